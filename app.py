@@ -1,35 +1,72 @@
-import psycopg2
+import io
+import math
+import os
+import time
+import uuid
 import atexit
-from psycopg2 import pool
 from inventory_items_table import InventoryItems
 from inventory_input import InventoryInput
 from inventory_utilities import InventoryUtilities
 from sales_items_table import SalesItems
-from orders import Orders
+from orders import InsufficientStock, OrderNotFound, Orders, ReservationReaper
 from deliveries import Deliveries
-from flask import Flask, render_template, request, jsonify, redirect, url_for
-
-
-app = Flask(__name__)
-
-# Database connection pooling configuration
-DB_HOST = 'localhost'
-DB_NAME = 'inventory'
-DB_USER = 'your_database_user'
-DB_PASSWORD = 'your_database_password'
-DB_PORT = 5432
-MIN_CONNS = 1
-MAX_CONNS = 10
-
-# Create a database connection pool
-db_pool = pool.ThreadedConnectionPool(
-    MIN_CONNS, MAX_CONNS,
-    host=DB_HOST,
-    database=DB_NAME,
-    user=DB_USER,
-    password=DB_PASSWORD,
-    port=DB_PORT
-)
+from database_utilities import (PRIORITY_READ, PRIORITY_REPORT, PRIORITY_WRITE, READ_YOUR_WRITES_SECONDS,
+                                db_config_from_env, get_db_pool, read_your_writes_until, set_read_your_writes_until,
+                                set_request_limits)
+from db_metrics import db_metrics, reset_shed_reason, shed_reason
+from stock_ledger import StockLedger
+from reports import Reports
+from forecasting import Forecaster
+from item_search import ItemSearch
+from valuation import InventoryValuation
+from query_cache import CacheInvalidationListener, query_cache
+from profiling import PROFILE_HEADER, RequestProfiler
+from validation import missing_field
+from bulk_import import IMPORT_TARGETS, bulk_import
+from change_feed import CHANGE_FEED_TABLES, ChangeFeed
+from export import stream_export
+from write_queue import GroupCommitQueue
+from flask import before_render_template, template_rendered
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, stream_template, stream_with_context
+
+
+# The templates live next to the modules rather than in templates/
+app = Flask(__name__, template_folder='.')
+
+# Group commit (write-behind) for /add_sale: rows are batched into one
+# multi-row INSERT and one commit; requests still wait for their commit.
+# /place_order reserves stock per order, so it always writes directly.
+GROUP_COMMIT = os.environ.get('GROUP_COMMIT') == '1'
+GROUP_COMMIT_BATCH_SIZE = int(os.environ.get('GROUP_COMMIT_BATCH_SIZE', 100))
+GROUP_COMMIT_MAX_DELAY = float(os.environ.get('GROUP_COMMIT_MAX_DELAY', 0.005))  # seconds
+
+# Admission control: under overload, requests queue for a connection by route priority and are
+# answered 503 + Retry-After when the wait or a statement runs out of time
+STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))
+REPORT_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_REPORT_STATEMENT_TIMEOUT_MS', 30000))
+RETRY_AFTER_SECONDS = int(os.environ.get('RETRY_AFTER_SECONDS', 1))
+# Endpoint -> (checkout priority, statement_timeout in ms or None); other POSTs are writes, other GETs reads
+ROUTE_LIMITS = {
+    'revenue_report': (PRIORITY_REPORT, REPORT_STATEMENT_TIMEOUT_MS),
+    'units_by_item_report': (PRIORITY_REPORT, REPORT_STATEMENT_TIMEOUT_MS),
+    'inventory_value_report': (PRIORITY_REPORT, REPORT_STATEMENT_TIMEOUT_MS),
+    'reorder_report': (PRIORITY_REPORT, REPORT_STATEMENT_TIMEOUT_MS),
+    'valuation_report': (PRIORITY_REPORT, REPORT_STATEMENT_TIMEOUT_MS),
+    # Both run as long as the file takes. An import is still a write and checks out ahead of reads;
+    # exports stream from their own thread, outside these limits
+    'bulk_import_rows': (PRIORITY_WRITE, None),
+    'export_rows': (PRIORITY_REPORT, None),
+}
+
+# Shared connection pool (configured from DB_* environment variables, connects on first use)
+db_pool = get_db_pool()
+
+# Cross-process cache invalidation: each worker LISTENs for other workers' writes
+CACHE_LISTEN = os.environ.get('CACHE_LISTEN') == '1'
+cache_listener = CacheInvalidationListener(query_cache, db_config_from_env())
+
+# Live row changes for open dashboards; the worker's LISTEN connection opens with the first subscriber
+change_feed = ChangeFeed(db_config_from_env())
 
 
 # Initialize classes with database connection pool
@@ -39,28 +76,163 @@ inventory_utilities = InventoryUtilities(db_pool)
 sales_items = SalesItems(db_pool)
 orders = Orders(db_pool)
 deliveries = Deliveries(db_pool)
+stock_ledger = StockLedger(db_pool)
+reports = Reports(db_pool)
+forecaster = Forecaster(db_pool)
+item_search = ItemSearch(db_pool)
+inventory_valuation = InventoryValuation(db_pool)
+
+reservation_reaper = ReservationReaper(orders)
+
+sales_queue = None
+if GROUP_COMMIT:
+    sales_queue = GroupCommitQueue(db_pool, 'sales', ['sale_date', 'item_name', 'quantity', 'price'],
+                                   GROUP_COMMIT_BATCH_SIZE, GROUP_COMMIT_MAX_DELAY)
+
+
+# Opt-in request profiling (see profiling.py): a PROFILE_SAMPLE_RATE share of requests, or any carrying
+# X-Profile: $PROFILE_TOKEN, get span timings in a Server-Timing header and run under cProfile; slow ones
+# are dumped to PROFILE_DIR as collapsed stacks for flame graphs. Registered first, so the profiler's
+# after_request runs last and sees everything. Disabled, the hooks below are never even registered.
+request_profiler = RequestProfiler()
+
+if request_profiler.enabled:
+    @app.before_request
+    def start_profiling():
+        request_profiler.begin(request.endpoint, request.headers.get(PROFILE_HEADER))
+
+    @app.after_request
+    def finish_profiling(response):
+        return request_profiler.finish(response)
+
+    @app.teardown_request
+    def abandon_profiling(error=None):
+        # after_request is skipped when a view raises; this still stops the profiler
+        request_profiler.finish()
+
+    before_render_template.connect(request_profiler.template_started, app)
+    template_rendered.connect(request_profiler.template_finished, app)
+
+
+@app.before_request
+def start_background_threads():
+    if CACHE_LISTEN:
+        cache_listener.ensure_running()
+    reservation_reaper.ensure_running()
+
+
+@app.before_request
+def apply_route_limits():
+    default = (PRIORITY_WRITE if request.method == 'POST' else PRIORITY_READ, STATEMENT_TIMEOUT_MS)
+    set_request_limits(*ROUTE_LIMITS.get(request.endpoint, default))
+    reset_shed_reason()
+
+
+@app.after_request
+def shed_overload(response):
+    # Routes turn exceptions into error bodies; a checkout or statement timeout still becomes a 503
+    if shed_reason():
+        response.status_code = 503
+        response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+    return response
+
+
+# Read-your-writes: a write sends this client's reads to the primary for a few seconds,
+# carried across requests (e.g. the redirect after a form POST) in a cookie
+READ_YOUR_WRITES_COOKIE = 'primary_reads_until'
+
+
+@app.before_request
+def restore_read_your_writes():
+    try:
+        set_read_your_writes_until(float(request.cookies.get(READ_YOUR_WRITES_COOKIE, 0)))
+    except ValueError:
+        set_read_your_writes_until(0.0)
+
+
+@app.after_request
+def save_read_your_writes(response):
+    until = read_your_writes_until()
+    if until > time.time() and str(until) != request.cookies.get(READ_YOUR_WRITES_COOKIE):
+        response.set_cookie(READ_YOUR_WRITES_COOKIE, str(until), max_age=math.ceil(READ_YOUR_WRITES_SECONDS),
+                            httponly=True, samesite='Lax')
+    return response
+
+
+# Listing helpers
+def listing_args(table_class):
+    # Pull pagination, sort and filter options off the query string
+    filters = {column: request.args[column] for column in table_class.FILTERABLE_COLUMNS if request.args.get(column)}
+    return {
+        'sort': request.args.get('sort') or None,
+        'descending': request.args.get('order') == 'desc',
+        'filters': filters,
+    }
+
+
+def render_listing(template, name, table, page_method, stream_method, extra_context=None, columns=None):
+    # extra_context(rows) adds per-page template data; it is skipped when streaming.
+    # columns limits the SELECT to what the template actually renders.
+    options = listing_args(table)
+    options['columns'] = columns
+    if request.args.get('stream'):
+        # Stream the whole table through a server-side cursor, rendering rows as they arrive
+        rows = stream_method(**options)
+        return Response(stream_with_context(stream_template(template, **{name: rows, 'next_cursor': None})))
+    rows, next_cursor = page_method(cursor=request.args.get('cursor'), limit=request.args.get('limit'), **options)
+    context = extra_context(rows) if extra_context else {}
+    return render_template(template, **{name: rows, 'next_cursor': next_cursor}, **context)
+
+
+def patch_results(apply):
+    # Bulk update routes: a JSON list of patches in, one {id, outcome, version} per patch out
+    patches = request.get_json(silent=True)
+    if not isinstance(patches, list):
+        raise ValueError("Expected a JSON list of patches")
+    results = apply(patches)
+    return jsonify({'updated': sum(result['outcome'] == 'updated' for result in results), 'results': results})
 
 
 # Inventory Routes
 @app.route('/inventory', methods=['GET'])
 def get_inventory():
     try:
-        inventory_data = inventory_items_table.get_inventory()
-        return render_template('inventory.html', inventory=inventory_data)
+        return render_listing('inventory.html', 'inventory', inventory_items_table,
+                              inventory_items_table.get_inventory_page, inventory_items_table.stream_inventory,
+                              lambda rows: {'balances': stock_ledger.get_balances([row.item_id for row in rows])},
+                              columns=('item_id', 'item_name', 'quantity'))
     except Exception as e:
         return f"Error: {str(e)}"
 
 
+@app.route('/stock/<int:item_id>', methods=['GET'])
+def get_stock(item_id):
+    try:
+        return jsonify({'item_id': item_id, 'on_hand': stock_ledger.get_balance(item_id)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/search/items', methods=['GET'])
+def search_items():
+    # Autocomplete for item name fields: prefix matches on item or vendor name, then typo-tolerant ones
+    try:
+        return jsonify({'items': item_search.search(request.args.get('q'), request.args.get('limit'))})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/add_item', methods=['POST'])
 def add_item():
     try:
         item_data = request.form
-        required_fields = ['item_name', 'vendor', 'quantity', 'value']
         
         # Validate data
-        for field in required_fields:
-            if not item_data.get(field):
-                return f"Error: Please fill out all fields. ({field} is missing)"
+        field = missing_field(item_data, 'add_item')
+        if field:
+            return f"Error: Please fill out all fields. ({field} is missing)"
         
         inventory_items_table.add_item(item_data)
         return redirect(url_for('get_inventory'))
@@ -68,12 +240,23 @@ def add_item():
         return f"Error: {str(e)}"
 
 
+@app.route('/update_items', methods=['POST'])
+def update_items():
+    # [{"item_id": 1, "version": 3, "value": 9.5}, ...]: only the given columns change, in one statement
+    try:
+        return patch_results(inventory_items_table.bulk_update)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 # Input Routes
 @app.route('/input', methods=['GET'])
 def get_input():
     try:
         input_data = inventory_input.get_input()
-        return render_template('input.html', input=input_data)
+        return render_template('inventory_input.html', input=input_data)
     except Exception as e:
         return f"Error: {str(e)}"
 
@@ -82,12 +265,11 @@ def get_input():
 def submit_input():
     try:
         input_data = request.form
-        required_fields = ['input_type', 'quantity', 'date']
         
         # Validate data
-        for field in required_fields:
-            if not input_data.get(field):
-                return f"Error: Please fill out all fields. ({field} is missing)"
+        field = missing_field(input_data, 'submit_input')
+        if field:
+            return f"Error: Please fill out all fields. ({field} is missing)"
         
         inventory_input.submit_input(input_data)
         return redirect(url_for('get_input'))
@@ -99,8 +281,8 @@ def submit_input():
 @app.route('/utilities', methods=['GET'])
 def get_utilities():
     try:
-        utilities_data = inventory_utilities.get_utilities()
-        return render_template('utilities.html', utilities=utilities_data)
+        return render_listing('utilities.html', 'utilities', inventory_utilities,
+                              inventory_utilities.get_utilities_page, inventory_utilities.stream_utilities)
     except Exception as e:
         return f"Error: {str(e)}"
 
@@ -109,12 +291,11 @@ def get_utilities():
 def run_utility():
     try:
         utility_data = request.form
-        required_fields = ['utility_name', 'parameters']
         
         # Validate data
-        for field in required_fields:
-            if not utility_data.get(field):
-                return f"Error: Please fill out all fields. ({field} is missing)"
+        field = missing_field(utility_data, 'run_utility')
+        if field:
+            return f"Error: Please fill out all fields. ({field} is missing)"
         
         inventory_utilities.run_utility(utility_data)
         return redirect(url_for('get_utilities'))
@@ -122,12 +303,24 @@ def run_utility():
         return f"Error: {str(e)}"
 
 
+@app.route('/utilities/status', methods=['GET'])
+def get_utility_status():
+    # Polled by utilities.html while jobs on the page are queued or running
+    try:
+        ids = [int(utility_id) for utility_id in request.args.getlist('id')]
+        states = inventory_utilities.get_utility_states(ids)
+        return jsonify({'utilities': [state._asdict() for state in states]})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
 # Sales Routes
 @app.route('/sales', methods=['GET'])
 def get_sales():
     try:
-        sales_data = sales_items.get_sales()
-        return render_template('sales.html', sales=sales_data)
+        return render_listing('sales_items.html', 'sales', sales_items,
+                              sales_items.get_sales_page, sales_items.stream_sales,
+                              columns=('sale_id', 'item_id', 'quantity', 'sale_date'))
     except Exception as e:
         return f"Error: {str(e)}"
 
@@ -136,14 +329,16 @@ def get_sales():
 def add_sale():
     try:
         sale_data = request.form
-        required_fields = ['sale_date', 'item_name', 'quantity', 'price']
         
         # Validate data
-        for field in required_fields:
-            if not sale_data.get(field):
-                return f"Error: Please fill out all fields. ({field} is missing)"
+        field = missing_field(sale_data, 'add_sale')
+        if field:
+            return f"Error: Please fill out all fields. ({field} is missing)"
         
-        sales_items.add_sale(sale_data)
+        if sales_queue:
+            sales_queue.write([sale_data[field] for field in sales_queue.columns])
+        else:
+            sales_items.add_sale(sale_data)
         return redirect(url_for('get_sales'))
     except Exception as e:
         return f"Error: {str(e)}"
@@ -153,8 +348,11 @@ def add_sale():
 @app.route('/orders', methods=['GET'])
 def get_orders():
     try:
-        orders_data = orders.get_orders()
-        return render_template('orders.html', orders=orders_data)
+        # Item, stock and latest delivery come from the same joined query as the orders, not a lookup per row
+        return render_listing('orders.html', 'orders', orders, orders.get_order_details_page,
+                              orders.stream_order_details, lambda rows: {'idempotency_key': uuid.uuid4().hex},
+                              columns=('order_id', 'item_id', 'item_name', 'quantity', 'order_date', 'status',
+                                       'vendor_name', 'available', 'last_delivery_date', 'last_delivery_quantity'))
     except Exception as e:
         return f"Error: {str(e)}"
 
@@ -163,15 +361,38 @@ def get_orders():
 def place_order():
     try:
         order_data = request.form
-        required_fields = ['order_date', 'customer_name', 'item_name', 'quantity']
         
         # Validate data
-        for field in required_fields:
-            if not order_data.get(field):
-                return f"Error: Please fill out all fields. ({field} is missing)"
+        field = missing_field(order_data, 'place_order')
+        if field:
+            return f"Error: Please fill out all fields. ({field} is missing)"
         
         orders.place_order(order_data)
         return redirect(url_for('get_orders'))
+    except InsufficientStock as e:
+        return f"Error: {str(e)}", 409
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+
+@app.route('/confirm_order/<int:order_id>', methods=['POST'])
+def confirm_order(order_id):
+    try:
+        orders.confirm_order(order_id, request.form.get('sale_date') or None)
+        return redirect(url_for('get_orders'))
+    except OrderNotFound as e:
+        return f"Error: {str(e)}", 404
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+
+@app.route('/cancel_order/<int:order_id>', methods=['POST'])
+def cancel_order(order_id):
+    try:
+        orders.cancel_order(order_id)
+        return redirect(url_for('get_orders'))
+    except OrderNotFound as e:
+        return f"Error: {str(e)}", 404
     except Exception as e:
         return f"Error: {str(e)}"
 
@@ -180,8 +401,9 @@ def place_order():
 @app.route('/deliveries', methods=['GET'])
 def get_deliveries():
     try:
-        deliveries_data = deliveries.get_deliveries()
-        return render_template('deliveries.html', deliveries=deliveries_data)
+        return render_listing('deliveries.html', 'deliveries', deliveries,
+                              deliveries.get_all_deliveries_page, deliveries.stream_deliveries,
+                              columns=('delivery_id', 'delivery_date', 'status'))
     except Exception as e:
         return f"Error: {str(e)}"
 
@@ -190,12 +412,11 @@ def get_deliveries():
 def record_delivery():
     try:
         delivery_data = request.form
-        required_fields = ['order_id', 'date', 'status']
         
         # Validate data
-        for field in required_fields:
-            if not delivery_data.get(field):
-                return f"Error: Please fill out all fields. ({field} is missing)"
+        field = missing_field(delivery_data, 'record_delivery')
+        if field:
+            return f"Error: Please fill out all fields. ({field} is missing)"
         
         deliveries.add_delivery(delivery_data['order_id'], delivery_data['date'], delivery_data['status'])
         return redirect(url_for('get_deliveries'))
@@ -203,8 +424,171 @@ def record_delivery():
         return f"Error: {str(e)}"
 
 
+@app.route('/record_deliveries', methods=['POST'])
+def record_deliveries():
+    # Batched status changes, e.g. a truck's deliveries marked delivered:
+    # [{"delivery_id": 7, "status": "delivered", "version": 2}, ...]
+    try:
+        return patch_results(deliveries.transition_status)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/update_deliveries', methods=['POST'])
+def update_deliveries():
+    # [{"delivery_id": 7, "version": 2, "quantity": 40}, ...]: only the given columns change, in one statement
+    try:
+        return patch_results(deliveries.bulk_update)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# Report Routes
+@app.route('/reports/revenue', methods=['GET'])
+def revenue_report():
+    try:
+        return jsonify(reports.revenue(request.args.get('period', 'day'), request.args.get('start'),
+                                       request.args.get('end'), int(request.args.get('window', 7))))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/reports/units_by_item', methods=['GET'])
+def units_by_item_report():
+    try:
+        return jsonify(reports.units_by_item(request.args.get('start'), request.args.get('end'),
+                                             int(request.args.get('limit', 100))))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/reports/inventory_value', methods=['GET'])
+def inventory_value_report():
+    try:
+        return jsonify(reports.inventory_value_by_vendor())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/reports/valuation', methods=['GET'])
+def valuation_report():
+    # ?as_of=YYYY-MM-DD[&detail=1]: the nearest snapshot (taken daily by the utility runner) plus movements since
+    try:
+        return jsonify(inventory_valuation.valuation(request.args.get('as_of'), bool(request.args.get('detail'))))
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/reports/reorder', methods=['GET'])
+def reorder_report():
+    # Refreshed by the nightly forecast utility (or 'python forecasting.py')
+    try:
+        return jsonify({'items': forecaster.reorder_list(request.args.get('vendor_name'),
+                                                         int(request.args.get('limit', 100)))})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/forecast/<int:item_id>', methods=['GET'])
+def get_item_forecast(item_id):
+    try:
+        result = forecaster.get_forecast(item_id)
+        if result is None:
+            return jsonify({'error': f"No forecast for item {item_id}"}), 404
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# Change Feed Routes
+@app.route('/changes', methods=['GET'])
+def changes():
+    # Server-Sent Events: ?tables=inventory,deliveries; pages patch their tables from each event
+    tables = request.args['tables'].split(',') if request.args.get('tables') else CHANGE_FEED_TABLES
+    unknown = [table for table in tables if table not in CHANGE_FEED_TABLES]
+    if unknown:
+        return jsonify({'error': f"No change feed for {', '.join(unknown)}"}), 400
+    change_feed.ensure_running()
+    events = change_feed.subscribe(tables, request.headers.get('Last-Event-ID'))
+    return Response(events, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Metrics Routes
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(db_metrics.render_prometheus() + query_cache.render_prometheus() + change_feed.render_prometheus(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+# Bulk Import Routes
+@app.route('/bulk_import/<table>', methods=['POST'])
+def bulk_import_rows(table):
+    try:
+        if table not in IMPORT_TARGETS:
+            return jsonify({'error': f"Bulk import is not supported for {table}"}), 404
+
+        upload = request.files.get('file')
+        if upload:
+            stream = io.TextIOWrapper(upload.stream, encoding='utf-8', newline='')
+            filename = upload.filename or ''
+        else:
+            stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+            filename = ''
+
+        file_format = request.args.get('format')
+        if not file_format:
+            is_jsonl = filename.endswith(('.jsonl', '.ndjson')) or 'ndjson' in (request.mimetype or '')
+            file_format = 'jsonl' if is_jsonl else 'csv'
+
+        result = bulk_import(db_pool, table, stream, file_format)
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# Export Routes
+@app.route('/export/<table>', methods=['GET'])
+def export_rows(table):
+    # Streams COPY output as CSV: ?columns=a,b&start=YYYY-MM-DD&end=YYYY-MM-DD&gzip=1
+    try:
+        args = request.args
+        columns = args['columns'].split(',') if args.get('columns') else None
+        compress = args.get('gzip') == '1'
+        chunks = stream_export(db_pool, table, columns, args.get('start'), args.get('end'), compress)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        # e.g. PoolOverloaded, which shed_overload turns into a 503
+        return jsonify({'error': str(e)}), 500
+
+    filename = f"{table}.csv.gz" if compress else f"{table}.csv"
+    return Response(chunks, mimetype='application/gzip' if compress else 'text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
 if __name__ == '__main__':
     app.run(debug=True)
 
 # When shutting down the application, close all database connections
 atexit.register(db_pool.closeall)
+
+# Flush any queued writes before the pool goes away (atexit runs these first)
+if sales_queue:
+    atexit.register(sales_queue.close)
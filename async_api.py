@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+from functools import partial
+from aiohttp import web
+from psycopg import Rollback
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+from database_utilities import db_config_from_env
+from orders import FIND_ORDER_SQL, INSERT_ORDER_SQL, RESERVE_STOCK_SQL, order_params
+from pagination import build_keyset_query, clamp_limit, encode_cursor
+from validation import missing_field
+
+
+ASYNC_MIN_CONNS = int(os.environ.get('ASYNC_DB_MIN_CONNS', 2))
+ASYNC_MAX_CONNS = int(os.environ.get('ASYNC_DB_MAX_CONNS', 10))
+# Largest JSON array accepted by one POST
+MAX_BATCH_ROWS = 1000
+
+# Each resource: table, primary key, listed columns, the route whose validation rules apply and the
+# columns a POST inserts. Deliveries follow Deliveries.insert_delivery, since the deliveries table has
+# no order_id/status columns for the /record_delivery form fields.
+RESOURCES = {
+    'inventory': {
+        'table': 'inventory', 'pk': 'item_id',
+        'columns': ('item_id', 'item_name', 'vendor_name', 'quantity', 'value'),
+        'sortable': ('item_name', 'vendor_name', 'quantity', 'value'),
+        'filterable': ('item_name', 'vendor_name'),
+        'route': 'add_item', 'insert': ('item_name', 'vendor_name', 'quantity', 'value'),
+    },
+    'sales': {
+        'table': 'sales', 'pk': 'sale_id',
+        'columns': ('sale_id', 'sale_date', 'item_name', 'quantity', 'price'),
+        'sortable': ('sale_date', 'item_name', 'quantity', 'price'),
+        'filterable': ('sale_date', 'item_name'),
+        'route': 'add_sale', 'insert': ('sale_date', 'item_name', 'quantity', 'price'),
+    },
+    'orders': {
+        'table': 'orders', 'pk': 'order_id',
+        'columns': ('order_id', 'order_date', 'customer_name', 'item_id', 'item_name', 'quantity', 'status'),
+        'sortable': ('order_date', 'customer_name', 'item_name', 'status'),
+        'filterable': ('order_date', 'customer_name', 'item_name', 'status'),
+        # POSTs go through place_orders, which reserves stock like /place_order
+        'route': 'place_order', 'insert': ('order_date', 'customer_name', 'item_name', 'quantity'),
+    },
+    'deliveries': {
+        'table': 'deliveries', 'pk': 'delivery_id',
+        'columns': ('delivery_id', 'delivery_date', 'vendor_name', 'item_name', 'quantity', 'unit_price'),
+        'sortable': ('delivery_date', 'vendor_name', 'item_name', 'quantity', 'unit_price'),
+        'filterable': ('delivery_date', 'vendor_name', 'item_name'),
+        'route': 'insert_delivery',
+        'insert': ('delivery_date', 'vendor_name', 'item_name', 'quantity', 'unit_price'),
+    },
+}
+
+
+def json_response(data, status=200):
+    # Dates and NUMERIC values serialize as strings
+    return web.json_response(data, status=status, dumps=partial(json.dumps, default=str))
+
+
+def async_conninfo():
+    config = dict(db_config_from_env())
+    config['dbname'] = config.pop('database')
+    return make_conninfo(**config)
+
+
+async def list_rows(request):
+    resource = RESOURCES[request.match_info['resource']]
+    args = request.query
+    limit = clamp_limit(args.get('limit'))
+    filters = {column: args[column] for column in resource['filterable'] if args.get(column)}
+    sort = args.get('sort') or None
+    try:
+        query, params = build_keyset_query(resource['table'], resource['pk'], resource['columns'], filters,
+                                           sort, args.get('order') == 'desc', args.get('cursor'), limit + 1,
+                                           resource['sortable'], resource['filterable'])
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+
+    async with request.app['pool'].connection() as conn:
+        cur = await conn.execute(query, params)
+        rows = await cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        columns = resource['columns']
+        next_cursor = encode_cursor(rows[-1][columns.index(sort or resource['pk'])],
+                                    rows[-1][columns.index(resource['pk'])])
+    return json_response({
+        'rows': [dict(zip(resource['columns'], row)) for row in rows],
+        'next_cursor': next_cursor,
+    })
+
+
+async def create_rows(request):
+    """Insert one JSON object or an array of them.
+
+    Every record is validated with the same required-field rules as the
+    matching Flask route. The INSERTs for an array are sent in pipeline mode,
+    so the batch costs one network round trip and one commit.
+    """
+    resource = RESOURCES[request.match_info['resource']]
+    try:
+        body = await request.json()
+    except ValueError:
+        return json_response({'error': "Request body must be JSON"}, 400)
+
+    records = body if isinstance(body, list) else [body]
+    if len(records) > MAX_BATCH_ROWS:
+        return json_response({'error': f"At most {MAX_BATCH_ROWS} records per request"}, 413)
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            return json_response({'error': f"Record {index} must be an object"}, 400)
+        field = missing_field(record, resource['route'])
+        if field:
+            return json_response({'error': f"Please fill out all fields. ({field} is missing)",
+                                  'record': index}, 400)
+
+    if resource['table'] == 'orders':
+        return await place_orders(request, records)
+
+    columns = resource['insert']
+    query = (f"INSERT INTO {resource['table']} ({', '.join(columns)}) "
+             f"VALUES ({', '.join(['%s'] * len(columns))}) RETURNING {resource['pk']};")
+    async with request.app['pool'].connection() as conn:
+        async with conn.transaction():
+            cursors = []
+            async with conn.pipeline():
+                for record in records:
+                    cur = conn.cursor()
+                    await cur.execute(query, [record[column] for column in columns])
+                    cursors.append(cur)
+            ids = [(await cur.fetchone())[0] for cur in cursors]
+    return json_response({'ids': ids}, 201)
+
+
+async def place_orders(request, records):
+    """Place orders through the same reservation statements as ``Orders.place_order``.
+
+    Each order is its own transaction so one out-of-stock item doesn't undo
+    the others; the response reports every order's outcome.
+    """
+    results = []
+    status = 201
+    async with request.app['pool'].connection() as conn:
+        for record in records:
+            try:
+                params = order_params(record)
+                if params['quantity'] <= 0:
+                    raise ValueError("Quantity must be positive")
+            except (TypeError, ValueError) as e:
+                results.append({'error': str(e)})
+                status = 207
+                continue
+            async with conn.transaction() as tx:
+                cur = await conn.execute(INSERT_ORDER_SQL, params)
+                row = await cur.fetchone()
+                if row is None:
+                    existing = None
+                    if params['idempotency_key']:
+                        existing = await (await conn.execute(FIND_ORDER_SQL, params)).fetchone()
+                    if existing:
+                        results.append({'order_id': existing[0], 'status': existing[1], 'replayed': True})
+                    else:
+                        results.append({'error': f"Unknown item {params['item_id'] or params['item_name']}"})
+                        status = 207
+                    continue
+                order_id, params['item_id'] = row
+                cur = await conn.execute(RESERVE_STOCK_SQL, params)
+                if cur.rowcount != 1:
+                    # Undo the order row; the other orders in the request keep going
+                    results.append({'error': f"Not enough stock to reserve {params['quantity']} units"})
+                    status = 207
+                    raise Rollback(tx)
+                results.append({'order_id': order_id, 'status': 'reserved'})
+    return json_response({'orders': results}, status)
+
+
+async def open_pool(app):
+    app['pool'] = AsyncConnectionPool(async_conninfo(), min_size=ASYNC_MIN_CONNS, max_size=ASYNC_MAX_CONNS,
+                                      open=False)
+    await app['pool'].open()
+
+
+async def close_pool(app):
+    await app['pool'].close()
+
+
+def create_app():
+    app = web.Application()
+    resources = '{resource:' + '|'.join(RESOURCES) + '}'
+    app.router.add_get(f'/api/{resources}', list_rows)
+    app.router.add_post(f'/api/{resources}', create_rows)
+    app.on_startup.append(open_pool)
+    app.on_cleanup.append(close_pool)
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the async JSON API")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args(argv)
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,414 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import numpy as np
+
+
+SCALES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000, '10m': 10_000_000}
+SEED_START = date(2020, 1, 1)
+# Regressions beyond this fraction (latency up, throughput down) are flagged by compare
+DEFAULT_THRESHOLD = 0.10
+
+
+class ThrowawayCluster:
+    """A private PostgreSQL cluster created with initdb in a temp directory."""
+
+    def __init__(self, bindir=None):
+        self.bindir = bindir or os.environ.get('PG_BINDIR', '')
+        self.datadir = tempfile.mkdtemp(prefix='inventory-bench-')
+        self.port = free_port()
+
+    def tool(self, name):
+        return os.path.join(self.bindir, name) if self.bindir else shutil.which(name) or name
+
+    def start(self):
+        subprocess.run([self.tool('initdb'), '-D', self.datadir, '-U', 'bench', '--auth=trust', '-E', 'UTF8'],
+                       check=True, stdout=subprocess.DEVNULL)
+        options = f"-p {self.port} -k {self.datadir} -c fsync=off -c max_connections=200"
+        subprocess.run([self.tool('pg_ctl'), '-D', self.datadir, '-o', options, '-w', '-l',
+                        os.path.join(self.datadir, 'server.log'), 'start'], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([self.tool('createdb'), '-h', '127.0.0.1', '-p', str(self.port), '-U', 'bench', 'inventory'],
+                       check=True)
+        return {'DB_HOST': '127.0.0.1', 'DB_PORT': str(self.port), 'DB_NAME': 'inventory',
+                'DB_USER': 'bench', 'DB_PASSWORD': ''}
+
+    def start_standby(self):
+        # Streaming replica of this cluster on its own port; returns its DB_* settings like start()
+        self.standby_dir = tempfile.mkdtemp(prefix='inventory-bench-standby-')
+        self.standby_port = free_port()
+        subprocess.run([self.tool('pg_basebackup'), '-h', '127.0.0.1', '-p', str(self.port), '-U', 'bench',
+                        '-D', self.standby_dir, '-R', '-X', 'stream'], check=True)
+        options = f"-p {self.standby_port} -k {self.standby_dir} -c hot_standby=on"
+        subprocess.run([self.tool('pg_ctl'), '-D', self.standby_dir, '-o', options, '-w', '-l',
+                        os.path.join(self.standby_dir, 'server.log'), 'start'], check=True, stdout=subprocess.DEVNULL)
+        return {'DB_HOST': '127.0.0.1', 'DB_PORT': str(self.standby_port), 'DB_NAME': 'inventory',
+                'DB_USER': 'bench', 'DB_PASSWORD': ''}
+
+    def stop(self):
+        for datadir in (getattr(self, 'standby_dir', None), self.datadir):
+            if datadir:
+                subprocess.run([self.tool('pg_ctl'), '-D', datadir, '-m', 'fast', 'stop'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                shutil.rmtree(datadir, ignore_errors=True)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def seed(db_pool, sales_rows):
+    """Generate inventory, sales and deliveries server-side with generate_series.
+
+    Inventory gets one item per 100 sales and deliveries one row per 10 sales,
+    so relative table sizes stay realistic at every scale.
+    """
+    items = max(sales_rows // 100, 10)
+    deliveries = max(sales_rows // 10, 10)
+    conn = db_pool.getconn()
+    try:
+        cur = conn.cursor()
+        cur.execute("TRUNCATE sales, deliveries, inventory_inputs, inventory RESTART IDENTITY CASCADE;")
+        cur.execute("""
+            INSERT INTO inventory (item_name, vendor_name, quantity, value)
+            SELECT 'item-' || g, 'vendor-' || (g %% 200), 100 + g %% 50, round((1 + random() * 99)::numeric, 2)
+            FROM generate_series(1, %s) g;
+        """, (items,))
+        cur.execute("""
+            INSERT INTO sales (sale_date, item_name, quantity, price)
+            SELECT %s::date + (g %% 1460), 'item-' || (1 + g %% %s), 1 + g %% 5, round((1 + random() * 99)::numeric, 2)
+            FROM generate_series(1, %s) g;
+        """, (SEED_START, items, sales_rows))
+        cur.execute("""
+            INSERT INTO deliveries (delivery_date, vendor_name, item_name, quantity, unit_price)
+            SELECT %s::date + (g %% 1460), 'vendor-' || (g %% 200), 'item-' || (1 + g %% %s), 10 + g %% 40,
+                   round((1 + random() * 50)::numeric, 2)
+            FROM generate_series(1, %s) g;
+        """, (SEED_START, items, deliveries))
+        conn.commit()
+        cur.execute("ANALYZE;")
+        conn.commit()
+    finally:
+        db_pool.putconn(conn)
+    return {'inventory': items, 'sales': sales_rows, 'deliveries': deliveries}
+
+
+def random_sale(items):
+    return {'sale_date': (SEED_START + timedelta(days=random.randrange(1460))).isoformat(),
+            'item_name': f"item-{random.randint(1, items)}", 'quantity': '1', 'price': '9.99'}
+
+
+def random_order(items):
+    return {'order_date': date.today().isoformat(), 'customer_name': 'bench',
+            'item_name': f"item-{random.randint(1, items)}", 'quantity': '1'}
+
+
+def route_workloads(items):
+    # (name, method, path or path factory, form factory)
+    return [
+        ('GET /inventory', 'GET', '/inventory', None),
+        ('GET /sales', 'GET', '/sales', None),
+        ('GET /sales?sort=sale_date', 'GET', '/sales?sort=sale_date&order=desc', None),
+        ('GET /deliveries', 'GET', '/deliveries', None),
+        ('GET /orders', 'GET', '/orders', None),
+        ('GET /utilities', 'GET', '/utilities', None),
+        ('GET /stock/<id>', 'GET', lambda: f"/stock/{random.randint(1, items)}", None),
+        ('GET /search/items', 'GET', lambda: f"/search/items?q=item-{random.randint(1, items) // 10}", None),
+        ('GET /search/items (typo)', 'GET', lambda: f"/search/items?q=itme-{random.randint(1, items)}", None),
+        ('GET /reports/revenue', 'GET', '/reports/revenue?period=month', None),
+        ('GET /reports/units_by_item', 'GET', '/reports/units_by_item', None),
+        ('GET /reports/inventory_value', 'GET', '/reports/inventory_value', None),
+        ('POST /add_sale', 'POST', '/add_sale', lambda: random_sale(items)),
+        ('POST /place_order', 'POST', '/place_order', lambda: random_order(items)),
+    ]
+
+
+def table_workloads(items):
+    # Drive the data-access layer directly, without Flask or templates in the way
+    from app import deliveries, inventory_items_table, sales_items
+    return [
+        ('InventoryItems.get_inventory_page', inventory_items_table.get_inventory_page),
+        ('SalesItems.get_sales_page', sales_items.get_sales_page),
+        ('SalesItems.get_sales_page(filter)',
+         lambda: sales_items.get_sales_page(filters={'item_name': f"item-{random.randint(1, items)}"})),
+        ('Deliveries.get_all_deliveries_page', deliveries.get_all_deliveries_page),
+        ('SalesItems.add_sale', lambda: sales_items.add_sale(random_sale(items))),
+    ]
+
+
+def http_caller(base_url, method, path, form):
+    # Call a running server; a 200 whose body starts with "Error:" is still a failure
+    def call():
+        target = path() if callable(path) else path
+        data = urllib.parse.urlencode(form()).encode() if form else None
+        req = urllib.request.Request(base_url + target, data=data, method=method)
+        try:
+            with urllib.request.urlopen(req) as response:
+                return not response.read(6).startswith(b'Error:')
+        except urllib.error.HTTPError as e:
+            return e.code < 400
+    return call
+
+
+def client_caller(client, method, path, form):
+    # Call the Flask app in-process through its test client
+    def call():
+        target = path() if callable(path) else path
+        response = client.open(target, method=method, data=form() if form else None)
+        return response.status_code < 400 and not response.get_data()[:6].startswith(b'Error:')
+    return call
+
+
+def measure(call, clients, requests):
+    """Run ``requests`` calls spread over ``clients`` threads; return latencies and errors."""
+    latencies = np.zeros(requests)
+    errors = 0
+    counter = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker():
+        nonlocal errors
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            start = time.perf_counter()
+            try:
+                ok = call()
+            except Exception:
+                ok = False
+            latencies[index] = time.perf_counter() - start
+            if not ok:
+                with lock:
+                    errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        for _ in range(clients):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def summarize(latencies, errors, elapsed):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000 if len(latencies) else (0, 0, 0)
+    return {
+        'requests': int(len(latencies)),
+        'errors': int(errors),
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+    }
+
+
+def run(args):
+    cluster = None
+    env = {}
+    if not args.no_cluster:
+        cluster = ThrowawayCluster(args.pg_bindir)
+        env = cluster.start()
+    os.environ.update(env)
+
+    try:
+        # Import after DB_* is set so the shared pool points at the benchmark database
+        from database_utilities import get_db_pool
+        from migrations import migrate
+
+        db_pool = get_db_pool()
+        migrate(db_pool, log=lambda message: None)
+        seeded = seed(db_pool, SCALES[args.scale]) if not args.no_seed else {}
+        items = seeded.get('inventory', 100)
+
+        results = {}
+        if args.url:
+            callers = [(name, http_caller(args.url.rstrip('/'), method, path, form))
+                       for name, method, path, form in route_workloads(items)]
+        else:
+            from app import app
+            client = app.test_client()
+            callers = [(name, client_caller(client, method, path, form))
+                       for name, method, path, form in route_workloads(items)]
+        if not args.routes_only:
+            callers += table_workloads(items)
+
+        for name, call in callers:
+            if args.only and args.only not in name:
+                continue
+            call()  # warm up
+            results[name] = summarize(*measure(call, args.clients, args.requests))
+            print(format_row(name, results[name]))
+
+        report = {
+            'scale': args.scale,
+            'seeded': seeded,
+            'clients': args.clients,
+            'requests': args.requests,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'results': results,
+        }
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        return 0
+    finally:
+        if cluster:
+            cluster.stop()
+
+
+def replica_check(args):
+    """Check read routing against a primary plus streaming replica.
+
+    Reads should land on the replica, go to the primary right after a write
+    and while replay is paused past the lag limit, and return to the replica
+    once it catches up.
+    """
+    cluster = ThrowawayCluster(args.pg_bindir)
+    try:
+        env = cluster.start()
+        replica_env = cluster.start_standby()
+
+        def kwargs(settings):
+            return {'host': settings['DB_HOST'], 'port': int(settings['DB_PORT']), 'database': settings['DB_NAME'],
+                    'user': settings['DB_USER'], 'password': settings['DB_PASSWORD']}
+
+        import database_utilities
+        db_pool = database_utilities.DatabaseConnectionPool(1, 4, replica_kwargs=kwargs(replica_env),
+                                                            max_lag=args.max_lag, **kwargs(env))
+
+        def read_from_replica():
+            conn = db_pool.getconn(readonly=True)
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT pg_is_in_recovery();")
+                return cur.fetchone()[0]
+            finally:
+                conn.rollback()
+                db_pool.putconn(conn)
+
+        def write():
+            conn = db_pool.getconn()
+            try:
+                conn.cursor().execute("CREATE TABLE IF NOT EXISTS replica_check (t timestamptz);"
+                                      "INSERT INTO replica_check VALUES (now());")
+                conn.commit()
+            finally:
+                db_pool.putconn(conn)
+
+        def wait_for_replica(timeout=30):
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                db_pool.lag_checked_at = 0.0
+                if read_from_replica():
+                    return True
+                time.sleep(0.2)
+            return False
+
+        checks = []
+        checks.append(('reads use the replica', wait_for_replica()))
+
+        write()
+        database_utilities.mark_write()
+        checks.append(('reads follow a write to the primary', not read_from_replica()))
+        database_utilities.set_read_your_writes_until(0.0)
+
+        replay = db_pool.getconn(readonly=True)
+        replay.autocommit = True
+        replay.cursor().execute("SELECT pg_wal_replay_pause();")
+        write()
+        time.sleep(args.max_lag + 1)
+        write()
+        db_pool.lag_checked_at = 0.0
+        checks.append(('reads skip a lagging replica', not read_from_replica()))
+        replay.cursor().execute("SELECT pg_wal_replay_resume();")
+        replay.autocommit = False
+        db_pool.putconn(replay)
+        checks.append(('reads return once the replica catches up', wait_for_replica()))
+
+        for name, ok in checks:
+            print(f"{name:45s} {'ok' if ok else 'FAILED'}")
+        db_pool.closeall()
+        return 0 if all(ok for _, ok in checks) else 1
+    finally:
+        cluster.stop()
+
+
+def format_row(name, result):
+    return (f"{name:45s} {result['throughput']:9.1f} req/s  p50 {result['p50_ms']:8.2f} ms  "
+            f"p95 {result['p95_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms  errors {result['errors']}")
+
+
+def compare(args):
+    """Print per-endpoint deltas between two result files and flag regressions."""
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    with open(args.candidate) as f:
+        candidate = json.load(f)['results']
+
+    regressions = 0
+    for name in sorted(set(baseline) & set(candidate)):
+        old, new = baseline[name], candidate[name]
+        flags = []
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if old[metric] and (new[metric] - old[metric]) / old[metric] > args.threshold:
+                flags.append(f"{metric} +{(new[metric] / old[metric] - 1) * 100:.0f}%")
+        if old['throughput'] and (old['throughput'] - new['throughput']) / old['throughput'] > args.threshold:
+            flags.append(f"throughput -{(1 - new['throughput'] / old['throughput']) * 100:.0f}%")
+        if new['errors'] > old['errors']:
+            flags.append(f"errors {old['errors']} -> {new['errors']}")
+        regressions += bool(flags)
+        status = 'REGRESSION ' + ', '.join(flags) if flags else 'ok'
+        print(f"{name:45s} p95 {old['p95_ms']:8.2f} -> {new['p95_ms']:8.2f} ms  "
+              f"{old['throughput']:9.1f} -> {new['throughput']:9.1f} req/s  {status}")
+    for name in sorted(set(baseline) ^ set(candidate)):
+        print(f"{name:45s} only in {'baseline' if name in baseline else 'candidate'}")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load and latency benchmarks for the inventory app")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="seed a database and benchmark every route")
+    run_parser.add_argument('--scale', choices=sorted(SCALES, key=SCALES.get), default='10k')
+    run_parser.add_argument('--clients', type=int, default=8)
+    run_parser.add_argument('--requests', type=int, default=500, help="per endpoint")
+    run_parser.add_argument('--url', help="benchmark a running server instead of the in-process app")
+    run_parser.add_argument('--no-cluster', action='store_true', help="use DB_* from the environment")
+    run_parser.add_argument('--no-seed', action='store_true')
+    run_parser.add_argument('--pg-bindir', help="directory containing initdb/pg_ctl")
+    run_parser.add_argument('--routes-only', action='store_true')
+    run_parser.add_argument('--only', help="run endpoints whose name contains this text")
+    run_parser.add_argument('--output', help="write results to this JSON file")
+
+    compare_parser = commands.add_parser('compare', help="flag regressions between two result files")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+
+    replica_parser = commands.add_parser('replica-check', help="verify read routing with a streaming replica")
+    replica_parser.add_argument('--pg-bindir', help="directory containing initdb/pg_ctl/pg_basebackup")
+    replica_parser.add_argument('--max-lag', type=float, default=1.0, help="replica lag limit in seconds")
+
+    args = parser.parse_args(argv)
+    return {'run': run, 'compare': compare, 'replica-check': replica_check}[args.command](args)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,147 @@
+import argparse
+import csv
+import io
+import json
+import tempfile
+from datetime import date
+from change_feed import publish_reload
+from database_utilities import get_db_pool, mark_write
+from query_cache import query_cache
+from validation import missing_field
+
+
+# Target tables for bulk loads: the route whose validation rules apply and the typed columns to load
+IMPORT_TARGETS = {
+    'inventory': {
+        'route': 'add_item',
+        'columns': [('item_name', str), ('vendor_name', str), ('quantity', int), ('value', float)],
+    },
+    'sales': {
+        'route': 'add_sale',
+        'columns': [('sale_date', date.fromisoformat), ('item_name', str), ('quantity', int), ('price', float)],
+    },
+    'deliveries': {
+        'route': 'insert_delivery',
+        'columns': [('delivery_date', date.fromisoformat), ('vendor_name', str), ('item_name', str),
+                    ('quantity', int), ('unit_price', float)],
+    },
+}
+
+# Validated rows are spooled to disk past this size so huge files don't sit in memory
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+
+def read_rows(stream, file_format):
+    # Yield (line_number, record) pairs from a CSV (with header) or JSON-lines text stream
+    if file_format == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif file_format == 'jsonl':
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_number, e
+                continue
+            yield line_number, record
+    else:
+        raise ValueError(f"Unsupported import format: {file_format}")
+
+
+def validate_row(record, target):
+    # Apply the route's required-field rules, then coerce each column to its type
+    if isinstance(record, Exception):
+        raise ValueError(f"Malformed line: {record}")
+    if not isinstance(record, dict):
+        raise ValueError("Each line must be an object")
+    field = missing_field(record, target['route'])
+    if field:
+        raise ValueError(f"{field} is missing")
+
+    values = []
+    for column, convert in target['columns']:
+        raw = record[column]
+        try:
+            values.append(convert(raw.strip() if isinstance(raw, str) else raw))
+        except (TypeError, ValueError):
+            raise ValueError(f"{column} has invalid value {raw!r}")
+    return values
+
+
+def bulk_import(db_pool, table, stream, file_format='csv'):
+    """Load rows from ``stream`` into ``table`` with COPY FROM STDIN.
+
+    Every row is validated up front; bad rows are reported as rejects and the
+    rest are copied into a temporary staging table, then moved into the real
+    table with one INSERT ... SELECT and a single commit.
+    """
+    if table not in IMPORT_TARGETS:
+        raise ValueError(f"Bulk import is not supported for {table}")
+    target = IMPORT_TARGETS[table]
+    columns = [column for column, _ in target['columns']]
+
+    rejected = []
+    accepted = 0
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES, mode='w+', newline='') as buffer:
+        writer = csv.writer(buffer)
+        for line_number, record in read_rows(stream, file_format):
+            try:
+                writer.writerow(validate_row(record, target))
+                accepted += 1
+            except ValueError as e:
+                rejected.append({'line': line_number, 'error': str(e)})
+
+        inserted = 0
+        if accepted:
+            buffer.seek(0)
+            column_list = ', '.join(columns)
+            conn = db_pool.getconn()
+            try:
+                cur = conn.cursor()
+                cur.execute(f"""
+                    CREATE TEMP TABLE {table}_staging ON COMMIT DROP AS
+                    SELECT {column_list} FROM {table} WITH NO DATA;
+                """)
+                cur.copy_expert(f"COPY {table}_staging ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+                # One reload event for the whole load instead of a change notification per row
+                cur.execute("SET LOCAL inventory.change_feed = 'off';")
+                cur.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {table}_staging;")
+                inserted = cur.rowcount
+                publish_reload(cur, table)
+                publish_reload(cur, 'stock_balances')
+                conn.commit()
+                query_cache.invalidate(table, 'stock_balances')
+                mark_write()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                db_pool.putconn(conn)
+
+    return {'inserted': inserted, 'rejected': rejected}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk load CSV or JSON-lines files with COPY")
+    parser.add_argument('table', choices=sorted(IMPORT_TARGETS))
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default=None,
+                        help="defaults to the file extension")
+    args = parser.parse_args(argv)
+
+    file_format = args.format or ('jsonl' if args.path.endswith(('.jsonl', '.ndjson')) else 'csv')
+
+    with io.open(args.path, encoding='utf-8', newline='') as stream:
+        result = bulk_import(get_db_pool(), args.table, stream, file_format)
+
+    print(f"Inserted {result['inserted']} rows into {args.table}")
+    for reject in result['rejected']:
+        print(f"  line {reject['line']}: {reject['error']}")
+    return 1 if result['rejected'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,129 @@
+from psycopg2.extras import execute_values
+
+
+# Patches sent per UPDATE statement; larger batches run as several statements in one transaction
+PATCH_PAGE_SIZE = 1000
+
+# Per-row outcomes of apply_patches
+UPDATED = 'updated'
+CONFLICT = 'conflict'  # the row's version moved on since the client read it
+REJECTED = 'rejected'  # the version matched but ``condition`` did not hold
+NOT_FOUND = 'not_found'
+
+
+def normalize_patches(patches, pk, columns):
+    # [(id, version or None, {column: value})], checking every key against the whitelist
+    normalized = []
+    seen = set()
+    for patch in patches:
+        if not isinstance(patch, dict) or pk not in patch:
+            raise ValueError(f"Every patch needs a {pk}")
+        unknown = [key for key in patch if key not in columns and key not in (pk, 'version')]
+        if unknown:
+            raise ValueError(f"Cannot update {', '.join(unknown)}")
+        row_id = int(patch[pk])
+        if row_id in seen:
+            # UPDATE ... FROM would apply only one of them, and not predictably which
+            raise ValueError(f"{pk} {row_id} is patched more than once")
+        seen.add(row_id)
+        version = patch.get('version')
+        values = {column: value for column, value in patch.items() if column in columns}
+        normalized.append((row_id, None if version is None else int(version), values))
+    return normalized
+
+
+def patch_statement(table, pk, columns, patches, condition=None):
+    """Build the ``UPDATE ... FROM (VALUES %s)`` statement and execute_values template for ``patches``.
+
+    Only columns present in some patch are sent. A column every patch sets
+    is assigned directly; one set by only some patches travels with a
+    ``set_<column>`` flag so other rows keep their value (a patch may still
+    set a column to NULL). Each value is cast to the column's type in the
+    template, since VALUES can't infer the type of a NULL.
+    """
+    assignments = []
+    names = ['id', 'version']
+    template = ['%s::integer', '%s::integer']
+    for column, sql_type in columns.items():
+        present = sum(column in values for _, _, values in patches)
+        if not present:
+            continue
+        if present == len(patches):
+            assignments.append(f"{column} = v.{column}")
+        else:
+            assignments.append(f"{column} = CASE WHEN v.set_{column} THEN v.{column} ELSE t.{column} END")
+            names.append(f"set_{column}")
+            template.append('%s::boolean')
+        names.append(column)
+        template.append(f'%s::{sql_type}')
+    if not assignments:
+        raise ValueError("Nothing to update")
+    where = f" AND ({condition})" if condition else ""
+    statement = f"""
+        UPDATE {table} t SET {', '.join(assignments)}
+        FROM (VALUES %s) AS v ({', '.join(names)})
+        WHERE t.{pk} = v.id AND (v.version IS NULL OR t.version = v.version){where}
+        RETURNING t.{pk}, t.version;
+    """
+    return statement, f"({', '.join(template)})", names
+
+
+def apply_patches(db_pool, table, pk, columns, patches, condition=None):
+    """Apply sparse ``patches`` to many rows of ``table`` in one transaction and report each row's outcome.
+
+    ``columns`` maps every patchable column to its SQL type. Each patch is a
+    dict with ``pk``, an optional ``version`` and any of those columns; a
+    patch carrying a version only applies if the row still has it (the
+    migration 15 trigger bumps ``version`` on every update). ``condition``
+    is an extra SQL guard over the row (``t``) and patch (``v``).
+
+    Returns ``[{pk, 'outcome', 'version'}]`` in patch order: the new version
+    for updated rows, the current one for conflicts and rejections. Rows the
+    UPDATE skipped are classified by a second read, so a concurrent write in
+    between can turn a rejection into a conflict (or either into not_found).
+    """
+    patches = normalize_patches(patches, pk, columns)
+    if not patches:
+        return []
+    statement, template, names = patch_statement(table, pk, columns, patches, condition)
+    rows = []
+    for row_id, version, values in patches:
+        row = [row_id, version]
+        for name in names[2:]:
+            if name.startswith('set_'):
+                row.append(name[4:] in values)
+            else:
+                row.append(values.get(name))
+        rows.append(row)
+
+    conn = db_pool.getconn()
+    try:
+        cur = conn.cursor()
+        updated = dict(execute_values(cur, statement, rows, template, page_size=PATCH_PAGE_SIZE, fetch=True))
+        missed = [row_id for row_id, _, _ in patches if row_id not in updated]
+        current = {}
+        if missed:
+            # A new snapshot under READ COMMITTED: a row another transaction changed or deleted since the
+            # UPDATE is reported as it is now. It still wasn't updated, but conflict, rejected and not_found
+            # describe the later row, and its version is the current one, which is what a retry needs.
+            cur.execute(f"SELECT {pk}, version FROM {table} WHERE {pk} = ANY(%s);", (missed,))
+            current = dict(cur.fetchall())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
+
+    results = []
+    for row_id, version, _ in patches:
+        if row_id in updated:
+            outcome, current_version = UPDATED, updated[row_id]
+        elif row_id not in current:
+            outcome, current_version = NOT_FOUND, None
+        elif version is not None and version != current[row_id]:
+            outcome, current_version = CONFLICT, current[row_id]
+        else:
+            outcome, current_version = REJECTED, current[row_id]
+        results.append({pk: row_id, 'outcome': outcome, 'version': current_version})
+    return results
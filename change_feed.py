@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import select
+import threading
+import time
+import uuid
+from collections import deque
+import psycopg2
+
+
+# Channel the row triggers from migration 13 notify on, with {table, op, row} JSON as payload
+CHANGE_CHANNEL = 'row_changes'
+# stock_balances (migration 18) carries the on-hand figure every stock movement changes
+CHANGE_FEED_TABLES = ('inventory', 'sales', 'deliveries', 'stock_balances')
+# Recent events kept per worker; a client reconnecting within this window resumes without a reload
+CHANGE_FEED_BACKLOG = int(os.environ.get('CHANGE_FEED_BACKLOG', 1000))
+# Comment line sent to idle clients so proxies don't close the stream
+CHANGE_FEED_HEARTBEAT = float(os.environ.get('CHANGE_FEED_HEARTBEAT', 15))  # seconds
+
+log = logging.getLogger('inventory.changes')
+
+
+def publish_reload(cur, table):
+    # Sent by bulk writes that skip the row triggers: dashboards showing ``table`` re-fetch it instead
+    cur.execute("SELECT pg_notify(%s, %s);", (CHANGE_CHANNEL, json.dumps({'table': table, 'op': 'reload'})))
+
+
+class ChangeFeed:
+    """Row changes from one LISTEN connection per worker, fanned out to SSE clients.
+
+    Notifications land in a bounded backlog numbered ``<epoch>-<seq>``;
+    every client generator waits on one condition and reads the events it
+    hasn't seen, so publishing costs the same for one dashboard or
+    thousands. A client whose position fell out of the backlog, or whose
+    Last-Event-ID belongs to another worker or an earlier connection (the
+    epoch changes on every reconnect, since notifications may have been
+    missed), gets a ``reload`` event instead.
+    """
+
+    def __init__(self, connect_kwargs, backlog=CHANGE_FEED_BACKLOG, poll_interval=5.0):
+        self.connect_kwargs = connect_kwargs
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+        self.events = deque(maxlen=backlog)  # (seq, table, event name, payload)
+        self.seq = 0
+        self.epoch = uuid.uuid4().hex[:8]
+        self.subscribers = 0
+        self.received = 0
+        self.pid = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def ensure_running(self):
+        # Safe to call per request: starts one thread per process, including after a fork
+        if self.pid == os.getpid() and self.thread and self.thread.is_alive():
+            return
+        with self.start_lock:
+            if self.pid == os.getpid() and self.thread and self.thread.is_alive():
+                return
+            if self.pid != os.getpid():
+                # Workers forked from a preloaded app would otherwise share the epoch built at import, and a
+                # Last-Event-ID from a sibling worker would resume at an unrelated position instead of reloading
+                self.condition = threading.Condition()
+                self.epoch = uuid.uuid4().hex[:8]
+                self.seq = 0
+                self.events.clear()
+                self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        backoff = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.connect_kwargs)
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {CHANGE_CHANNEL};")
+                backoff = 1
+                while True:
+                    if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                        continue
+                    conn.poll()
+                    notifies = list(conn.notifies)
+                    conn.notifies.clear()
+                    self._publish(notifies)
+            except Exception:
+                log.exception("change feed listener failed, reconnecting in %ss", backoff)
+                if conn is not None:
+                    conn.close()
+                self._restart()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+    def _publish(self, notifies):
+        with self.condition:
+            for notify in notifies:
+                try:
+                    change = json.loads(notify.payload)
+                except ValueError:
+                    continue
+                self.seq += 1
+                self.received += 1
+                event = 'reload' if change.get('op') == 'reload' else 'change'
+                self.events.append((self.seq, change.get('table'), event, notify.payload))
+            self.condition.notify_all()
+
+    def _restart(self):
+        # Anything committed while disconnected is lost, so every client has to reload
+        with self.condition:
+            self.epoch = uuid.uuid4().hex[:8]
+            self.seq = 0
+            self.events.clear()
+            self.condition.notify_all()
+
+    def _position(self, last_event_id):
+        epoch, _, seq = (last_event_id or '').partition('-')
+        if epoch == self.epoch and seq.isdigit():
+            return int(seq)
+        return None
+
+    def subscribe(self, tables=CHANGE_FEED_TABLES, last_event_id=None, heartbeat=CHANGE_FEED_HEARTBEAT):
+        """Yield Server-Sent Events text for changes to ``tables``.
+
+        Without a usable ``last_event_id`` the stream starts at the next
+        change (after a ``reload`` if the client asked to resume and
+        couldn't).
+        """
+        tables = set(tables)
+        with self.condition:
+            epoch = self.epoch
+            position = self._position(last_event_id)
+            resume_failed = last_event_id is not None and (position is None or position > self.seq)
+            if position is None or position > self.seq:
+                position = self.seq
+            self.subscribers += 1
+        try:
+            yield "retry: 3000\n\n"
+            if resume_failed:
+                yield self._reload(epoch, position)
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.seq != position or self.epoch != epoch, heartbeat)
+                    if self.epoch != epoch:
+                        epoch, position = self.epoch, self.seq
+                        pending = None
+                    elif self.events and self.events[0][0] > position + 1:
+                        # Fell behind the backlog
+                        position = self.seq
+                        pending = None
+                    else:
+                        pending = [event for event in self.events if event[0] > position]
+                        position = self.seq
+                if pending is None:
+                    yield self._reload(epoch, position)
+                elif not pending:
+                    yield ": keep-alive\n\n"
+                else:
+                    chunk = ''.join(f"id: {epoch}-{seq}\nevent: {name}\ndata: {payload}\n\n"
+                                    for seq, table, name, payload in pending if table in tables)
+                    if chunk:
+                        yield chunk
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+    def _reload(self, epoch, position):
+        return f"id: {epoch}-{position}\nevent: reload\ndata: {json.dumps({'op': 'reload'})}\n\n"
+
+    def render_prometheus(self):
+        return '\n'.join([
+            '# HELP inventory_change_feed_subscribers Open change feed (SSE) streams in this worker.',
+            '# TYPE inventory_change_feed_subscribers gauge',
+            f'inventory_change_feed_subscribers {self.subscribers}',
+            '# HELP inventory_change_feed_events_total Row change notifications received by this worker.',
+            '# TYPE inventory_change_feed_events_total counter',
+            f'inventory_change_feed_events_total {self.received}',
+        ]) + '\n'
@@ -1,18 +1,314 @@
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import weakref
 import psycopg2
 from psycopg2 import pool
+from db_metrics import InstrumentedCursor, db_metrics
+
+
+def db_config_from_env():
+    # Connection settings for the shared pool; every process reads the same environment
+    return {
+        'host': os.environ.get('DB_HOST', 'localhost'),
+        'database': os.environ.get('DB_NAME', 'inventory'),
+        'user': os.environ.get('DB_USER', 'your_database_user'),
+        'password': os.environ.get('DB_PASSWORD', 'your_database_password'),
+        'port': int(os.environ.get('DB_PORT', 5432)),
+    }
+
+
+def replica_config_from_env():
+    # Settings for a streaming replica that serves reads, or None when DB_REPLICA_HOST is unset
+    host = os.environ.get('DB_REPLICA_HOST')
+    if not host:
+        return None
+    config = db_config_from_env()
+    config['host'] = host
+    config['port'] = int(os.environ.get('DB_REPLICA_PORT', config['port']))
+    return config
+
+
+MIN_CONNS = int(os.environ.get('DB_MIN_CONNS', 1))
+MAX_CONNS = int(os.environ.get('DB_MAX_CONNS', 10))
+# Reads go back to the primary while the replica is further behind than this
+REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))  # seconds
+REPLICA_LAG_CHECK_INTERVAL = 1.0  # seconds
+# How long an unreachable replica is skipped before trying it again
+REPLICA_RETRY_INTERVAL = 10.0  # seconds
+# After a write, the same session reads from the primary for this long
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('DB_READ_YOUR_WRITES_SECONDS', 5))
+# Longest a checkout queues for a free connection before the request is shed
+CHECKOUT_TIMEOUT = float(os.environ.get('DB_CHECKOUT_TIMEOUT', 2))  # seconds
+
+# Checkout priorities, lowest served first: writes ahead of page reads ahead of reports
+PRIORITY_WRITE = 0
+PRIORITY_READ = 1
+PRIORITY_REPORT = 2
+
+log = logging.getLogger('inventory.db')
+
+# Wall-clock time until which the current session (request, thread) must read from the primary
+_primary_reads_until = contextvars.ContextVar('primary_reads_until', default=0.0)
+# Queue priority and statement_timeout (ms, None for the server default) of the current request
+_checkout_priority = contextvars.ContextVar('checkout_priority', default=PRIORITY_READ)
+_statement_timeout = contextvars.ContextVar('statement_timeout', default=None)
+# Checkouts served by the replica in the current session; query_cache won't store what they read
+_replica_reads = contextvars.ContextVar('replica_reads', default=0)
+
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END;
+"""
+
+
+def mark_write():
+    # Called after a write commits, so this session's next reads see it
+    _primary_reads_until.set(time.time() + READ_YOUR_WRITES_SECONDS)
+
+
+def read_your_writes_until():
+    return _primary_reads_until.get()
+
+
+def reading_own_writes():
+    # True while this session's reads must come from the primary (see mark_write)
+    return time.time() < _primary_reads_until.get()
+
+
+def replica_reads():
+    return _replica_reads.get()
+
+
+def set_read_your_writes_until(until):
+    # Restore stickiness carried across requests (app.py keeps it in a cookie)
+    _primary_reads_until.set(until)
+
+
+def set_request_limits(priority, statement_timeout=None):
+    # Set per request by app.py from its route table; background threads keep the defaults
+    _checkout_priority.set(priority)
+    _statement_timeout.set(statement_timeout)
+
+
+class PoolOverloaded(pool.PoolError):
+    pass
+
+
+class CheckoutQueue:
+    """Admission to ``size`` connections, granted by priority and then arrival order.
+
+    A released connection goes straight to the best waiter rather than to
+    whichever thread wakes first, so nobody is overtaken within a priority.
+    Waiters that time out are skipped when their turn comes.
+    """
+
+    def __init__(self, size):
+        self.available = size
+        self.lock = threading.Lock()
+        self.waiters = []  # heap of (priority, arrival, waiter)
+        self.arrivals = itertools.count()
+
+    def acquire(self, priority, timeout):
+        with self.lock:
+            if self.available > 0 and not self.waiters:
+                self.available -= 1
+                return True
+            if timeout <= 0:
+                return False
+            waiter = {'event': threading.Event(), 'granted': False, 'abandoned': False}
+            heapq.heappush(self.waiters, (priority, next(self.arrivals), waiter))
+        if waiter['event'].wait(timeout):
+            return True
+        with self.lock:
+            # The grant may have raced the timeout
+            waiter['abandoned'] = not waiter['granted']
+            return waiter['granted']
+
+    def release(self):
+        with self.lock:
+            while self.waiters:
+                _, _, waiter = heapq.heappop(self.waiters)
+                if not waiter['abandoned']:
+                    waiter['granted'] = True
+                    waiter['event'].set()
+                    return
+            self.available += 1
+
 
 class DatabaseConnectionPool:
-    def __init__(self):
-        self.pool = pool.ThreadedConnectionPool(
-            1, 10,
-            host="localhost",
-            database="your_database",
-            user="your_username",
-            password="your_password"
-        )
-
-    def getconn(self):
-        return self.pool.getconn()
-
-    def putconn(self, conn):
-        self.pool.putconn(conn)
+    """Lazily created, fork-aware wrapper around ``ThreadedConnectionPool``.
+
+    No connection is opened until the first ``getconn()``, so importing a
+    module never needs the database. If the process forks, the child builds
+    its own pool instead of reusing the parent's sockets.
+
+    With a replica configured, ``getconn(readonly=True)`` hands out a replica
+    connection unless this session wrote in the last
+    ``READ_YOUR_WRITES_SECONDS``, the replica lags more than ``max_lag``
+    seconds, or it can't be reached; in each case the read goes to the
+    primary instead.
+
+    Checkouts queue in a ``CheckoutQueue`` for at most ``CHECKOUT_TIMEOUT``
+    seconds, then raise ``PoolOverloaded``; each connection is handed out
+    with the current request's ``statement_timeout``.
+    """
+
+    def __init__(self, minconn=None, maxconn=None, replica_kwargs=None, max_lag=REPLICA_MAX_LAG, **connect_kwargs):
+        self.minconn = MIN_CONNS if minconn is None else minconn
+        self.maxconn = MAX_CONNS if maxconn is None else maxconn
+        self.connect_kwargs = connect_kwargs or db_config_from_env()
+        # A pool built from explicit settings only gets a replica when one is passed too
+        self.replica_kwargs = replica_kwargs if connect_kwargs else replica_kwargs or replica_config_from_env()
+        self.max_lag = max_lag
+        self.pools = {}  # 'primary' / 'replica' -> ThreadedConnectionPool
+        self.queues = {}  # 'primary' / 'replica' -> CheckoutQueue
+        self.pid = None
+        self.lock = threading.Lock()
+        # Pools inherited across a fork are kept referenced but never closed or
+        # garbage collected: closing them would terminate the parent's sessions
+        self.inherited_pools = []
+        # (checkout timestamp, pool, queue) keyed by connection, for hold-time metrics and putconn routing
+        self.checked_out = {}
+        # statement_timeout each connection currently has, so it is only SET when a request needs another
+        self.statement_timeouts = weakref.WeakKeyDictionary()
+        self.replica_lag = 0.0
+        self.lag_checked_at = 0.0
+        self.replica_down_until = 0.0
+
+    def get_pool(self, role='primary'):
+        pid = os.getpid()
+        if self.pid != pid or role not in self.pools:
+            with self.lock:
+                if self.pid != pid:
+                    self.inherited_pools.extend(self.pools.values())
+                    self.pools = {}
+                    self.queues = {}
+                    self.checked_out = {}
+                    self.statement_timeouts = weakref.WeakKeyDictionary()
+                    self.pid = pid
+                if role not in self.pools:
+                    kwargs = self.connect_kwargs if role == 'primary' else self.replica_kwargs
+                    self.queues[role] = CheckoutQueue(self.maxconn)
+                    self.pools[role] = pool.ThreadedConnectionPool(self.minconn, self.maxconn,
+                                                                   cursor_factory=InstrumentedCursor, **kwargs)
+        return self.pools[role]
+
+    def use_replica(self):
+        return (self.replica_kwargs is not None
+                and time.time() >= _primary_reads_until.get()
+                and time.monotonic() >= self.replica_down_until)
+
+    def replica_fresh(self, conn):
+        # Re-measure replay lag at most once per REPLICA_LAG_CHECK_INTERVAL, on the connection just checked out
+        now = time.monotonic()
+        if now - self.lag_checked_at >= REPLICA_LAG_CHECK_INTERVAL:
+            cur = conn.cursor()
+            cur.execute(REPLICA_LAG_SQL)
+            self.replica_lag = float(cur.fetchone()[0])
+            conn.rollback()
+            self.lag_checked_at = now
+            db_metrics.record_replica_lag(self.replica_lag)
+        return self.replica_lag <= self.max_lag
+
+    def getconn(self, key=None, readonly=False):
+        if readonly and self.use_replica():
+            conn = None
+            try:
+                # Don't queue for a busy replica; the primary can serve the read
+                conn = self._checkout('replica', key, timeout=0)
+                if self.replica_fresh(conn):
+                    db_metrics.record_read_route('replica')
+                    _replica_reads.set(_replica_reads.get() + 1)
+                    return conn
+                db_metrics.record_read_route('primary_lagging')
+            except psycopg2.OperationalError:
+                log.warning("replica unreachable, reading from the primary for %ss", REPLICA_RETRY_INTERVAL)
+                self.replica_down_until = time.monotonic() + REPLICA_RETRY_INTERVAL
+                db_metrics.record_read_route('primary_unreachable')
+            except pool.PoolError:
+                db_metrics.record_read_route('primary_exhausted')
+            if conn is not None:
+                self.putconn(conn, key, close=conn.closed != 0)
+        elif readonly:
+            db_metrics.record_read_route('primary')
+        try:
+            return self._checkout('primary', key)
+        except PoolOverloaded:
+            db_metrics.record_shed('pool_timeout')
+            raise
+
+    def _checkout(self, role, key, timeout=None):
+        start = time.perf_counter()
+        connections = self.get_pool(role)
+        queue = self.queues[role]
+        timeout = CHECKOUT_TIMEOUT if timeout is None else timeout
+        if not queue.acquire(_checkout_priority.get(), timeout):
+            db_metrics.record_checkout_error()
+            raise PoolOverloaded(f"No database connection free within {timeout:g}s")
+        try:
+            conn = connections.getconn(key)
+        except Exception:
+            queue.release()
+            db_metrics.record_checkout_error()
+            raise
+        try:
+            self.apply_statement_timeout(conn)
+        except Exception:
+            connections.putconn(conn, key, close=True)
+            queue.release()
+            db_metrics.record_checkout_error()
+            raise
+        now = time.perf_counter()
+        db_metrics.record_checkout(now - start)
+        self.checked_out[id(conn)] = (now, connections, queue)
+        return conn
+
+    def apply_statement_timeout(self, conn):
+        wanted = _statement_timeout.get()
+        if self.statement_timeouts.get(conn) == wanted:
+            return
+        cur = conn.cursor()
+        if wanted is None:
+            cur.execute("RESET statement_timeout;")
+        else:
+            cur.execute("SET statement_timeout = %s;", (int(wanted),))
+        # Committed on its own, so a rollback by the caller doesn't undo it
+        conn.commit()
+        self.statement_timeouts[conn] = wanted
+
+    def putconn(self, conn, key=None, close=False):
+        started, connections, queue = self.checked_out.pop(id(conn), (None, None, None))
+        (connections or self.get_pool()).putconn(conn, key, close)
+        if queue is not None:
+            queue.release()
+        if started is not None:
+            db_metrics.record_release(time.perf_counter() - started)
+
+    def closeall(self):
+        # Only close pools this process created; there is nothing to do if it never connected
+        with self.lock:
+            if self.pid == os.getpid():
+                for connections in self.pools.values():
+                    if not connections.closed:
+                        connections.closeall()
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    # The single process-wide pool every table class is wired through
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DatabaseConnectionPool()
+    return _db_pool
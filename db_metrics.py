@@ -0,0 +1,228 @@
+import bisect
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from psycopg2.errors import QueryCanceled
+from psycopg2.extensions import cursor as base_cursor
+from profiling import record_span
+
+
+# Latency buckets in seconds, shared by every histogram
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 500))
+MAX_FINGERPRINTS = 500
+
+slow_query_log = logging.getLogger('inventory.slow_query')
+
+# Why the current request was refused for overload ('pool_timeout' or 'statement_timeout'), if it was
+_shed_reason = contextvars.ContextVar('shed_reason', default=None)
+
+
+def shed_reason():
+    return _shed_reason.get()
+
+
+def reset_shed_reason():
+    _shed_reason.set(None)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name, labels=''):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}')
+        plain = '{' + labels.rstrip(',') + '}' if labels else ''
+        lines.append(f'{name}_sum{plain} {self.total}')
+        lines.append(f'{name}_count{plain} {self.count}')
+        return lines
+
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%\(\w+\)s|%s'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*'), '(...)'),
+    (re.compile(r'\bstream_\w+_[0-9a-f]{32}\b'), 'stream_?'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def fingerprint(query):
+    # Normalize a statement so every execution of the same query shape shares one series
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = str(query)
+    for pattern, replacement in _LITERALS:
+        query = pattern.sub(replacement, query)
+    return query.strip().rstrip(';')[:200]
+
+
+class DatabaseMetrics:
+    """Process-wide counters for pool checkouts and statements."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkout_wait = Histogram()
+        self.hold_time = Histogram()
+        self.checkout_errors = 0
+        self.in_use = 0
+        self.statements = {}
+        self.rows = {}
+        self.read_routes = {}
+        self.replica_lag = None
+        self.shed = {}
+
+    def record_checkout(self, seconds):
+        record_span('checkout', seconds)
+        with self.lock:
+            self.checkout_wait.observe(seconds)
+            self.in_use += 1
+
+    def record_checkout_error(self):
+        with self.lock:
+            self.checkout_errors += 1
+
+    def record_release(self, seconds):
+        with self.lock:
+            self.hold_time.observe(seconds)
+            self.in_use -= 1
+
+    def record_read_route(self, route):
+        # Where a read-only checkout went: replica, primary, or primary because the replica was unusable
+        with self.lock:
+            self.read_routes[route] = self.read_routes.get(route, 0) + 1
+
+    def record_shed(self, reason):
+        # A checkout or statement gave up under load; app.py answers the request with a 503
+        _shed_reason.set(reason)
+        with self.lock:
+            self.shed[reason] = self.shed.get(reason, 0) + 1
+
+    def record_replica_lag(self, seconds):
+        with self.lock:
+            self.replica_lag = seconds
+
+    def record_statement(self, query, seconds, rows):
+        record_span('sql', seconds)
+        key = fingerprint(query)
+        with self.lock:
+            histogram = self.statements.get(key)
+            if histogram is None:
+                if len(self.statements) >= MAX_FINGERPRINTS:
+                    key = 'other'
+                    histogram = self.statements.setdefault(key, Histogram())
+                else:
+                    histogram = self.statements[key] = Histogram()
+            histogram.observe(seconds)
+            if rows is not None and rows >= 0:
+                self.rows.setdefault(key, Histogram(ROW_BUCKETS)).observe(rows)
+        if seconds * 1000 >= SLOW_QUERY_MS:
+            slow_query_log.warning("slow query (%.1f ms, %s rows): %s", seconds * 1000, rows, key)
+
+    def render_prometheus(self):
+        with self.lock:
+            lines = [
+                '# HELP inventory_db_pool_checkout_wait_seconds Time spent waiting for a pooled connection.',
+                '# TYPE inventory_db_pool_checkout_wait_seconds histogram',
+            ]
+            lines += self.checkout_wait.render('inventory_db_pool_checkout_wait_seconds')
+            lines += [
+                '# HELP inventory_db_pool_hold_seconds Time a connection was held before being returned.',
+                '# TYPE inventory_db_pool_hold_seconds histogram',
+            ]
+            lines += self.hold_time.render('inventory_db_pool_hold_seconds')
+            lines += [
+                '# HELP inventory_db_pool_in_use Connections currently checked out.',
+                '# TYPE inventory_db_pool_in_use gauge',
+                f'inventory_db_pool_in_use {self.in_use}',
+                '# HELP inventory_db_pool_checkout_errors_total Checkouts that failed.',
+                '# TYPE inventory_db_pool_checkout_errors_total counter',
+                f'inventory_db_pool_checkout_errors_total {self.checkout_errors}',
+                '# HELP inventory_db_read_routes_total Read-only checkouts by where they were served.',
+                '# TYPE inventory_db_read_routes_total counter',
+            ]
+            lines += [f'inventory_db_read_routes_total{{route="{route}"}} {count}'
+                      for route, count in sorted(self.read_routes.items())]
+            lines += [
+                '# HELP inventory_db_shed_total Requests refused because of a checkout or statement timeout.',
+                '# TYPE inventory_db_shed_total counter',
+            ]
+            lines += [f'inventory_db_shed_total{{reason="{reason}"}} {count}'
+                      for reason, count in sorted(self.shed.items())]
+            if self.replica_lag is not None:
+                lines += [
+                    '# HELP inventory_db_replica_lag_seconds Replay lag last measured on the replica.',
+                    '# TYPE inventory_db_replica_lag_seconds gauge',
+                    f'inventory_db_replica_lag_seconds {self.replica_lag}',
+                ]
+            lines += [
+                '# HELP inventory_db_statement_seconds Statement latency by normalized SQL.',
+                '# TYPE inventory_db_statement_seconds histogram',
+            ]
+            for key, histogram in sorted(self.statements.items()):
+                lines += histogram.render('inventory_db_statement_seconds', f'query="{escape_label(key)}",')
+            lines += [
+                '# HELP inventory_db_statement_rows Rows returned or affected by normalized SQL.',
+                '# TYPE inventory_db_statement_rows histogram',
+            ]
+            for key, histogram in sorted(self.rows.items()):
+                lines += histogram.render('inventory_db_statement_rows', f'query="{escape_label(key)}",')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+db_metrics = DatabaseMetrics()
+
+
+class InstrumentedCursor(base_cursor):
+    # Cursor class installed on every pooled connection so each statement is timed
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        except QueryCanceled:
+            db_metrics.record_shed('statement_timeout')
+            raise
+        finally:
+            rows = self.rowcount if self.name is None else None
+            db_metrics.record_statement(query, time.perf_counter() - start, rows)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            db_metrics.record_statement(query, time.perf_counter() - start, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        except QueryCanceled:
+            db_metrics.record_shed('statement_timeout')
+            raise
+        finally:
+            db_metrics.record_statement(sql, time.perf_counter() - start, self.rowcount)
@@ -1,8 +1,26 @@
 import psycopg2
 from psycopg2 import pool
+from bulk_update import apply_patches
+from pagination import DEFAULT_PAGE_SIZE, STREAM_CHUNK_SIZE, fetch_many, fetch_page, stream_rows
+from records import record_cursor
+from partitions import partition_table
+from query_cache import cached, invalidates
 
 
 class Deliveries:
+    COLUMNS = ('delivery_id', 'delivery_date', 'vendor_name', 'item_id', 'item_name', 'quantity', 'unit_price',
+               'status', 'version')
+    SORTABLE_COLUMNS = ('delivery_date', 'vendor_name', 'item_name', 'quantity', 'unit_price')
+    FILTERABLE_COLUMNS = ('delivery_date', 'vendor_name', 'item_name')
+    RECORD = 'DeliveryRecord'
+    ALIASES = (('id', 'delivery_id'), ('date', 'delivery_date'))
+    # Columns bulk_update may patch, with their SQL types; status only changes through transition_status
+    PATCHABLE_COLUMNS = {'delivery_date': 'date', 'vendor_name': 'varchar', 'item_name': 'varchar',
+                         'quantity': 'integer', 'unit_price': 'numeric'}
+    STATUSES = ('pending', 'in_transit', 'delivered')
+    # Allowed status changes; stock only counts a delivery once it is delivered (see migration 15)
+    STATUS_TRANSITIONS = (('pending', 'in_transit'), ('pending', 'delivered'), ('in_transit', 'delivered'))
+
     def __init__(self, db_pool):
         self.db_pool = db_pool
 
@@ -11,55 +29,67 @@ class Deliveries:
         pass
 
     def create_delivery_table(self):
+        # Monthly partitions on delivery_date, same layout as sales (see partitions.py)
         conn = self.db_pool.getconn()
         try:
-            cur = conn.cursor()
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS deliveries (
-                    delivery_id SERIAL PRIMARY KEY,
-                    delivery_date DATE NOT NULL,
-                    vendor_name VARCHAR(255) NOT NULL,
-                    item_name VARCHAR(255) NOT NULL,
-                    quantity INTEGER NOT NULL,
-                    unit_price FLOAT NOT NULL
-                );
-            """)
-            conn.commit()
+            partition_table(conn, 'deliveries')
         finally:
             self.db_pool.putconn(conn)
 
-    def insert_delivery(self, delivery_date, vendor_name, item_name, quantity, unit_price):
+    @invalidates('deliveries', 'stock_balances')
+    def insert_delivery(self, delivery_date, vendor_name, item_name, quantity, unit_price, status='delivered'):
+        if status not in self.STATUSES:
+            raise ValueError(f"Unknown delivery status {status}")
         conn = self.db_pool.getconn()
         try:
             cur = conn.cursor()
             cur.execute("""
-                INSERT INTO deliveries (delivery_date, vendor_name, item_name, quantity, unit_price)
-                VALUES (%s, %s, %s, %s, %s);
-            """, (delivery_date, vendor_name, item_name, quantity, unit_price))
+                INSERT INTO deliveries (delivery_date, vendor_name, item_name, quantity, unit_price, status)
+                VALUES (%s, %s, %s, %s, %s, %s);
+            """, (delivery_date, vendor_name, item_name, quantity, unit_price, status))
             conn.commit()
         finally:
             self.db_pool.putconn(conn)
 
+    @cached('deliveries')
     def get_all_deliveries(self):
-        conn = self.db_pool.getconn()
+        conn = self.db_pool.getconn(readonly=True)
         try:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM deliveries;")
+            cur = record_cursor(conn, self.RECORD, self.COLUMNS, self.ALIASES)
+            cur.execute(f"SELECT {', '.join(self.COLUMNS)} FROM deliveries;")
             rows = cur.fetchall()
             return rows
         finally:
             self.db_pool.putconn(conn)
 
+    @cached('deliveries')
+    def get_many(self, ids, columns=None):
+        # {delivery_id: row} for a batch of ids in one round trip
+        return fetch_many(self.db_pool, 'deliveries', 'delivery_id',
+                          columns or self.COLUMNS, ids, self.RECORD, self.ALIASES)
+
+    @cached('deliveries')
+    def get_all_deliveries_page(self, cursor=None, limit=DEFAULT_PAGE_SIZE, sort=None, descending=False, filters=None,
+                                columns=None):
+        return fetch_page(self.db_pool, 'deliveries', 'delivery_id', columns or self.COLUMNS, filters, sort, descending,
+                          cursor, limit, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS, self.RECORD, self.ALIASES)
+
+    def stream_deliveries(self, sort=None, descending=False, filters=None, chunk_size=STREAM_CHUNK_SIZE, columns=None):
+        return stream_rows(self.db_pool, 'deliveries', 'delivery_id', columns or self.COLUMNS, filters, sort, descending,
+                           chunk_size, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS, self.RECORD, self.ALIASES)
+
+    @cached('deliveries')
     def get_delivery_by_id(self, delivery_id):
-        conn = self.db_pool.getconn()
+        conn = self.db_pool.getconn(readonly=True)
         try:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM deliveries WHERE delivery_id = %s;", (delivery_id,))
+            cur = record_cursor(conn, self.RECORD, self.COLUMNS, self.ALIASES)
+            cur.execute(f"SELECT {', '.join(self.COLUMNS)} FROM deliveries WHERE delivery_id = %s;", (delivery_id,))
             row = cur.fetchone()
             return row
         finally:
             self.db_pool.putconn(conn)
 
+    @invalidates('deliveries', 'stock_balances')
     def update_delivery(self, delivery_id, delivery_date, vendor_name, item_name, quantity, unit_price):
         conn = self.db_pool.getconn()
         try:
@@ -73,6 +103,30 @@ class Deliveries:
         finally:
             self.db_pool.putconn(conn)
 
+    @invalidates('deliveries', 'stock_balances')
+    def bulk_update(self, patches):
+        """Apply sparse patches (``{delivery_id, version?, column: value...}``) to many deliveries at once.
+
+        Returns one ``{delivery_id, outcome, version}`` per patch (see bulk_update.apply_patches).
+        """
+        return apply_patches(self.db_pool, 'deliveries', 'delivery_id', self.PATCHABLE_COLUMNS, patches)
+
+    @invalidates('deliveries', 'stock_balances')
+    def transition_status(self, changes):
+        """Move many deliveries to a new status (``{delivery_id, status, version?}``) in one statement.
+
+        A change outside STATUS_TRANSITIONS is reported as ``rejected``
+        rather than failing the batch; marking a delivery ``delivered`` adds
+        its quantity to stock in the same transaction.
+        """
+        for change in changes:
+            if not isinstance(change, dict) or change.get('status') not in self.STATUSES:
+                raise ValueError(f"Every change needs a status out of {', '.join(self.STATUSES)}")
+        allowed = ', '.join(f"('{old}', '{new}')" for old, new in self.STATUS_TRANSITIONS)
+        return apply_patches(self.db_pool, 'deliveries', 'delivery_id', {'status': 'varchar'}, changes,
+                             condition=f"(t.status, v.status) IN ({allowed})")
+
+    @invalidates('deliveries', 'stock_balances')
     def delete_delivery(self, delivery_id):
         conn = self.db_pool.getconn()
         try:
@@ -83,29 +137,9 @@ class Deliveries:
             self.db_pool.putconn(conn)
 
 
-# Create a database connection pool
-db_host = 'localhost'
-db_name = 'inventory'
-db_user = 'your_database_user'
-db_password = 'your_database_password'
-db_port = 5432
-min_conns = 1
-max_conns = 10
-
-db_pool = pool.ThreadedConnectionPool(
-    min_conns, max_conns,
-    host=db_host,
-    database=db_name,
-    user=db_user,
-    password=db_password,
-    port=db_port
-)
+# Use the shared, lazily created database connection pool
+from database_utilities import get_db_pool
 
 
 # Initialize Deliveries class with database connection pool
-deliveries = Deliveries(db_pool)
-
-
-# When shutting down the application, close all database connections
-import atexit
-atexit.register(db_pool.closeall)
+deliveries = Deliveries(get_db_pool())
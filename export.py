@@ -0,0 +1,209 @@
+import argparse
+import gzip
+import os
+import queue
+import sys
+import threading
+import zlib
+from datetime import date
+from database_utilities import get_db_pool
+from deliveries import Deliveries
+from inventory_items_table import InventoryItems
+from sales_items_table import SalesItems
+
+
+# Exportable tables: the date column range filters apply to and the columns offered
+EXPORT_TARGETS = {
+    'inventory': {'date': None, 'columns': InventoryItems.COLUMNS},
+    'sales': {'date': 'sale_date', 'columns': SalesItems.COLUMNS},
+    'deliveries': {'date': 'delivery_date', 'columns': Deliveries.COLUMNS},
+}
+
+# COPY emits one message per row; they are gathered into chunks of this size before being sent on
+EXPORT_CHUNK_SIZE = 256 * 1024
+# Chunks buffered between the COPY and a slow client, so memory stays bounded at about 2 MB per export
+EXPORT_QUEUE_CHUNKS = 8
+# Level 1 compresses CSV nearly as well as 6 at several times the speed, keeping gzip off the critical path
+EXPORT_GZIP_LEVEL = int(os.environ.get('EXPORT_GZIP_LEVEL', 1))
+
+
+def export_query(table, columns=None, start=None, end=None):
+    """Build the ``COPY ... TO STDOUT`` statement and parameters for an export.
+
+    ``columns`` limits and orders the output columns; ``start`` (inclusive)
+    and ``end`` (exclusive) are ISO dates on the table's date column, which
+    also prunes partitions of sales and deliveries.
+    """
+    if table not in EXPORT_TARGETS:
+        raise ValueError(f"Export is not supported for {table}")
+    target = EXPORT_TARGETS[table]
+    columns = list(columns or target['columns'])
+    unknown = [column for column in columns if column not in target['columns']]
+    if unknown:
+        raise ValueError(f"Unknown column(s) for {table}: {', '.join(unknown)}")
+
+    conditions = []
+    params = []
+    for value, operator in ((start, '>='), (end, '<')):
+        if not value:
+            continue
+        if target['date'] is None:
+            raise ValueError(f"{table} has no date to filter on")
+        conditions.append(f"{target['date']} {operator} %s")
+        params.append(date.fromisoformat(value) if isinstance(value, str) else value)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    # No ORDER BY: rows leave in scan order, so the export runs at sequential-scan speed without a sort
+    query = f"SELECT {', '.join(columns)} FROM {table}{where}"
+    return f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", params
+
+
+def copy_export(db_pool, table, out, columns=None, start=None, end=None):
+    # Write the CSV export to a binary file object; the server streams it, nothing is held in memory
+    statement, params = export_query(table, columns, start, end)
+    conn = db_pool.getconn(readonly=True)
+    broken = True
+    try:
+        cur = conn.cursor()
+        cur.copy_expert(cur.mogrify(statement, params).decode(), out, EXPORT_CHUNK_SIZE)
+        conn.commit()
+        broken = False
+    finally:
+        # An interrupted COPY leaves the connection unusable
+        db_pool.putconn(conn, close=broken)
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class ChunkWriter:
+    # File object for copy_expert that gathers rows into chunks and hands them to a bounded queue
+    def __init__(self, chunks, cancelled, chunk_size=EXPORT_CHUNK_SIZE):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def put(self, item):
+        # Blocks while the client is behind; gives up once the reader has gone away
+        while True:
+            if self.cancelled.is_set():
+                raise ExportCancelled()
+            try:
+                self.chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+
+def stream_export(db_pool, table, columns=None, start=None, end=None, compress=False):
+    """Yield the CSV export as byte chunks for a streaming HTTP response.
+
+    The COPY runs in a background thread into a small bounded queue, so a
+    slow client slows the COPY down instead of growing memory. Closing the
+    generator (e.g. the client disconnects) aborts the COPY. Arguments are
+    validated and the connection is checked out before returning, in the
+    caller's thread, so bad input or an overloaded pool raises immediately
+    rather than after the response has started.
+    """
+    statement, params = export_query(table, columns, start, end)
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    done = object()
+    conn = db_pool.getconn(readonly=True)
+
+    def produce():
+        writer = ChunkWriter(chunks, cancelled)
+        broken = False
+        try:
+            cur = conn.cursor()
+            cur.copy_expert(cur.mogrify(statement, params).decode(), writer, EXPORT_CHUNK_SIZE)
+            conn.commit()
+            writer.flush()
+            writer.put(done)
+        except ExportCancelled:
+            broken = True
+        except Exception as e:
+            broken = True
+            try:
+                writer.put(e)
+            except ExportCancelled:
+                pass
+        finally:
+            db_pool.putconn(conn, close=broken)
+
+    def generate():
+        compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None  # 31: gzip
+        try:
+            threading.Thread(target=produce, name=f'export-{table}', daemon=True).start()
+            yield b''
+            while True:
+                chunk = chunks.get()
+                if chunk is done:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                    if not chunk:
+                        continue
+                yield chunk
+            if compressor:
+                yield compressor.flush()
+        finally:
+            cancelled.set()
+
+    body = generate()
+    try:
+        # Run up to the first yield: the producer now owns the connection, and closing a body that is never
+        # read still cancels the COPY and returns it
+        next(body)
+    except Exception:
+        db_pool.putconn(conn, close=True)
+        raise
+    return body
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a table as CSV using COPY")
+    parser.add_argument('table', choices=sorted(EXPORT_TARGETS))
+    parser.add_argument('--columns', help="comma-separated columns to export, in order")
+    parser.add_argument('--start', help="first date to include (YYYY-MM-DD)")
+    parser.add_argument('--end', help="first date to exclude (YYYY-MM-DD)")
+    parser.add_argument('--gzip', action='store_true', help="gzip the output")
+    parser.add_argument('-o', '--output', help="file to write (default: standard output)")
+    args = parser.parse_args(argv)
+
+    columns = args.columns.split(',') if args.columns else None
+    try:
+        export_query(args.table, columns, args.start, args.end)
+    except ValueError as e:
+        parser.error(str(e))
+
+    db_pool = get_db_pool()
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        if args.gzip:
+            with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=EXPORT_GZIP_LEVEL) as compressed:
+                copy_export(db_pool, args.table, compressed, columns, args.start, args.end)
+        else:
+            copy_export(db_pool, args.table, out, columns, args.start, args.end)
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,246 @@
+import argparse
+import datetime
+import io
+import os
+import time
+from statistics import NormalDist
+import numpy as np
+from database_utilities import get_db_pool
+from query_cache import cached, invalidates
+from reports import fetch_columns
+
+
+HISTORY_WEEKS = int(os.environ.get('FORECAST_HISTORY_WEEKS', 156))
+LEVEL_WEEKS = int(os.environ.get('FORECAST_LEVEL_WEEKS', 13))  # recent weeks the demand level is taken from
+HORIZON_WEEKS = int(os.environ.get('FORECAST_HORIZON_WEEKS', 4))
+SERVICE_LEVEL = float(os.environ.get('FORECAST_SERVICE_LEVEL', 0.95))
+DEFAULT_LEAD_TIME_DAYS = float(os.environ.get('FORECAST_LEAD_TIME_DAYS', 7))
+REVIEW_DAYS = float(os.environ.get('FORECAST_REVIEW_DAYS', 7))  # stock an order should cover beyond the lead time
+SEASON_WEEKS = 52
+# Seasonal indexes from a couple of years are noisy, so each is pulled toward 1
+# by a weight of years / (years + SEASONAL_SHRINKAGE)
+SEASONAL_SHRINKAGE = 1.0
+MIN_SEASONAL_INDEX = 0.2
+
+FORECAST_COLUMNS = ('item_id', 'weekly_demand', 'demand_std', 'horizon_demand', 'lead_time_days',
+                    'safety_stock', 'reorder_point', 'available', 'order_quantity')
+
+WEEKLY_SALES_SQL = """
+    SELECT item_id, (sale_date - %(start)s::date) / 7, sum(quantity)
+    FROM sales
+    WHERE item_id IS NOT NULL AND sale_date >= %(start)s::date AND sale_date < %(end)s::date
+    GROUP BY 1, 2
+"""
+
+# deliveries record no order date, so the spacing of successive deliveries of an
+# item from a vendor stands in for that vendor's replenishment lead time
+LEAD_TIMES_SQL = """
+    SELECT vendor_name, avg(gap)::float8, COALESCE(stddev_samp(gap), 0)::float8
+    FROM (
+        SELECT vendor_name,
+               delivery_date - lag(delivery_date) OVER (PARTITION BY vendor_name, item_name
+                                                        ORDER BY delivery_date) AS gap
+        FROM deliveries
+        WHERE delivery_date >= %(start)s::date
+    ) gaps
+    WHERE gap > 0
+    GROUP BY vendor_name;
+"""
+
+
+def copy_numbers(cur, query, params, width):
+    """Run ``query`` through COPY TO STDOUT and parse the numeric result in C.
+
+    Millions of (item, week, units) rows never become Python tuples; the
+    tab-separated text is parsed straight into a float array of shape
+    ``(rows, width)``.
+    """
+    buffer = io.StringIO()
+    cur.copy_expert(f"COPY ({cur.mogrify(query, params).decode()}) TO STDOUT", buffer)
+    if not buffer.tell():
+        return np.empty((0, width))
+    buffer.seek(0)
+    return np.loadtxt(buffer, dtype=np.float64, delimiter='\t', ndmin=2)
+
+
+def seasonal_indexes(weekly):
+    # (items, 52) week-of-year demand relative to each item's mean, aligned so index 0 is next week
+    items, weeks = weekly.shape
+    years = weeks // SEASON_WEEKS
+    if years < 2:
+        return np.ones((items, SEASON_WEEKS))
+    profile = weekly[:, -years * SEASON_WEEKS:].reshape(items, years, SEASON_WEEKS).mean(axis=1)
+    mean = profile.mean(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        raw = np.where(mean > 0, profile / mean, 1.0)
+    return 1 + (raw - 1) * (years / (years + SEASONAL_SHRINKAGE))
+
+
+def forecast(weekly, lead_days, lead_std, available, service_level=SERVICE_LEVEL):
+    """Demand, safety stock and reorder points for every item at once.
+
+    ``weekly`` is an (items, weeks) matrix of units sold, oldest week first;
+    the other arguments are per-item vectors. Demand is the deseasonalized
+    mean of the last ``LEVEL_WEEKS`` weeks, and safety stock covers both
+    demand and lead-time variability at ``service_level``.
+    """
+    items, weeks = weekly.shape
+    season = seasonal_indexes(weekly)
+    level_weeks = min(LEVEL_WEEKS, weeks)
+    # The profile covers the last whole years of history, so week w sits at (w - weeks) mod 52: the latest
+    # week at 51 and next week at 0, whatever the history's length
+    positions = (np.arange(weeks - level_weeks, weeks) - weeks) % SEASON_WEEKS
+    recent = weekly[:, -level_weeks:] / np.maximum(season[:, positions], MIN_SEASONAL_INDEX)
+    level = recent.mean(axis=1)
+    sigma = recent.std(axis=1, ddof=1) if level_weeks > 1 else np.zeros(items)
+
+    daily_rate = level / 7
+    daily_sigma = sigma / np.sqrt(7)
+    # Average seasonal index over the weeks each item's lead time spans, starting from next week (index 0)
+    lead_weeks = np.maximum(np.ceil(lead_days / 7).astype(int), 1)
+    ahead = np.cumsum(season[:, np.arange(max(lead_weeks.max(initial=1), HORIZON_WEEKS)) % SEASON_WEEKS], axis=1)
+    lead_factor = np.take_along_axis(ahead, (lead_weeks - 1)[:, None], axis=1)[:, 0] / lead_weeks
+
+    z = NormalDist().inv_cdf(service_level)
+    safety_stock = z * np.sqrt(lead_days * daily_sigma ** 2 + daily_rate ** 2 * lead_std ** 2)
+    reorder_point = daily_rate * lead_days * lead_factor + safety_stock
+    needs_order = (daily_rate > 0) & (available <= reorder_point)
+    order_quantity = np.where(needs_order,
+                              np.ceil(np.maximum(reorder_point + daily_rate * REVIEW_DAYS - available, 0)), 0)
+    return {
+        'weekly_demand': level,
+        'demand_std': sigma,
+        'horizon_demand': level * ahead[:, HORIZON_WEEKS - 1],
+        'lead_time_days': lead_days,
+        'safety_stock': safety_stock,
+        'reorder_point': reorder_point,
+        'available': available,
+        'order_quantity': order_quantity,
+    }
+
+
+class Forecaster:
+    """Reorder points from sales and deliveries history, stored in ``item_forecasts``.
+
+    ``run`` recomputes every SKU in one vectorized pass and is skipped while
+    no sale or delivery has arrived since the last run; reads come from the
+    stored table through the query cache.
+    """
+
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
+
+    def watermark(self, cur):
+        cur.execute("SELECT (SELECT max(sale_id) FROM sales), (SELECT max(delivery_id) FROM deliveries);")
+        return cur.fetchone()
+
+    def load(self, cur, today):
+        start = today - datetime.timedelta(weeks=HISTORY_WEEKS)
+        cur.execute("""
+            SELECT i.item_id, i.vendor_name, COALESCE(b.on_hand - b.reserved, i.quantity)::float8
+            FROM inventory i LEFT JOIN stock_balances b USING (item_id)
+            ORDER BY i.item_id;
+        """)
+        items = fetch_columns(cur, [('item_id', np.int64), ('vendor_name', object), ('available', np.float64)])
+        item_ids = items['item_id']
+
+        # Scatter (item, week, units) triples into a dense (items, weeks) matrix
+        sales = copy_numbers(cur, WEEKLY_SALES_SQL, {'start': start, 'end': today}, 3)
+        sales = sales[np.isin(sales[:, 0], item_ids)]
+        rows = np.searchsorted(item_ids, sales[:, 0].astype(np.int64))
+        flat = rows * HISTORY_WEEKS + sales[:, 1].astype(np.int64)
+        weekly = np.bincount(flat, weights=sales[:, 2], minlength=len(item_ids) * HISTORY_WEEKS)
+        weekly = weekly.reshape(len(item_ids), HISTORY_WEEKS)
+
+        cur.execute(LEAD_TIMES_SQL, {'start': start})
+        vendor_lead_times = {vendor: (mean, std) for vendor, mean, std in cur.fetchall()}
+        vendors, vendor_index = np.unique(items['vendor_name'].astype(str), return_inverse=True)
+        defaults = (DEFAULT_LEAD_TIME_DAYS, 0.0)
+        lead_mean = np.array([vendor_lead_times.get(v, defaults)[0] for v in vendors] or [0.0])[vendor_index]
+        lead_std = np.array([vendor_lead_times.get(v, defaults)[1] for v in vendors] or [0.0])[vendor_index]
+        return item_ids, weekly, lead_mean, lead_std, items['available']
+
+    @invalidates('item_forecasts')
+    def run(self, force=False, progress=None):
+        """Recompute and store forecasts; returns the number of items, or None if skipped."""
+        progress = progress or (lambda fraction, message=None: None)
+        started = time.monotonic()
+        conn = self.db_pool.getconn()
+        try:
+            cur = conn.cursor()
+            last_sale_id, last_delivery_id = self.watermark(cur)
+            cur.execute("SELECT last_sale_id, last_delivery_id FROM forecast_runs ORDER BY run_id DESC LIMIT 1;")
+            previous = cur.fetchone()
+            if not force and previous == (last_sale_id, last_delivery_id):
+                conn.commit()
+                return None
+
+            progress(0.1, "Loading history")
+            item_ids, weekly, lead_mean, lead_std, available = self.load(cur, datetime.date.today())
+            progress(0.6, f"Forecasting {len(item_ids)} items")
+            result = forecast(weekly, lead_mean, lead_std, available)
+
+            progress(0.8, "Storing forecasts")
+            buffer = io.StringIO()
+            table = np.column_stack([item_ids] + [result[column] for column in FORECAST_COLUMNS[1:]])
+            np.savetxt(buffer, table, fmt=['%d'] + ['%.4f'] * (len(FORECAST_COLUMNS) - 1), delimiter='\t')
+            buffer.seek(0)
+            # Readers keep seeing the previous run until this transaction commits
+            cur.execute("DELETE FROM item_forecasts;")
+            cur.copy_expert(f"COPY item_forecasts ({', '.join(FORECAST_COLUMNS)}) FROM STDIN", buffer)
+            cur.execute("""
+                INSERT INTO forecast_runs (last_sale_id, last_delivery_id, items, duration_ms)
+                VALUES (%s, %s, %s, %s);
+            """, (last_sale_id, last_delivery_id, len(item_ids), int((time.monotonic() - started) * 1000)))
+            conn.commit()
+            return len(item_ids)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.db_pool.putconn(conn)
+
+    @cached('item_forecasts')
+    def get_forecast(self, item_id):
+        conn = self.db_pool.getconn(readonly=True)
+        try:
+            cur = conn.cursor()
+            cur.execute(f"""
+                SELECT {', '.join(FORECAST_COLUMNS)}, computed_at FROM item_forecasts WHERE item_id = %s;
+            """, (item_id,))
+            row = cur.fetchone()
+            return dict(zip(FORECAST_COLUMNS + ('computed_at',), row)) if row else None
+        finally:
+            self.db_pool.putconn(conn)
+
+    @cached('item_forecasts', 'inventory')
+    def reorder_list(self, vendor_name=None, limit=100):
+        # Items at or below their reorder point, furthest below first
+        conn = self.db_pool.getconn(readonly=True)
+        try:
+            cur = conn.cursor()
+            cur.execute(f"""
+                SELECT i.item_name, i.vendor_name, {', '.join('f.' + column for column in FORECAST_COLUMNS)}
+                FROM item_forecasts f JOIN inventory i USING (item_id)
+                WHERE f.order_quantity > 0 AND (%s::varchar IS NULL OR i.vendor_name = %s)
+                ORDER BY f.reorder_point - f.available DESC
+                LIMIT %s;
+            """, (vendor_name, vendor_name, int(limit)))
+            columns = ('item_name', 'vendor_name') + FORECAST_COLUMNS
+            return [dict(zip(columns, row)) for row in cur.fetchall()]
+        finally:
+            self.db_pool.putconn(conn)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute demand forecasts and reorder points")
+    parser.add_argument('--force', action='store_true', help="recompute even if no new sales arrived")
+    args = parser.parse_args(argv)
+
+    count = Forecaster(get_db_pool()).run(force=args.force)
+    print("No new sales or deliveries since the last run" if count is None else f"Forecast {count} item(s)")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
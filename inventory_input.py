@@ -1,59 +1,72 @@
 import psycopg2
 from psycopg2 import pool
+from pagination import DEFAULT_PAGE_SIZE, fetch_many, fetch_page
+from query_cache import cached, invalidates
 
 
-class InventoryUtilities:
+class InventoryInput:
+    COLUMNS = ('input_id', 'input_type', 'item_id', 'quantity', 'input_date')
+    SORTABLE_COLUMNS = ('input_date', 'item_id')
+    FILTERABLE_COLUMNS = ('input_type', 'item_id', 'input_date')
+    RECORD = 'InputRecord'
+    ALIASES = (('id', 'input_id'), ('date', 'input_date'))
+
     def __init__(self, db_pool):
         self.db_pool = db_pool
 
-    def get_utilities(self):
-        conn = self.db_pool.getconn()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM utilities;")
-            rows = cur.fetchall()
-            return rows
-        finally:
-            self.db_pool.putconn(conn)
-
-    def run_utility(self, utility_data):
+    def create_input_table(self):
         conn = self.db_pool.getconn()
         try:
             cur = conn.cursor()
             cur.execute("""
-                INSERT INTO utilities (utility_name, parameters)
-                VALUES (%s, %s);
-            """, (utility_data['utility_name'], utility_data['parameters']))
+                CREATE TABLE IF NOT EXISTS inventory_inputs (
+                    input_id SERIAL PRIMARY KEY,
+                    input_type VARCHAR(16) NOT NULL CHECK (input_type IN ('purchase', 'sale')),
+                    item_id INTEGER REFERENCES inventory (item_id) ON DELETE SET NULL,
+                    quantity INTEGER NOT NULL,
+                    input_date DATE NOT NULL
+                );
+            """)
             conn.commit()
         finally:
             self.db_pool.putconn(conn)
 
-    def update_utility(self, utility_id, utility_name, parameters):
+    @invalidates('inventory_inputs', 'stock_balances')
+    def submit_input(self, input_data):
+        # The stock ledger trigger adjusts the item's on-hand balance in this same transaction
         conn = self.db_pool.getconn()
         try:
             cur = conn.cursor()
             cur.execute("""
-                UPDATE utilities
-                SET utility_name = %s, parameters = %s
-                WHERE utility_id = %s;
-            """, (utility_name, parameters, utility_id))
+                INSERT INTO inventory_inputs (input_type, item_id, quantity, input_date)
+                VALUES (%s, %s, %s, %s);
+            """, (input_data['input_type'], input_data['item_id'], input_data['quantity'], input_data['date']))
             conn.commit()
         finally:
             self.db_pool.putconn(conn)
 
-    def delete_utility(self, utility_id):
-        conn = self.db_pool.getconn()
-        try:
-            cur = conn.cursor()
-            cur.execute("DELETE FROM utilities WHERE utility_id = %s;", (utility_id,))
-            conn.commit()
-        finally:
-            self.db_pool.putconn(conn)
+    @cached('inventory_inputs')
+    def get_input(self, limit=DEFAULT_PAGE_SIZE):
+        # Most recent inputs first
+        rows, _ = self.get_input_page(limit=limit, descending=True)
+        return rows
+
+    @cached('inventory_inputs')
+    def get_many(self, ids, columns=None):
+        # {input_id: row} for a batch of ids in one round trip
+        return fetch_many(self.db_pool, 'inventory_inputs', 'input_id',
+                          columns or self.COLUMNS, ids, self.RECORD, self.ALIASES)
+
+    @cached('inventory_inputs')
+    def get_input_page(self, cursor=None, limit=DEFAULT_PAGE_SIZE, sort=None, descending=False, filters=None,
+                       columns=None):
+        return fetch_page(self.db_pool, 'inventory_inputs', 'input_id', columns or self.COLUMNS, filters, sort,
+                          descending, cursor, limit, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS, self.RECORD, self.ALIASES)
 
 
-# Use the existing database connection pool from app.py
-from app import db_pool
+# Use the shared, lazily created database connection pool
+from database_utilities import get_db_pool
 
 
-# Initialize InventoryUtilities class with database connection pool
-inventory_utilities = InventoryUtilities(db_pool)
+# Initialize InventoryInput class with database connection pool
+inventory_input = InventoryInput(get_db_pool())
@@ -1,8 +1,20 @@
 import psycopg2
 from psycopg2 import pool
+from bulk_update import apply_patches
+from pagination import DEFAULT_PAGE_SIZE, STREAM_CHUNK_SIZE, fetch_many, fetch_page, stream_rows
+from records import record_cursor
+from query_cache import cached, invalidates
 
 
 class InventoryItems:
+    COLUMNS = ('item_id', 'item_name', 'vendor_name', 'quantity', 'value', 'version')
+    SORTABLE_COLUMNS = ('item_name', 'vendor_name', 'quantity', 'value')
+    FILTERABLE_COLUMNS = ('item_name', 'vendor_name')
+    RECORD = 'InventoryRecord'
+    ALIASES = (('id', 'item_id'), ('name', 'item_name'), ('vendor', 'vendor_name'))
+    # Columns bulk_update may patch, with their SQL types
+    PATCHABLE_COLUMNS = {'item_name': 'varchar', 'vendor_name': 'varchar', 'quantity': 'integer', 'value': 'numeric'}
+
     def __init__(self, db_pool):
         self.db_pool = db_pool
 
@@ -11,6 +23,7 @@ class InventoryItems:
         pass
 
     def create_inventory_table(self):
+        # The table as migrations.py leaves it (NUMERIC value, row version); its triggers and indexes come from there
         conn = self.db_pool.getconn()
         try:
             cur = conn.cursor()
@@ -20,13 +33,15 @@ class InventoryItems:
                     item_name VARCHAR(255) NOT NULL,
                     vendor_name VARCHAR(255) NOT NULL,
                     quantity INTEGER NOT NULL,
-                    value FLOAT NOT NULL
+                    value NUMERIC(12, 2) NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 1
                 );
             """)
             conn.commit()
         finally:
             self.db_pool.putconn(conn)
 
+    @invalidates('inventory', 'stock_balances')
     def add_item(self, item_data):
         conn = self.db_pool.getconn()
         try:
@@ -39,16 +54,33 @@ class InventoryItems:
         finally:
             self.db_pool.putconn(conn)
 
+    @cached('inventory')
     def get_inventory(self):
-        conn = self.db_pool.getconn()
+        conn = self.db_pool.getconn(readonly=True)
         try:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM inventory;")
+            cur = record_cursor(conn, self.RECORD, self.COLUMNS, self.ALIASES)
+            cur.execute(f"SELECT {', '.join(self.COLUMNS)} FROM inventory;")
             rows = cur.fetchall()
             return rows
         finally:
             self.db_pool.putconn(conn)
 
+    @cached('inventory')
+    def get_many(self, ids, columns=None):
+        # {item_id: row} for a batch of ids in one round trip
+        return fetch_many(self.db_pool, 'inventory', 'item_id', columns or self.COLUMNS, ids, self.RECORD, self.ALIASES)
+
+    @cached('inventory')
+    def get_inventory_page(self, cursor=None, limit=DEFAULT_PAGE_SIZE, sort=None, descending=False, filters=None,
+                           columns=None):
+        return fetch_page(self.db_pool, 'inventory', 'item_id', columns or self.COLUMNS, filters, sort, descending,
+                          cursor, limit, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS, self.RECORD, self.ALIASES)
+
+    def stream_inventory(self, sort=None, descending=False, filters=None, chunk_size=STREAM_CHUNK_SIZE, columns=None):
+        return stream_rows(self.db_pool, 'inventory', 'item_id', columns or self.COLUMNS, filters, sort, descending,
+                           chunk_size, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS, self.RECORD, self.ALIASES)
+
+    @invalidates('inventory', 'stock_balances')
     def update_item(self, item_id, item_name, vendor_name, quantity, value):
         conn = self.db_pool.getconn()
         try:
@@ -62,6 +94,16 @@ class InventoryItems:
         finally:
             self.db_pool.putconn(conn)
 
+    @invalidates('inventory', 'stock_balances')
+    def bulk_update(self, patches):
+        """Apply sparse patches (``{item_id, version?, column: value...}``) to many items at once.
+
+        Repricing a vendor's catalog is one statement and one commit.
+        Returns one ``{item_id, outcome, version}`` per patch (see bulk_update.apply_patches).
+        """
+        return apply_patches(self.db_pool, 'inventory', 'item_id', self.PATCHABLE_COLUMNS, patches)
+
+    @invalidates('inventory', 'stock_balances')
     def delete_item(self, item_id):
         conn = self.db_pool.getconn()
         try:
@@ -72,9 +114,9 @@ class InventoryItems:
             self.db_pool.putconn(conn)
 
 
-# Use the existing database connection pool from app.py
-from app import db_pool
+# Use the shared, lazily created database connection pool
+from database_utilities import get_db_pool
 
 
 # Initialize InventoryItems class with database connection pool
-inventory_items = InventoryItems(db_pool)
+inventory_items = InventoryItems(get_db_pool())
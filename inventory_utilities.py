@@ -1,46 +1,109 @@
 import psycopg2
 from psycopg2 import pool
+from pagination import DEFAULT_PAGE_SIZE, STREAM_CHUNK_SIZE, fetch_many, fetch_page, stream_rows
+from records import record_cursor
+from query_cache import cached, invalidates
+from utility_runner import validate_job
 
 
 class InventoryUtilities:
+    COLUMNS = ('utility_id', 'utility_name', 'parameters', 'status', 'progress', 'message',
+               'queued_at', 'started_at', 'duration_ms')
+    SORTABLE_COLUMNS = ('utility_name', 'status', 'queued_at')
+    FILTERABLE_COLUMNS = ('utility_name', 'status')
+    # Columns that change while a job runs
+    STATE_COLUMNS = ('utility_id', 'status', 'progress', 'message', 'duration_ms')
+    RECORD = 'UtilityRecord'
+    ALIASES = (('id', 'utility_id'), ('name', 'utility_name'))
+
     def __init__(self, db_pool):
         self.db_pool = db_pool
 
+    @cached('utilities')
     def get_utilities(self):
-        conn = self.db_pool.getconn()
+        conn = self.db_pool.getconn(readonly=True)
         try:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM utilities;")
+            cur = record_cursor(conn, self.RECORD, self.COLUMNS, self.ALIASES)
+            cur.execute(f"SELECT {', '.join(self.COLUMNS)} FROM utilities;")
             rows = cur.fetchall()
             return rows
         finally:
             self.db_pool.putconn(conn)
 
+    @cached('utilities')
+    def get_many(self, ids, columns=None):
+        # {utility_id: row} for a batch of ids in one round trip
+        return fetch_many(self.db_pool, 'utilities', 'utility_id',
+                          columns or self.COLUMNS, ids, self.RECORD, self.ALIASES)
+
+    @cached('utilities')
+    def get_utilities_page(self, cursor=None, limit=DEFAULT_PAGE_SIZE, sort=None, descending=False, filters=None,
+                           columns=None):
+        return fetch_page(self.db_pool, 'utilities', 'utility_id', columns or self.COLUMNS, filters, sort, descending,
+                          cursor, limit, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS, self.RECORD, self.ALIASES)
+
+    def stream_utilities(self, sort=None, descending=False, filters=None, chunk_size=STREAM_CHUNK_SIZE, columns=None):
+        return stream_rows(self.db_pool, 'utilities', 'utility_id', columns or self.COLUMNS, filters, sort, descending,
+                           chunk_size, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS, self.RECORD, self.ALIASES)
+
+    def get_utility_states(self, utility_ids):
+        # Live job state for the given rows; never cached, the runner updates these every second
+        utility_ids = list(utility_ids)
+        if not utility_ids:
+            return []
+        conn = self.db_pool.getconn()
+        try:
+            cur = record_cursor(conn, self.RECORD, self.STATE_COLUMNS, self.ALIASES)
+            cur.execute(f"SELECT {', '.join(self.STATE_COLUMNS)} FROM utilities WHERE utility_id = ANY(%s);",
+                        (utility_ids,))
+            return cur.fetchall()
+        finally:
+            self.db_pool.putconn(conn)
+
+    @invalidates('utilities')
     def run_utility(self, utility_data):
+        """Queue a job for ``utility_runner`` and return its id.
+
+        The request only inserts the row; the work itself happens in the
+        runner's processes.
+        """
+        validate_job(utility_data['utility_name'], utility_data['parameters'])
+        timeout = utility_data.get('timeout_seconds') or None
         conn = self.db_pool.getconn()
         try:
             cur = conn.cursor()
             cur.execute("""
-                INSERT INTO utilities (utility_name, parameters)
-                VALUES (%s, %s);
-            """, (utility_data['utility_name'], utility_data['parameters']))
+                INSERT INTO utilities (utility_name, parameters, timeout_seconds)
+                VALUES (%s, %s, %s)
+                RETURNING utility_id;
+            """, (utility_data['utility_name'], utility_data['parameters'],
+                  int(timeout) if timeout is not None else None))
+            utility_id = cur.fetchone()[0]
             conn.commit()
+            return utility_id
         finally:
             self.db_pool.putconn(conn)
 
+    @invalidates('utilities')
     def update_utility(self, utility_id, utility_name, parameters):
+        # Only a job still waiting in the queue can be edited; once claimed the runner has already read it
+        validate_job(utility_name, parameters)
         conn = self.db_pool.getconn()
         try:
             cur = conn.cursor()
             cur.execute("""
                 UPDATE utilities
                 SET utility_name = %s, parameters = %s
-                WHERE utility_id = %s;
+                WHERE utility_id = %s AND status = 'queued';
             """, (utility_name, parameters, utility_id))
+            if cur.rowcount == 0:
+                conn.rollback()
+                raise ValueError(f"Utility {utility_id} is not queued and can no longer be edited")
             conn.commit()
         finally:
             self.db_pool.putconn(conn)
 
+    @invalidates('utilities')
     def delete_utility(self, utility_id):
         conn = self.db_pool.getconn()
         try:
@@ -51,9 +114,9 @@ class InventoryUtilities:
             self.db_pool.putconn(conn)
 
 
-# Use the existing database connection pool from app.py
-from app import db_pool
+# Use the shared, lazily created database connection pool
+from database_utilities import get_db_pool
 
 
 # Initialize InventoryUtilities class with database connection pool
-inventory_utilities = InventoryUtilities(db_pool)
+inventory_utilities = InventoryUtilities(get_db_pool())
@@ -0,0 +1,148 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from database_utilities import reading_own_writes, replica_reads
+from query_cache import query_cache
+
+
+SEARCH_DEFAULT_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+# Trigram matching needs a few characters to be selective; shorter queries only match prefixes
+FUZZY_MIN_LENGTH = 3
+# Lowest pg_trgm word similarity a typo match may have (pg_trgm's own default is 0.6)
+SEARCH_MIN_SIMILARITY = float(os.environ.get('SEARCH_MIN_SIMILARITY', 0.4))
+# Queries up to this many characters are the ones every keystroke session starts with
+SEARCH_CACHE_PREFIX_LENGTH = int(os.environ.get('SEARCH_CACHE_PREFIX_LENGTH', 4))
+SEARCH_CACHE_ENTRIES = int(os.environ.get('SEARCH_CACHE_ENTRIES', 512))
+
+# Each branch is answered from an index on lower(column) created in migration 12 and stops after
+# ``limit`` rows: the text_pattern_ops btrees serve the prefix range scans, the GiST trigram indexes the
+# nearest-neighbour (<<->) scans. Matches on the item name rank ahead of matches on the vendor.
+PREFIX_SQL = """
+    (SELECT item_id, item_name, vendor_name, 'item_name', 1.0::float8
+     FROM inventory WHERE lower(item_name) LIKE %(prefix)s
+     ORDER BY lower(item_name) LIMIT %(limit)s)
+    UNION ALL
+    (SELECT item_id, item_name, vendor_name, 'vendor_name', 1.0::float8
+     FROM inventory WHERE lower(vendor_name) LIKE %(prefix)s
+     ORDER BY lower(vendor_name), lower(item_name) LIMIT %(limit)s);
+"""
+
+FUZZY_SQL = """
+    SELECT * FROM (
+        (SELECT item_id, item_name, vendor_name, 'item_name', word_similarity(%(query)s, lower(item_name))::float8
+         FROM inventory WHERE %(query)s <%% lower(item_name)
+         ORDER BY %(query)s <<-> lower(item_name) LIMIT %(limit)s)
+        UNION ALL
+        (SELECT item_id, item_name, vendor_name, 'vendor_name', word_similarity(%(query)s, lower(vendor_name))::float8
+         FROM inventory WHERE %(query)s <%% lower(vendor_name)
+         ORDER BY %(query)s <<-> lower(vendor_name) LIMIT %(limit)s)
+    ) matches (item_id, item_name, vendor_name, matched, score)
+    ORDER BY score DESC, matched;
+"""
+
+RESULT_FIELDS = ('item_id', 'item_name', 'vendor_name', 'matched', 'score')
+
+
+def normalize(query):
+    return re.sub(r'\s+', ' ', query or '').strip().lower()
+
+
+def like_prefix(query):
+    # Escape LIKE wildcards so user input only ever matches literally
+    return re.sub(r'([\\%_])', r'\\\1', query) + '%'
+
+
+class PrefixCache:
+    """Small LRU of results for the shortest, hottest search queries.
+
+    Entries remember the query cache's generation for ``inventory``; any
+    write to the table (here or, through the invalidation listener, in
+    another worker) bumps it and turns the entry into a miss.
+    """
+
+    def __init__(self, max_entries=SEARCH_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (generation, results)
+
+    def get(self, key):
+        generation = query_cache.generation(('inventory',))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != generation:
+                return generation, None
+            self.entries.move_to_end(key)
+            return generation, entry[1]
+
+    def put(self, key, generation, results):
+        with self.lock:
+            self.entries[key] = (generation, results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class ItemSearch:
+    """Ranked, typo-tolerant lookup of items by item or vendor name, for autocomplete.
+
+    Prefix matches come first in name order; if they don't fill ``limit``,
+    the rest are the closest trigram matches, so "widgt" still finds
+    "Blue Widget". Each result says which column ``matched`` and carries a
+    ``score``: 1.0 for a prefix match, otherwise its word similarity.
+    """
+
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
+        self.cache = PrefixCache()
+
+    def search(self, query, limit=SEARCH_DEFAULT_LIMIT):
+        limit = min(max(int(limit or SEARCH_DEFAULT_LIMIT), 1), SEARCH_MAX_LIMIT)
+        query = normalize(query)
+        if not query:
+            return []
+
+        # Same rules as query_cache.cached: no cache right after a write, and replica results aren't stored
+        cacheable = len(query) <= SEARCH_CACHE_PREFIX_LENGTH and not reading_own_writes()
+        if cacheable:
+            generation, results = self.cache.get((query, limit))
+            if results is not None:
+                return results
+        replica_reads_before = replica_reads()
+        results = self._search(query, limit)
+        if cacheable and replica_reads() == replica_reads_before:
+            self.cache.put((query, limit), generation, results)
+        return results
+
+    def _search(self, query, limit):
+        params = {'query': query, 'prefix': like_prefix(query), 'limit': limit}
+        conn = self.db_pool.getconn(readonly=True)
+        try:
+            cur = conn.cursor()
+            cur.execute(PREFIX_SQL, params)
+            rows = cur.fetchall()
+            if len({row[0] for row in rows}) < limit and len(query) >= FUZZY_MIN_LENGTH:
+                cur.execute("SET LOCAL pg_trgm.word_similarity_threshold = %s;", (SEARCH_MIN_SIMILARITY,))
+                cur.execute(FUZZY_SQL, params)
+                rows += cur.fetchall()
+            conn.commit()
+        finally:
+            self.db_pool.putconn(conn)
+
+        # An item can match on both columns and in both passes; keep its best-ranked row
+        results = []
+        seen = set()
+        for row in rows:
+            if row[0] not in seen and len(results) < limit:
+                seen.add(row[0])
+                results.append(dict(zip(RESULT_FIELDS, row)))
+        return results
+
+
+# Use the shared, lazily created database connection pool
+from database_utilities import get_db_pool
+
+
+# Initialize ItemSearch class with database connection pool
+item_search = ItemSearch(get_db_pool())
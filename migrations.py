@@ -0,0 +1,717 @@
+import argparse
+import re
+import time
+import psycopg2
+from database_utilities import get_db_pool
+from partitions import partition_table
+from stock_ledger import UNTRACKED_MOVEMENTS_SQL, rebuild_sql
+
+
+DEFAULT_BATCH_SIZE = 5000
+# Pause between backfill batches so replication and autovacuum keep up
+BATCH_PAUSE = 0.05
+# DDL gives up instead of queueing behind long-running queries (and blocking everyone behind it)
+LOCK_TIMEOUT = '5s'
+
+
+class SQL:
+    # A statement run in its own short transaction; must be safe to re-run
+    def __init__(self, statement):
+        self.statement = statement
+
+    def apply(self, conn, batch_size):
+        cur = conn.cursor()
+        cur.execute(self.statement)
+        conn.commit()
+
+
+# CREATE [UNIQUE] INDEX CONCURRENTLY [IF NOT EXISTS] name ON table ..., split so it can be rewritten per partition
+INDEX_STATEMENT = re.compile(r'\s*(?P<head>CREATE\s+(?:UNIQUE\s+)?INDEX)\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?'
+                             r'(?P<name>\w+)\s+ON\s+(?:ONLY\s+)?(?P<table>\w+)(?P<rest>.*)', re.IGNORECASE | re.DOTALL)
+
+
+class Concurrently(SQL):
+    # A statement that cannot run in a transaction block, e.g. CREATE INDEX CONCURRENTLY
+    def apply(self, conn, batch_size):
+        index = INDEX_STATEMENT.match(self.statement)
+        if index:
+            cur = conn.cursor()
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (index['table'],))
+            row = cur.fetchone()
+            conn.commit()
+            if row and row[0] == 'p':
+                self.apply_partitioned(conn, index)
+                return
+        run_concurrently(conn, self.statement, index['name'] if index else None)
+
+    def apply_partitioned(self, conn, index):
+        """Build an index on a partitioned table without blocking writes to it.
+
+        Partitioned tables reject CREATE INDEX CONCURRENTLY, and a plain
+        CREATE INDEX blocks writes to every partition for the whole build.
+        Instead the index is created ``ON ONLY`` the parent (instant, and
+        invalid for now), each partition's index is built concurrently and
+        attached, and the parent index turns valid once every partition has
+        one. Partitions attached later get theirs from the parent.
+        """
+        head, name, table, rest = index['head'], index['name'], index['table'], index['rest']
+        SQL(f"{head} IF NOT EXISTS {name} ON ONLY {table}{rest}").apply(conn, None)
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT c.relname, EXISTS (
+                SELECT 1 FROM pg_index x JOIN pg_inherits a ON a.inhrelid = x.indexrelid
+                WHERE x.indrelid = c.oid AND a.inhparent = to_regclass(%s)
+            )
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+            ORDER BY c.relname;
+        """, (name, table))
+        partitions = cur.fetchall()
+        conn.commit()
+        for partition, attached in partitions:
+            if attached:
+                continue
+            # deliveries_item_id_idx on deliveries_2024_01 becomes deliveries_2024_01_item_id_idx
+            child = partition + name[len(table):] if name.startswith(f"{table}_") else f"{partition}_{name}"
+            run_concurrently(conn, f"{head} CONCURRENTLY IF NOT EXISTS {child} ON {partition}{rest}", child)
+            SQL(f"ALTER INDEX {name} ATTACH PARTITION {child};").apply(conn, None)
+
+
+def run_concurrently(conn, statement, index=None):
+    # Run outside a transaction block; ``index`` names the index the statement builds, if any
+    conn.commit()
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        if index:
+            drop_invalid_index(cur, index)
+        cur.execute(statement)
+    finally:
+        conn.autocommit = False
+
+
+def drop_invalid_index(cur, name):
+    # A failed or interrupted CREATE INDEX CONCURRENTLY leaves an INVALID index behind that IF NOT EXISTS
+    # would keep forever (unused by queries but still maintained on every write), so drop it and rebuild
+    cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);", (name,))
+    row = cur.fetchone()
+    if row and not row[0]:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+
+
+class AddConstraint:
+    # ALTER TABLE ... ADD CONSTRAINT has no IF NOT EXISTS, so check the catalog first
+    def __init__(self, table, name, definition):
+        self.table = table
+        self.name = name
+        self.definition = definition
+
+    def apply(self, conn, batch_size):
+        cur = conn.cursor()
+        cur.execute("SELECT 1 FROM pg_constraint WHERE conname = %s;", (self.name,))
+        if cur.fetchone() is None:
+            cur.execute(f"ALTER TABLE {self.table} ADD CONSTRAINT {self.name} {self.definition};")
+        conn.commit()
+
+
+class Partition:
+    # Convert a table to monthly range partitions online (see partitions.partition_table)
+    def __init__(self, table):
+        self.table = table
+
+    def apply(self, conn, batch_size):
+        partition_table(conn, self.table, batch_size)
+
+
+class Backfill:
+    """An UPDATE applied in primary-key ranges, committing after each batch.
+
+    Each batch only locks the rows in its range, so the table stays writable
+    while a large backfill runs.
+    """
+
+    def __init__(self, table, pk, assignment, where=None):
+        self.table = table
+        self.pk = pk
+        self.assignment = assignment
+        self.where = where
+
+    def apply(self, conn, batch_size):
+        cur = conn.cursor()
+        cur.execute(f"SELECT min({self.pk}), max({self.pk}) FROM {self.table};")
+        low, high = cur.fetchone()
+        conn.commit()
+        if low is None:
+            return
+
+        condition = f" AND ({self.where})" if self.where else ""
+        start = low - 1
+        while start < high:
+            cur.execute(f"""
+                UPDATE {self.table} SET {self.assignment}
+                WHERE {self.pk} > %s AND {self.pk} <= %s{condition};
+            """, (start, start + batch_size))
+            conn.commit()
+            start += batch_size
+            time.sleep(BATCH_PAUSE)
+
+
+def item_id_sync(table):
+    # Trigger that keeps item_id filled in from item_name for rows written by the existing INSERTs
+    return SQL(f"""
+        CREATE OR REPLACE FUNCTION {table}_set_item_id() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                IF NEW.item_id IS NULL THEN
+                    NEW.item_id := (SELECT min(item_id) FROM inventory WHERE item_name = NEW.item_name);
+                END IF;
+            ELSIF NEW.item_name IS DISTINCT FROM OLD.item_name THEN
+                NEW.item_id := (SELECT min(item_id) FROM inventory WHERE item_name = NEW.item_name);
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS {table}_set_item_id ON {table};
+        CREATE TRIGGER {table}_set_item_id BEFORE INSERT OR UPDATE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {table}_set_item_id();
+    """)
+
+
+def money_to_numeric(table, pk, column):
+    """Steps converting a FLOAT money column to NUMERIC without a table rewrite lock.
+
+    A shadow column is kept in sync by a trigger, backfilled in batches and
+    then swapped in with a quick rename. The columns hold whole cents:
+    NUMERIC(12, 2) rounds any sub-cent FLOAT value to the nearest cent (half
+    away from zero), during the backfill and on every later write alike.
+    """
+    shadow = f"{column}_numeric"
+    return [
+        SQL(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {shadow} NUMERIC(12, 2);"),
+        SQL(f"""
+            CREATE OR REPLACE FUNCTION {table}_sync_{shadow}() RETURNS trigger AS $$
+            BEGIN
+                NEW.{shadow} := NEW.{column};
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS {table}_sync_{shadow} ON {table};
+            CREATE TRIGGER {table}_sync_{shadow} BEFORE INSERT OR UPDATE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION {table}_sync_{shadow}();
+        """),
+        Backfill(table, pk, f"{shadow} = {column}", f"{shadow} IS NULL"),
+        # Validating a CHECK lets SET NOT NULL skip its full-table scan
+        AddConstraint(table, f"{table}_{shadow}_not_null", f"CHECK ({shadow} IS NOT NULL) NOT VALID"),
+        SQL(f"ALTER TABLE {table} VALIDATE CONSTRAINT {table}_{shadow}_not_null;"),
+        SQL(f"""
+            DO $$
+            BEGIN
+                IF EXISTS (SELECT 1 FROM information_schema.columns
+                           WHERE table_name = '{table}' AND column_name = '{shadow}') THEN
+                    DROP TRIGGER IF EXISTS {table}_sync_{shadow} ON {table};
+                    DROP FUNCTION IF EXISTS {table}_sync_{shadow}();
+                    ALTER TABLE {table} ALTER COLUMN {shadow} SET NOT NULL;
+                    ALTER TABLE {table} DROP CONSTRAINT {table}_{shadow}_not_null;
+                    ALTER TABLE {table} DROP COLUMN {column};
+                    ALTER TABLE {table} RENAME COLUMN {shadow} TO {column};
+                END IF;
+            END;
+            $$;
+        """),
+    ]
+
+
+def stock_movement_trigger(table, delta, events='INSERT OR UPDATE OR DELETE'):
+    """Trigger applying a table's stock movement to ``stock_balances``.
+
+    ``delta`` is the signed quantity expression written against ``ROW``; an
+    update backs out the old row's movement and applies the new one.
+    """
+    old_delta = delta.replace('ROW.', 'OLD.')
+    new_delta = delta.replace('ROW.', 'NEW.')
+    return SQL(f"""
+        CREATE OR REPLACE FUNCTION {table}_stock_movement() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM stock_apply(OLD.item_id, -({old_delta}));
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM stock_apply(NEW.item_id, {new_delta});
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS {table}_stock_movement ON {table};
+        CREATE TRIGGER {table}_stock_movement AFTER {events} ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {table}_stock_movement();
+    """)
+
+
+# (version, name, steps) in the order they are applied
+MIGRATIONS = [
+    (1, 'baseline tables', [
+        SQL("""
+            CREATE TABLE IF NOT EXISTS inventory (
+                item_id SERIAL PRIMARY KEY,
+                item_name VARCHAR(255) NOT NULL,
+                vendor_name VARCHAR(255) NOT NULL,
+                quantity INTEGER NOT NULL,
+                value FLOAT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sales (
+                sale_id SERIAL PRIMARY KEY,
+                sale_date DATE NOT NULL,
+                item_name VARCHAR(255) NOT NULL,
+                quantity INTEGER NOT NULL,
+                price FLOAT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS deliveries (
+                delivery_id SERIAL PRIMARY KEY,
+                delivery_date DATE NOT NULL,
+                vendor_name VARCHAR(255) NOT NULL,
+                item_name VARCHAR(255) NOT NULL,
+                quantity INTEGER NOT NULL,
+                unit_price FLOAT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS utilities (
+                utility_id SERIAL PRIMARY KEY,
+                utility_name VARCHAR(255) NOT NULL,
+                parameters TEXT
+            );
+        """),
+    ]),
+    (2, 'inventory lookup indexes', [
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_item_name_idx ON inventory (item_name);"),
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_vendor_name_idx ON inventory (vendor_name);"),
+    ]),
+    (3, 'item_id foreign keys on sales and deliveries', [
+        SQL("ALTER TABLE sales ADD COLUMN IF NOT EXISTS item_id INTEGER;"),
+        SQL("ALTER TABLE deliveries ADD COLUMN IF NOT EXISTS item_id INTEGER;"),
+        item_id_sync('sales'),
+        item_id_sync('deliveries'),
+        Backfill('sales', 'sale_id',
+                 "item_id = (SELECT min(i.item_id) FROM inventory i WHERE i.item_name = sales.item_name)",
+                 "item_id IS NULL"),
+        Backfill('deliveries', 'delivery_id',
+                 "item_id = (SELECT min(i.item_id) FROM inventory i WHERE i.item_name = deliveries.item_name)",
+                 "item_id IS NULL"),
+        # NOT VALID + VALIDATE avoids holding a write-blocking lock during the check
+        AddConstraint('sales', 'sales_item_id_fkey',
+                      "FOREIGN KEY (item_id) REFERENCES inventory (item_id) ON DELETE SET NULL NOT VALID"),
+        AddConstraint('deliveries', 'deliveries_item_id_fkey',
+                      "FOREIGN KEY (item_id) REFERENCES inventory (item_id) ON DELETE SET NULL NOT VALID"),
+        SQL("ALTER TABLE sales VALIDATE CONSTRAINT sales_item_id_fkey;"),
+        SQL("ALTER TABLE deliveries VALIDATE CONSTRAINT deliveries_item_id_fkey;"),
+    ]),
+    (4, 'sales and deliveries indexes', [
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS sales_item_id_idx ON sales (item_id);"),
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS sales_sale_date_idx ON sales (sale_date);"),
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS deliveries_item_id_idx ON deliveries (item_id);"),
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS deliveries_delivery_date_idx "
+                     "ON deliveries (delivery_date);"),
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS deliveries_vendor_name_idx "
+                     "ON deliveries (vendor_name);"),
+    ]),
+    (5, 'NUMERIC money columns',
+        # Prices and values are currency amounts; sub-cent inputs are rounded to the cent (see money_to_numeric)
+        money_to_numeric('inventory', 'item_id', 'value')
+        + money_to_numeric('sales', 'sale_id', 'price')
+        + money_to_numeric('deliveries', 'delivery_id', 'unit_price')),
+    (6, 'stock ledger', [
+        SQL("""
+            CREATE TABLE IF NOT EXISTS inventory_inputs (
+                input_id SERIAL PRIMARY KEY,
+                input_type VARCHAR(16) NOT NULL CHECK (input_type IN ('purchase', 'sale')),
+                item_id INTEGER REFERENCES inventory (item_id) ON DELETE SET NULL,
+                quantity INTEGER NOT NULL,
+                input_date DATE NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS stock_balances (
+                item_id INTEGER PRIMARY KEY REFERENCES inventory (item_id) ON DELETE CASCADE,
+                on_hand INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+        """),
+        SQL("""
+            CREATE OR REPLACE FUNCTION stock_apply(p_item_id INTEGER, p_delta INTEGER) RETURNS void AS $$
+            BEGIN
+                IF p_item_id IS NULL OR p_delta = 0 THEN
+                    RETURN;
+                END IF;
+                -- Skip items deleted in this statement (their balance row is cascaded away)
+                INSERT INTO stock_balances (item_id, on_hand, updated_at)
+                SELECT p_item_id, p_delta, now()
+                WHERE EXISTS (SELECT 1 FROM inventory WHERE item_id = p_item_id)
+                ON CONFLICT (item_id) DO UPDATE
+                    SET on_hand = stock_balances.on_hand + EXCLUDED.on_hand, updated_at = EXCLUDED.updated_at;
+            END;
+            $$ LANGUAGE plpgsql;
+        """),
+        # Deleting an inventory row cascades its balance away, so only inserts and recounts count
+        stock_movement_trigger('inventory', 'ROW.quantity', 'INSERT OR UPDATE OF quantity'),
+        stock_movement_trigger('deliveries', 'ROW.quantity'),
+        stock_movement_trigger('sales', '-ROW.quantity'),
+        stock_movement_trigger('inventory_inputs',
+                               "CASE WHEN ROW.input_type = 'purchase' THEN ROW.quantity ELSE -ROW.quantity END"),
+        SQL("LOCK TABLE stock_balances IN EXCLUSIVE MODE;" + rebuild_sql(UNTRACKED_MOVEMENTS_SQL)),
+    ]),
+    (7, 'cache invalidation notifications', [
+        SQL("""
+            CREATE OR REPLACE FUNCTION notify_cache_invalidation() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('cache_invalidation', TG_TABLE_NAME);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        """),
+    ] + [
+        # Statement-level, so a bulk write sends one notification per table (delivered at commit)
+        SQL(f"""
+            DROP TRIGGER IF EXISTS {table}_cache_invalidation ON {table};
+            CREATE TRIGGER {table}_cache_invalidation
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_cache_invalidation();
+        """)
+        for table in ('inventory', 'sales', 'deliveries', 'utilities', 'inventory_inputs', 'stock_balances')
+    ]),
+    (8, 'orders with stock reservations', [
+        SQL("""
+            CREATE TABLE IF NOT EXISTS orders (
+                order_id SERIAL PRIMARY KEY,
+                order_date DATE NOT NULL,
+                customer_name VARCHAR(255) NOT NULL,
+                item_id INTEGER REFERENCES inventory (item_id) ON DELETE SET NULL,
+                item_name VARCHAR(255) NOT NULL,
+                quantity INTEGER NOT NULL CHECK (quantity > 0),
+                status VARCHAR(16) NOT NULL DEFAULT 'reserved',
+                idempotency_key VARCHAR(255) UNIQUE,
+                reserved_until TIMESTAMPTZ,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            ALTER TABLE stock_balances ADD COLUMN IF NOT EXISTS reserved INTEGER NOT NULL DEFAULT 0;
+        """),
+        AddConstraint('stock_balances', 'stock_balances_reserved_check',
+                      "CHECK (reserved >= 0) NOT VALID"),
+        SQL("ALTER TABLE stock_balances VALIDATE CONSTRAINT stock_balances_reserved_check;"),
+        # The reaper only ever looks at live reservations, ordered by deadline
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_reserved_until_idx "
+                     "ON orders (reserved_until) WHERE status = 'reserved';"),
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_item_id_idx ON orders (item_id);"),
+        SQL("""
+            DROP TRIGGER IF EXISTS orders_cache_invalidation ON orders;
+            CREATE TRIGGER orders_cache_invalidation
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON orders
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_cache_invalidation();
+        """),
+    ]),
+    (9, 'utility job state', [
+        # Rows queued before the runner existed were never meant to run retroactively
+        SQL("""
+            ALTER TABLE utilities
+                ADD COLUMN IF NOT EXISTS status VARCHAR(16) NOT NULL DEFAULT 'skipped',
+                ADD COLUMN IF NOT EXISTS progress REAL NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS message TEXT,
+                ADD COLUMN IF NOT EXISTS timeout_seconds INTEGER,
+                ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS worker VARCHAR(255),
+                ADD COLUMN IF NOT EXISTS queued_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                ADD COLUMN IF NOT EXISTS started_at TIMESTAMPTZ,
+                ADD COLUMN IF NOT EXISTS finished_at TIMESTAMPTZ,
+                ADD COLUMN IF NOT EXISTS duration_ms BIGINT;
+            ALTER TABLE utilities ALTER COLUMN status SET DEFAULT 'queued';
+        """),
+        # The runner only scans the queue head and the running set
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS utilities_queued_idx "
+                     "ON utilities (utility_id) WHERE status = 'queued';"),
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS utilities_running_idx "
+                     "ON utilities (started_at) WHERE status = 'running';"),
+    ]),
+    (10, 'demand forecasts', [
+        SQL("""
+            CREATE TABLE IF NOT EXISTS item_forecasts (
+                item_id INTEGER PRIMARY KEY REFERENCES inventory (item_id) ON DELETE CASCADE,
+                weekly_demand NUMERIC(14, 4) NOT NULL,
+                demand_std NUMERIC(14, 4) NOT NULL,
+                horizon_demand NUMERIC(14, 4) NOT NULL,
+                lead_time_days NUMERIC(10, 4) NOT NULL,
+                safety_stock NUMERIC(14, 4) NOT NULL,
+                reorder_point NUMERIC(14, 4) NOT NULL,
+                available NUMERIC(14, 4) NOT NULL,
+                order_quantity NUMERIC(14, 4) NOT NULL,
+                computed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            CREATE TABLE IF NOT EXISTS forecast_runs (
+                run_id SERIAL PRIMARY KEY,
+                computed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                last_sale_id INTEGER,
+                last_delivery_id INTEGER,
+                items INTEGER NOT NULL,
+                duration_ms BIGINT NOT NULL
+            );
+            DROP TRIGGER IF EXISTS item_forecasts_cache_invalidation ON item_forecasts;
+            CREATE TRIGGER item_forecasts_cache_invalidation
+                AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON item_forecasts
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_cache_invalidation();
+        """),
+        # The reorder list only reads items that need ordering
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS item_forecasts_reorder_idx "
+                     "ON item_forecasts ((reorder_point - available) DESC) WHERE order_quantity > 0;"),
+    ]),
+    (11, 'monthly partitions for sales and deliveries', [
+        SQL("""
+            CREATE TABLE IF NOT EXISTS archived_movements (
+                partition_name VARCHAR(63) NOT NULL,
+                item_id INTEGER NOT NULL REFERENCES inventory (item_id) ON DELETE CASCADE,
+                quantity INTEGER NOT NULL,
+                PRIMARY KEY (partition_name, item_id)
+            );
+        """),
+        Partition('sales'),
+        Partition('deliveries'),
+    ]),
+    (12, 'item search indexes', [
+        SQL("CREATE EXTENSION IF NOT EXISTS pg_trgm;"),
+        # Case-insensitive prefix scans (LIKE 'abc%') for autocomplete
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_item_name_prefix_idx "
+                     "ON inventory (lower(item_name) text_pattern_ops);"),
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_vendor_name_prefix_idx "
+                     "ON inventory (lower(vendor_name) text_pattern_ops);"),
+        # GiST rather than GIN: it can return the nearest trigram matches in order, so LIMIT stops early
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_item_name_trgm_idx "
+                     "ON inventory USING gist (lower(item_name) gist_trgm_ops);"),
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_vendor_name_trgm_idx "
+                     "ON inventory USING gist (lower(vendor_name) gist_trgm_ops);"),
+    ]),
+    (13, 'row change feed notifications', [
+        # The table name is an argument because on a partitioned table the trigger fires on the partition.
+        # Bulk loads set inventory.change_feed = 'off' for their transaction and send one reload instead.
+        SQL("""
+            CREATE OR REPLACE FUNCTION notify_row_change() RETURNS trigger AS $$
+            BEGIN
+                IF current_setting('inventory.change_feed', true) = 'off' THEN
+                    RETURN NULL;
+                END IF;
+                PERFORM pg_notify('row_changes', json_build_object(
+                    'table', TG_ARGV[0],
+                    'op', lower(TG_OP),
+                    'row', CASE WHEN TG_OP = 'DELETE' THEN row_to_json(OLD) ELSE row_to_json(NEW) END
+                )::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        """),
+    ] + [
+        SQL(f"""
+            DROP TRIGGER IF EXISTS {table}_change_feed ON {table};
+            CREATE TRIGGER {table}_change_feed
+                AFTER INSERT OR UPDATE OR DELETE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION notify_row_change('{table}');
+        """)
+        for table in ('inventory', 'sales', 'deliveries')
+    ]),
+    (14, 'order details view', [
+        # Serves the LATERAL lookup of each item's latest delivery
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS deliveries_item_id_date_idx "
+                     "ON deliveries (item_id, delivery_date DESC, delivery_id DESC);"),
+        # A plain view, so keyset predicates and LIMIT on order_id reach the orders index and the
+        # joins only run for the rows of the page
+        SQL("""
+            CREATE OR REPLACE VIEW order_details AS
+            SELECT o.order_id, o.order_date, o.customer_name, o.item_id, o.item_name, o.quantity, o.status,
+                   i.vendor_name, i.value AS unit_value,
+                   b.on_hand, b.on_hand - b.reserved AS available,
+                   d.delivery_id AS last_delivery_id, d.delivery_date AS last_delivery_date,
+                   d.quantity AS last_delivery_quantity
+            FROM orders o
+            LEFT JOIN inventory i ON i.item_id = o.item_id
+            LEFT JOIN stock_balances b ON b.item_id = o.item_id
+            LEFT JOIN LATERAL (
+                SELECT delivery_id, delivery_date, quantity
+                FROM deliveries
+                WHERE deliveries.item_id = o.item_id
+                ORDER BY delivery_date DESC, delivery_id DESC
+                LIMIT 1
+            ) d ON true;
+        """),
+    ]),
+    (15, 'row versions and delivery status', [
+        # Constant defaults, so adding the columns doesn't rewrite the tables. Existing deliveries were all
+        # counted into stock when recorded, so they start out delivered and balances stay as they are.
+        SQL("""
+            ALTER TABLE inventory ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+            ALTER TABLE deliveries ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+            ALTER TABLE deliveries ADD COLUMN IF NOT EXISTS status VARCHAR(16) NOT NULL DEFAULT 'delivered';
+        """),
+        AddConstraint('deliveries', 'deliveries_status_check',
+                      "CHECK (status IN ('pending', 'in_transit', 'delivered')) NOT VALID"),
+        SQL("ALTER TABLE deliveries VALIDATE CONSTRAINT deliveries_status_check;"),
+        # Every UPDATE bumps the version, whichever code path issues it, for optimistic checks in bulk_update.py
+        SQL("""
+            CREATE OR REPLACE FUNCTION bump_version() RETURNS trigger AS $$
+            BEGIN
+                NEW.version := OLD.version + 1;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+        """),
+    ] + [
+        SQL(f"""
+            DROP TRIGGER IF EXISTS {table}_version ON {table};
+            CREATE TRIGGER {table}_version BEFORE UPDATE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION bump_version();
+        """)
+        for table in ('inventory', 'deliveries')
+    ] + [
+        # Pending and in-transit deliveries aren't on hand yet
+        stock_movement_trigger('deliveries', "CASE WHEN ROW.status = 'delivered' THEN ROW.quantity ELSE 0 END"),
+    ]),
+    (16, 'inventory valuation snapshots', [
+        # A keyframe snapshot stores every item; the others only the items that changed (see valuation.py).
+        # No foreign key to inventory, so deleted items stay in history; a NULL quantity marks the deletion.
+        SQL("""
+            CREATE TABLE IF NOT EXISTS valuation_snapshots (
+                snapshot_id SERIAL PRIMARY KEY,
+                as_of DATE NOT NULL UNIQUE,
+                keyframe_id INTEGER NOT NULL,
+                items INTEGER NOT NULL,
+                total_quantity BIGINT NOT NULL,
+                total_value NUMERIC(16, 2) NOT NULL,
+                stored_items INTEGER NOT NULL,
+                taken_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            CREATE INDEX IF NOT EXISTS valuation_snapshots_keyframe_idx ON valuation_snapshots (keyframe_id);
+            CREATE TABLE IF NOT EXISTS valuation_snapshot_items (
+                snapshot_id INTEGER NOT NULL REFERENCES valuation_snapshots (snapshot_id) ON DELETE CASCADE,
+                item_id INTEGER NOT NULL,
+                quantity INTEGER,
+                unit_value NUMERIC(12, 2),
+                PRIMARY KEY (item_id, snapshot_id)
+            );
+            CREATE INDEX IF NOT EXISTS valuation_snapshot_items_snapshot_idx
+                ON valuation_snapshot_items (snapshot_id);
+        """),
+        # Movements since a snapshot are summed by date range
+        Concurrently("CREATE INDEX CONCURRENTLY IF NOT EXISTS inventory_inputs_input_date_idx "
+                     "ON inventory_inputs (input_date);"),
+    ]),
+    (17, 'utility job notifications', [
+        # Only queueing a job wakes the runner; cache_invalidation fires on every write to every table
+        SQL("""
+            CREATE OR REPLACE FUNCTION notify_utility_queued() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('utility_jobs', '');
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+
+            DROP TRIGGER IF EXISTS utilities_queued ON utilities;
+            CREATE TRIGGER utilities_queued AFTER INSERT ON utilities
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_utility_queued();
+        """),
+    ]),
+    (18, 'stock balance change feed', [
+        # Sales, deliveries and inputs only show up on the inventory page as on-hand changes
+        SQL("""
+            DROP TRIGGER IF EXISTS stock_balances_change_feed ON stock_balances;
+            CREATE TRIGGER stock_balances_change_feed
+                AFTER INSERT OR UPDATE OR DELETE ON stock_balances
+                FOR EACH ROW EXECUTE FUNCTION notify_row_change('stock_balances');
+        """),
+    ]),
+]
+
+
+def ensure_migrations_table(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+    conn.commit()
+
+
+def applied_versions(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT version FROM schema_migrations;")
+    versions = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    return versions
+
+
+def migrate(db_pool, target=None, batch_size=DEFAULT_BATCH_SIZE, log=print):
+    """Apply every pending migration up to ``target`` and return the versions applied.
+
+    Every step is idempotent, so a run interrupted halfway through a
+    migration simply picks up again the next time.
+    """
+    conn = db_pool.getconn()
+    applied = []
+    try:
+        cur = conn.cursor()
+        cur.execute(f"SET lock_timeout = '{LOCK_TIMEOUT}';")
+        conn.commit()
+        ensure_migrations_table(conn)
+        done = applied_versions(conn)
+
+        for version, name, steps in MIGRATIONS:
+            if version in done or (target is not None and version > target):
+                continue
+            log(f"Applying migration {version}: {name}")
+            for step in steps:
+                step.apply(conn, batch_size)
+            cur = conn.cursor()
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (version, name))
+            conn.commit()
+            applied.append(version)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        # The connection goes back to the pool, where request queries must not inherit the DDL lock timeout
+        db_pool.putconn(conn, close=not reset_lock_timeout(conn))
+    return applied
+
+
+def reset_lock_timeout(conn):
+    # False if the connection is unusable and should be closed instead of pooled
+    try:
+        conn.rollback()
+        conn.cursor().execute("RESET lock_timeout;")
+        conn.commit()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations")
+    parser.add_argument('--target', type=int, default=None, help="stop after this version")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--status', action='store_true', help="list migrations and exit")
+    args = parser.parse_args(argv)
+
+    db_pool = get_db_pool()
+    if args.status:
+        conn = db_pool.getconn()
+        try:
+            ensure_migrations_table(conn)
+            done = applied_versions(conn)
+        finally:
+            db_pool.putconn(conn)
+        for version, name, _ in MIGRATIONS:
+            print(f"{'x' if version in done else ' '} {version:3d} {name}")
+        return 0
+
+    applied = migrate(db_pool, args.target, args.batch_size)
+    print(f"Applied {len(applied)} migration(s)")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
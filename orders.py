@@ -1,80 +1,337 @@
+import logging
+import os
+import threading
 import psycopg2
 from psycopg2 import pool
+from pagination import DEFAULT_PAGE_SIZE, STREAM_CHUNK_SIZE, fetch_many, fetch_page, stream_rows
+from records import record_cursor
+from query_cache import cached, invalidates, query_cache
 
 
-class InventoryItems:
+RESERVATION_MINUTES = int(os.environ.get('ORDER_RESERVATION_MINUTES', 15))
+RELEASE_INTERVAL = float(os.environ.get('ORDER_RELEASE_INTERVAL', 30))  # seconds
+RELEASE_BATCH_SIZE = 500
+
+log = logging.getLogger('inventory.orders')
+
+
+class InsufficientStock(Exception):
+    pass
+
+
+class OrderNotFound(Exception):
+    pass
+
+
+# The statements are plain SQL with named parameters so the async API can run them too.
+# Inserting first makes a retried idempotency key a no-op before any stock is touched.
+INSERT_ORDER_SQL = """
+    INSERT INTO orders (order_date, customer_name, item_id, item_name, quantity, idempotency_key, reserved_until)
+    SELECT %(order_date)s, %(customer_name)s, item.item_id, item.item_name, %(quantity)s, %(idempotency_key)s,
+           now() + make_interval(mins => %(reservation_minutes)s)
+    FROM (
+        SELECT item_id, item_name FROM inventory
+        WHERE item_id = %(item_id)s::integer OR (%(item_id)s::integer IS NULL AND item_name = %(item_name)s)
+        ORDER BY item_id
+        LIMIT 1
+    ) item
+    ON CONFLICT (idempotency_key) DO NOTHING
+    RETURNING order_id, item_id;
+"""
+
+FIND_ORDER_SQL = "SELECT order_id, status FROM orders WHERE idempotency_key = %(idempotency_key)s;"
+
+# A conditional UPDATE: it only locks the one balance row, and only succeeds while enough stock is free
+RESERVE_STOCK_SQL = """
+    UPDATE stock_balances
+    SET reserved = reserved + %(quantity)s, updated_at = now()
+    WHERE item_id = %(item_id)s AND on_hand - reserved >= %(quantity)s;
+"""
+
+RELEASE_EXPIRED_SQL = """
+    WITH expired AS (
+        SELECT order_id FROM orders
+        WHERE status = 'reserved' AND reserved_until < now()
+        ORDER BY reserved_until
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    ), released AS (
+        UPDATE orders o SET status = 'expired'
+        FROM expired
+        WHERE o.order_id = expired.order_id
+        RETURNING o.item_id, o.quantity
+    ), totals AS (
+        SELECT item_id, sum(quantity) AS quantity FROM released WHERE item_id IS NOT NULL GROUP BY item_id
+    ), restored AS (
+        UPDATE stock_balances b
+        SET reserved = b.reserved - totals.quantity, updated_at = now()
+        FROM totals
+        WHERE b.item_id = totals.item_id
+    )
+    SELECT count(*) FROM released;
+"""
+
+
+def order_params(order_data):
+    # Normalize form/JSON input into the named parameters the order statements use
+    item_id = order_data.get('item_id') or None
+    return {
+        'order_date': order_data['order_date'],
+        'customer_name': order_data['customer_name'],
+        'item_id': int(item_id) if item_id is not None else None,
+        'item_name': order_data.get('item_name'),
+        'quantity': int(order_data['quantity']),
+        'idempotency_key': order_data.get('idempotency_key') or None,
+        'reservation_minutes': RESERVATION_MINUTES,
+    }
+
+
+class Orders:
+    """Order placement with stock reservation.
+
+    Placing an order reserves stock on the item's ``stock_balances`` row with
+    a conditional UPDATE, so concurrent orders for the same SKU only contend
+    on that row and never oversell. Reservations expire after
+    ``ORDER_RESERVATION_MINUTES`` unless confirmed; confirming turns the
+    reservation into a sale.
+    """
+
+    COLUMNS = ('order_id', 'order_date', 'customer_name', 'item_id', 'item_name', 'quantity', 'status')
+    SORTABLE_COLUMNS = ('order_date', 'customer_name', 'item_name', 'status')
+    FILTERABLE_COLUMNS = ('order_date', 'customer_name', 'item_name', 'status')
+    RECORD = 'OrderRecord'
+    ALIASES = (('id', 'order_id'), ('date', 'order_date'))
+    # The order_details view (migration 14): each order with its item, stock and the item's latest delivery
+    DETAIL_COLUMNS = COLUMNS + ('vendor_name', 'unit_value', 'on_hand', 'available',
+                                'last_delivery_id', 'last_delivery_date', 'last_delivery_quantity')
+    DETAIL_RECORD = 'OrderDetailRecord'
+
     def __init__(self, db_pool):
         self.db_pool = db_pool
 
-    def connect_to_database(self):
-        # Connection pooling handles connection creation
-        pass
-
-    def create_inventory_table(self):
+    def create_orders_table(self):
         conn = self.db_pool.getconn()
         try:
             cur = conn.cursor()
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS inventory (
-                    item_id SERIAL PRIMARY KEY,
+                CREATE TABLE IF NOT EXISTS orders (
+                    order_id SERIAL PRIMARY KEY,
+                    order_date DATE NOT NULL,
+                    customer_name VARCHAR(255) NOT NULL,
+                    item_id INTEGER REFERENCES inventory (item_id) ON DELETE SET NULL,
                     item_name VARCHAR(255) NOT NULL,
-                    vendor_name VARCHAR(255) NOT NULL,
-                    quantity INTEGER NOT NULL,
-                    value FLOAT NOT NULL
+                    quantity INTEGER NOT NULL CHECK (quantity > 0),
+                    status VARCHAR(16) NOT NULL DEFAULT 'reserved',
+                    idempotency_key VARCHAR(255) UNIQUE,
+                    reserved_until TIMESTAMPTZ,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
                 );
             """)
             conn.commit()
         finally:
             self.db_pool.putconn(conn)
 
-    def add_item(self, item_data):
+    @invalidates('orders', 'stock_balances')
+    def place_order(self, order_data):
+        """Reserve stock and record the order; returns the order id.
+
+        Replaying an ``idempotency_key`` returns the original order instead
+        of booking stock twice.
+        """
+        params = order_params(order_data)
+        if params['quantity'] <= 0:
+            raise ValueError("Quantity must be positive")
         conn = self.db_pool.getconn()
         try:
             cur = conn.cursor()
-            cur.execute("""
-                INSERT INTO inventory (item_name, vendor_name, quantity, value)
-                VALUES (%s, %s, %s, %s);
-            """, (item_data['item_name'], item_data['vendor_name'], item_data['quantity'], item_data['value']))
+            cur.execute(INSERT_ORDER_SQL, params)
+            row = cur.fetchone()
+            if row is None:
+                if params['idempotency_key']:
+                    cur.execute(FIND_ORDER_SQL, params)
+                    existing = cur.fetchone()
+                    if existing:
+                        conn.commit()
+                        return existing[0]
+                raise ValueError(f"Unknown item {params['item_id'] or params['item_name']}")
+
+            order_id, params['item_id'] = row
+            cur.execute(RESERVE_STOCK_SQL, params)
+            if cur.rowcount != 1:
+                raise InsufficientStock(f"Not enough stock to reserve {params['quantity']} units")
             conn.commit()
+            return order_id
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             self.db_pool.putconn(conn)
 
-    def get_inventory(self):
+    @invalidates('orders', 'sales', 'stock_balances')
+    def confirm_order(self, order_id, sale_date=None):
+        # Turn a live reservation into a sale at the item's current value
         conn = self.db_pool.getconn()
         try:
             cur = conn.cursor()
-            cur.execute("SELECT * FROM inventory;")
-            rows = cur.fetchall()
-            return rows
+            cur.execute("""
+                UPDATE orders SET status = 'confirmed', reserved_until = NULL
+                WHERE order_id = %s AND status = 'reserved'
+                RETURNING item_id, item_name, quantity;
+            """, (order_id,))
+            row = cur.fetchone()
+            if row is None:
+                raise OrderNotFound(f"Order {order_id} has no live reservation")
+            item_id, item_name, quantity = row
+            cur.execute("""
+                UPDATE stock_balances SET reserved = reserved - %s, updated_at = now() WHERE item_id = %s;
+            """, (quantity, item_id))
+            cur.execute("""
+                INSERT INTO sales (sale_date, item_id, item_name, quantity, price)
+                SELECT COALESCE(%s, current_date), item_id, item_name, %s, value
+                FROM inventory WHERE item_id = %s;
+            """, (sale_date, quantity, item_id))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             self.db_pool.putconn(conn)
 
-    def update_item(self, item_id, item_name, vendor_name, quantity, value):
+    @invalidates('orders', 'stock_balances')
+    def cancel_order(self, order_id):
         conn = self.db_pool.getconn()
         try:
             cur = conn.cursor()
             cur.execute("""
-                UPDATE inventory
-                SET item_name = %s, vendor_name = %s, quantity = %s, value = %s
-                WHERE item_id = %s;
-            """, (item_name, vendor_name, quantity, value, item_id))
+                UPDATE orders SET status = 'cancelled', reserved_until = NULL
+                WHERE order_id = %s AND status = 'reserved'
+                RETURNING item_id, quantity;
+            """, (order_id,))
+            row = cur.fetchone()
+            if row is None:
+                raise OrderNotFound(f"Order {order_id} has no live reservation")
+            cur.execute("""
+                UPDATE stock_balances SET reserved = reserved - %s, updated_at = now() WHERE item_id = %s;
+            """, (row[1], row[0]))
             conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             self.db_pool.putconn(conn)
 
-    def delete_item(self, item_id):
+    def release_expired(self, batch_size=RELEASE_BATCH_SIZE):
+        """Release reservations past their deadline; returns how many were released.
+
+        Rows are claimed with SKIP LOCKED, so several workers can run this at
+        once without waiting on each other or on orders being confirmed.
+        Cached order and balance reads are only dropped when something was
+        released, not on every reaper cycle.
+        """
+        released = 0
         conn = self.db_pool.getconn()
         try:
             cur = conn.cursor()
-            cur.execute("DELETE FROM inventory WHERE item_id = %s;", (item_id,))
-            conn.commit()
+            while True:
+                cur.execute(RELEASE_EXPIRED_SQL, (batch_size,))
+                count = cur.fetchone()[0]
+                conn.commit()
+                released += count
+                if count < batch_size:
+                    return released
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.db_pool.putconn(conn)
+            # Batches committed before a failure are released too
+            if released:
+                query_cache.invalidate('orders', 'stock_balances')
+
+    @cached('orders')
+    def get_orders(self, limit=DEFAULT_PAGE_SIZE):
+        # Most recent orders first
+        rows, _ = self.get_orders_page(limit=limit, descending=True)
+        return rows
+
+    @cached('orders')
+    def get_order(self, order_id):
+        conn = self.db_pool.getconn(readonly=True)
+        try:
+            cur = record_cursor(conn, self.RECORD, self.COLUMNS, self.ALIASES)
+            cur.execute(f"SELECT {', '.join(self.COLUMNS)} FROM orders WHERE order_id = %s;", (order_id,))
+            return cur.fetchone()
         finally:
             self.db_pool.putconn(conn)
 
+    @cached('orders')
+    def get_many(self, ids, columns=None):
+        # {order_id: row} for a batch of ids in one round trip
+        return fetch_many(self.db_pool, 'orders', 'order_id', columns or self.COLUMNS, ids, self.RECORD, self.ALIASES)
+
+    @cached('orders')
+    def get_orders_page(self, cursor=None, limit=DEFAULT_PAGE_SIZE, sort=None, descending=False, filters=None,
+                        columns=None):
+        return fetch_page(self.db_pool, 'orders', 'order_id', columns or self.COLUMNS, filters, sort, descending,
+                          cursor, limit, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS, self.RECORD, self.ALIASES)
+
+    def stream_orders(self, sort=None, descending=False, filters=None, chunk_size=STREAM_CHUNK_SIZE, columns=None):
+        return stream_rows(self.db_pool, 'orders', 'order_id', columns or self.COLUMNS, filters, sort, descending,
+                           chunk_size, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS, self.RECORD, self.ALIASES)
+
+    @cached('orders', 'inventory', 'stock_balances', 'deliveries')
+    def get_order_details_page(self, cursor=None, limit=DEFAULT_PAGE_SIZE, sort=None, descending=False, filters=None,
+                               columns=None):
+        # One keyset query for a page of orders joined to their item, stock and latest delivery
+        return fetch_page(self.db_pool, 'order_details', 'order_id', columns or self.DETAIL_COLUMNS, filters, sort,
+                          descending, cursor, limit, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS,
+                          self.DETAIL_RECORD, self.ALIASES)
+
+    def stream_order_details(self, sort=None, descending=False, filters=None, chunk_size=STREAM_CHUNK_SIZE,
+                             columns=None):
+        return stream_rows(self.db_pool, 'order_details', 'order_id', columns or self.DETAIL_COLUMNS, filters, sort,
+                           descending, chunk_size, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS,
+                           self.DETAIL_RECORD, self.ALIASES)
+
+
+class ReservationReaper:
+    """Background thread that periodically releases expired reservations in this process."""
+
+    def __init__(self, orders, interval=RELEASE_INTERVAL):
+        self.orders = orders
+        self.interval = interval
+        self.pid = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.start_lock = threading.Lock()
+
+    def ensure_running(self):
+        # Safe to call per request: starts one thread per process, including after a fork
+        if self.pid == os.getpid() and self.thread and self.thread.is_alive():
+            return
+        with self.start_lock:
+            if self.pid == os.getpid() and self.thread and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name='reservation-reaper', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                released = self.orders.release_expired()
+                if released:
+                    log.info("released %s expired reservations", released)
+            except Exception:
+                log.exception("releasing expired reservations failed")
+
 
-# Use the existing database connection pool from app.py
-from app import db_pool
+# Use the shared, lazily created database connection pool
+from database_utilities import get_db_pool
 
 
-# Initialize InventoryItems class with database connection pool
-inventory_items = InventoryItems(db_pool)
+# Initialize Orders class with database connection pool
+orders = Orders(get_db_pool())
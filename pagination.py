@@ -0,0 +1,165 @@
+import base64
+import json
+import uuid
+from records import record_cursor
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+STREAM_CHUNK_SIZE = 2000
+
+
+def clamp_limit(limit):
+    # Accept whatever came in on the query string and keep it in a sane range
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def encode_cursor(sort_value, row_id):
+    payload = json.dumps([None if sort_value is None else str(sort_value), row_id])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return sort_value, int(row_id)
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError("Invalid pagination cursor")
+
+
+def build_keyset_query(table, pk, columns, filters=None, sort=None, descending=False,
+                       cursor=None, limit=None, sortable=(), filterable=()):
+    """Build a keyset (seek) query over ``table``.
+
+    Rows are ordered by ``sort`` with the primary key as a tie breaker, and
+    ``cursor`` resumes after the last row of the previous page, so every page
+    is an index range scan instead of an OFFSET that re-reads earlier rows.
+    Only whitelisted column names are ever interpolated into the SQL.
+    """
+    sort = sort or pk
+    if sort != pk and sort not in sortable:
+        raise ValueError(f"Cannot sort {table} by {sort}")
+
+    direction = 'DESC' if descending else 'ASC'
+    comparison = '<' if descending else '>'
+    where = []
+    params = []
+
+    for column, value in (filters or {}).items():
+        if column not in filterable:
+            raise ValueError(f"Cannot filter {table} by {column}")
+        where.append(f"{column} = %s")
+        params.append(value)
+
+    if cursor:
+        sort_value, row_id = decode_cursor(cursor)
+        if sort == pk:
+            where.append(f"{pk} {comparison} %s")
+            params.append(row_id)
+        else:
+            where.append(f"({sort}, {pk}) {comparison} (%s, %s)")
+            params.extend([sort_value, row_id])
+
+    query = f"SELECT {', '.join(columns)} FROM {table}"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    if sort == pk:
+        query += f" ORDER BY {pk} {direction}"
+    else:
+        query += f" ORDER BY {sort} {direction}, {pk} {direction}"
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+
+    return query + ";", params
+
+
+def select_columns(columns, pk, sort):
+    # The primary key and sort column are needed to build the next cursor, so always fetch them
+    columns = tuple(columns)
+    for column in (pk, sort):
+        if column and column not in columns:
+            columns = (column,) + columns
+    return columns
+
+
+def fetch_page(db_pool, table, pk, columns, filters=None, sort=None, descending=False,
+               cursor=None, limit=DEFAULT_PAGE_SIZE, sortable=(), filterable=(), record=None, aliases=()):
+    """Return ``(rows, next_cursor)`` for one page; ``next_cursor`` is None on the last page.
+
+    With ``record`` set, rows come back as ``records.record_type(record, columns, aliases)``.
+    """
+    limit = clamp_limit(limit)
+    columns = select_columns(columns, pk, sort)
+    # Ask for one extra row so we know whether another page exists
+    query, params = build_keyset_query(table, pk, columns, filters, sort, descending,
+                                       cursor, limit + 1, sortable, filterable)
+    conn = db_pool.getconn(readonly=True)
+    try:
+        cur = record_cursor(conn, record, columns, aliases) if record else conn.cursor()
+        cur.execute(query, params)
+        rows = cur.fetchall()
+    finally:
+        db_pool.putconn(conn)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        sort_index = columns.index(sort or pk)
+        next_cursor = encode_cursor(last[sort_index], last[columns.index(pk)])
+    return rows, next_cursor
+
+
+def fetch_many(db_pool, table, pk, columns, ids, record=None, aliases=()):
+    """Return ``{id: row}`` for every row of ``table`` whose primary key is in ``ids``, in one query.
+
+    Ids with no row are simply absent, so callers can batch lookups that would
+    otherwise be one query per id.
+    """
+    ids = sorted({int(row_id) for row_id in ids})
+    if not ids:
+        return {}
+    columns = select_columns(columns, pk, None)
+    conn = db_pool.getconn(readonly=True)
+    try:
+        cur = record_cursor(conn, record, columns, aliases) if record else conn.cursor()
+        cur.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE {pk} = ANY(%s);", (ids,))
+        rows = cur.fetchall()
+    finally:
+        db_pool.putconn(conn)
+    key = columns.index(pk)
+    return {row[key]: row for row in rows}
+
+
+def stream_rows(db_pool, table, pk, columns, filters=None, sort=None, descending=False,
+                chunk_size=STREAM_CHUNK_SIZE, sortable=(), filterable=(), record=None, aliases=()):
+    """Yield every matching row through a server-side (named) cursor.
+
+    Rows are pulled from PostgreSQL ``chunk_size`` at a time, so memory stays
+    flat no matter how large the table is. The pooled connection is held until
+    the generator is exhausted or closed.
+    """
+    columns = select_columns(columns, pk, sort)
+    query, params = build_keyset_query(table, pk, columns, filters, sort, descending,
+                                       sortable=sortable, filterable=filterable)
+    conn = db_pool.getconn(readonly=True)
+    try:
+        cursor_name = f"stream_{table}_{uuid.uuid4().hex}"
+        if record:
+            cur = record_cursor(conn, record, columns, aliases, cursor_name)
+        else:
+            cur = conn.cursor(name=cursor_name)
+        cur.itersize = chunk_size
+        cur.execute(query, params)
+        for row in cur:
+            yield row
+        cur.close()
+    finally:
+        # Named cursors live inside a transaction; end it before handing the connection back
+        conn.rollback()
+        db_pool.putconn(conn)
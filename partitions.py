@@ -0,0 +1,446 @@
+import argparse
+import datetime
+import glob
+import gzip
+import os
+import re
+import time
+from database_utilities import get_db_pool
+from query_cache import INVALIDATION_CHANNEL, query_cache
+
+
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+# Months of history kept attached by the maintenance job; 0 keeps everything
+PARTITION_RETENTION_MONTHS = int(os.environ.get('PARTITION_RETENTION_MONTHS', 0))
+PARTITION_ARCHIVE_DIR = os.environ.get('PARTITION_ARCHIVE_DIR', 'archive')
+DEFAULT_BATCH_SIZE = 5000
+BATCH_PAUSE = 0.05
+# Set per transaction (SET LOCAL), so pooled connections go back without it
+LOCK_TIMEOUT = '5s'
+
+# Monthly range partitions on the date column. ``sign`` is the stock movement
+# of a row's quantity, carried forward in archived_movements when a partition
+# is archived so stock balances still rebuild correctly; ``counted`` limits
+# that to the rows that moved stock. ``definition`` is the current schema, so
+# a fresh database gets every column later migrations add (deliveries' status
+# and version, migration 15) and converting an older table copies into it.
+PARTITIONED_TABLES = {
+    'sales': {
+        'key': 'sale_date', 'pk': 'sale_id', 'sign': -1, 'counted': 'true',
+        'definition': """
+            sale_id INTEGER NOT NULL DEFAULT nextval('sales_sale_id_seq'),
+            sale_date DATE NOT NULL,
+            item_name VARCHAR(255) NOT NULL,
+            quantity INTEGER NOT NULL,
+            price NUMERIC(12, 2) NOT NULL,
+            item_id INTEGER REFERENCES inventory (item_id) ON DELETE SET NULL
+        """,
+        'indexes': ('sale_date', 'item_id'),
+    },
+    'deliveries': {
+        'key': 'delivery_date', 'pk': 'delivery_id', 'sign': 1, 'counted': "status = 'delivered'",
+        'definition': """
+            delivery_id INTEGER NOT NULL DEFAULT nextval('deliveries_delivery_id_seq'),
+            delivery_date DATE NOT NULL,
+            vendor_name VARCHAR(255) NOT NULL,
+            item_name VARCHAR(255) NOT NULL,
+            quantity INTEGER NOT NULL,
+            unit_price NUMERIC(12, 2) NOT NULL,
+            item_id INTEGER REFERENCES inventory (item_id) ON DELETE SET NULL,
+            version INTEGER NOT NULL DEFAULT 1,
+            status VARCHAR(16) NOT NULL DEFAULT 'delivered'
+                CONSTRAINT deliveries_status_check CHECK (status IN ('pending', 'in_transit', 'delivered'))
+        """,
+        'indexes': ('delivery_date', 'item_id', 'vendor_name'),
+    },
+}
+
+ARCHIVE_FILE = re.compile(r'^(?P<table>[a-z_]+)_(?P<year>\d{4})_(?P<month>\d{2})\.csv\.gz$')
+
+
+def month_start(day):
+    return datetime.date(day.year, day.month, 1)
+
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return datetime.date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_{month:%Y_%m}"
+
+
+def table_kind(cur, table):
+    # pg_class.relkind: 'r' plain table, 'p' partitioned table, None if missing
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (table,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def table_columns(cur, table):
+    # Current column names of ``table`` in order, including ones added after it was partitioned
+    cur.execute("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum;
+    """, (table,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def table_triggers(cur, table):
+    # [(name, CREATE TRIGGER statement)] for the user-defined triggers on ``table``
+    cur.execute("""
+        SELECT tgname, pg_get_triggerdef(oid) FROM pg_trigger
+        WHERE tgrelid = to_regclass(%s) AND NOT tgisinternal
+        ORDER BY tgname;
+    """, (table,))
+    return cur.fetchall()
+
+
+def create_partitioned_table(cur, table, name=None):
+    """Create ``table`` (or a new table ``name`` shaped like it) partitioned by month.
+
+    A DEFAULT partition catches rows outside every monthly range, so a write
+    never fails because maintenance has not created a month yet.
+    """
+    spec = PARTITIONED_TABLES[table]
+    name = name or table
+    cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {table}_{spec['pk']}_seq;")
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {name} (
+            {spec['definition']},
+            CONSTRAINT {table}_part_pkey PRIMARY KEY ({spec['pk']}, {spec['key']})
+        ) PARTITION BY RANGE ({spec['key']});
+    """)
+    # Indexes on the parent are created on every partition, including ones attached later
+    for column in spec['indexes']:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_{column}_part_idx ON {name} ({column});")
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {name} DEFAULT;")
+    if name == table:
+        cur.execute(f"ALTER SEQUENCE {table}_{spec['pk']}_seq OWNED BY {table}.{spec['pk']};")
+
+
+def create_like(cur, name, parent):
+    # A standalone table ready to ATTACH to ``parent``, which needs every CHECK constraint the parent has
+    # (deliveries_status_check); indexes and foreign keys come from the parent on attach
+    cur.execute(f"CREATE TABLE {name} (LIKE {parent} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);")
+
+
+def partition_month(table, name):
+    # The month a partition named by partition_name() holds, or None for the default partition
+    match = ARCHIVE_FILE.match(f"{name}.csv.gz")
+    if not match or match['table'] != table:
+        return None
+    return datetime.date(int(match['year']), int(match['month']), 1)
+
+
+def attach_month(cur, table, name, month, parent=None):
+    """Attach standalone table ``name`` as the partition of ``table`` for ``month``.
+
+    Rows for the month that already landed in the DEFAULT partition are moved
+    into it first. The default partition is detached for the move, which
+    drops its cloned triggers, so moving rows doesn't count as stock movement.
+    """
+    spec = PARTITIONED_TABLES[table]
+    parent = parent or table
+    start, end = month, add_months(month, 1)
+    default = f"{table}_default"
+    key, columns = spec['key'], ', '.join(table_columns(cur, default))
+    cur.execute(f"SELECT 1 FROM {default} WHERE {key} >= %s AND {key} < %s LIMIT 1;", (start, end))
+    if cur.fetchone() is None:
+        cur.execute(f"ALTER TABLE {parent} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s);", (start, end))
+        return
+    cur.execute(f"ALTER TABLE {parent} DETACH PARTITION {default};")
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM {default} WHERE {key} >= %s AND {key} < %s RETURNING {columns}
+        )
+        INSERT INTO {name} ({columns}) SELECT {columns} FROM moved;
+    """, (start, end))
+    cur.execute(f"ALTER TABLE {parent} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s);", (start, end))
+    cur.execute(f"ALTER TABLE {parent} ATTACH PARTITION {default} DEFAULT;")
+
+
+def ensure_partitions(conn, table, first_month=None, months_ahead=PARTITION_MONTHS_AHEAD, parent=None):
+    """Create any missing monthly partitions from ``first_month`` (default: this month) on.
+
+    ``parent`` names the partitioned table when it doesn't carry ``table``'s
+    name yet (during ``partition_table``). Returns the partitions created.
+    """
+    parent = parent or table
+    first_month = month_start(first_month or datetime.date.today())
+    last_month = add_months(month_start(datetime.date.today()), months_ahead)
+    created = []
+    cur = conn.cursor()
+    month = first_month
+    try:
+        while month <= last_month:
+            name = partition_name(table, month)
+            cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}';")
+            cur.execute("SELECT to_regclass(%s);", (name,))
+            if cur.fetchone()[0] is None:
+                create_like(cur, name, parent)
+                attach_month(cur, table, name, month, parent)
+                created.append(name)
+            conn.commit()
+            month = add_months(month, 1)
+    except Exception:
+        conn.rollback()
+        raise
+    return created
+
+
+def list_partitions(conn, table):
+    # [(partition name, bound expression)] for table's attached partitions
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+        ORDER BY c.relname;
+    """, (table,))
+    partitions = cur.fetchall()
+    conn.commit()
+    return partitions
+
+
+def partition_table(conn, table, batch_size=DEFAULT_BATCH_SIZE, log=print):
+    """Convert an existing ``table`` into a partitioned one without blocking writes for the copy.
+
+    Rows are copied into a new partitioned table in primary-key batches
+    while a trigger records every row touched meanwhile. The final swap
+    takes a brief exclusive lock, re-copies only those recorded rows and
+    renames the tables; the old table is kept as ``<table>_unpartitioned``.
+    Safe to re-run; on an already partitioned table it only adds partitions.
+    """
+    spec = PARTITIONED_TABLES[table]
+    pk, key = spec['pk'], spec['key']
+    new, changes = f"{table}_partitioned", f"{table}_partition_changes"
+    cur = conn.cursor()
+    kind = table_kind(cur, table)
+    conn.commit()
+    if kind == 'p':
+        ensure_partitions(conn, table)
+        return
+    if kind is None:
+        create_partitioned_table(cur, table)
+        conn.commit()
+        ensure_partitions(conn, table)
+        return
+
+    # Capture rows written during the copy before the copy starts
+    cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}';")
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {changes} ({pk} INTEGER NOT NULL);
+        CREATE OR REPLACE FUNCTION {changes}_capture() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO {changes} VALUES (OLD.{pk});
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO {changes} VALUES (NEW.{pk});
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS {changes}_capture ON {table};
+        CREATE TRIGGER {changes}_capture AFTER INSERT OR UPDATE OR DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {changes}_capture();
+    """)
+    create_partitioned_table(cur, table, new)
+    # Every column the live table has; ones it doesn't have yet take their defaults in the new table
+    columns = table_columns(cur, table)
+    missing = [column for column in columns if column not in table_columns(cur, new)]
+    if missing:
+        conn.rollback()
+        raise ValueError(f"{table} has columns the partitioned definition lacks: {', '.join(missing)}")
+    columns = ', '.join(columns)
+    cur.execute(f"SELECT min({pk}), max({pk}), min({key}) FROM {table};")
+    low, high, first_day = cur.fetchone()
+    conn.commit()
+    for name in ensure_partitions(conn, table, first_day, parent=new):
+        log(f"Created partition {name}")
+
+    # The new table gets the old one's triggers only at the swap, so copying is not a stock movement
+    if low is not None:
+        start = low - 1
+        while start < high:
+            cur.execute(f"""
+                INSERT INTO {new} ({columns})
+                SELECT {columns} FROM {table} WHERE {pk} > %s AND {pk} <= %s
+                ON CONFLICT DO NOTHING;
+            """, (start, start + batch_size))
+            conn.commit()
+            start += batch_size
+            log(f"Copied {table} rows up to {min(start, high)} of {high}")
+            time.sleep(BATCH_PAUSE)
+
+    try:
+        cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}';")
+        cur.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE;")
+        cur.execute(f"DELETE FROM {new} WHERE {pk} IN (SELECT {pk} FROM {changes});")
+        cur.execute(f"""
+            INSERT INTO {new} ({columns})
+            SELECT {columns} FROM {table} WHERE {pk} IN (SELECT {pk} FROM {changes});
+        """)
+        # Move every trigger the table has (item_id sync, stock movement, cache and change feed
+        # notifications, row versions) to the new table; the definitions name the table, not its oid
+        triggers = [(name, definition) for name, definition in table_triggers(cur, table)
+                    if name != f"{changes}_capture"]
+        cur.execute(f"DROP TRIGGER {changes}_capture ON {table};")
+        for name, _ in triggers:
+            cur.execute(f"DROP TRIGGER {name} ON {table};")
+        cur.execute(f"""
+            ALTER SEQUENCE {table}_{pk}_seq OWNED BY {new}.{pk};
+            ALTER TABLE {table} ALTER COLUMN {pk} DROP DEFAULT;
+            ALTER TABLE {table} RENAME TO {table}_unpartitioned;
+            ALTER TABLE {new} RENAME TO {table};
+        """)
+        for _, definition in triggers:
+            cur.execute(definition)
+        cur.execute(f"""
+            DROP TABLE {changes};
+            DROP FUNCTION {changes}_capture();
+        """)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    log(f"{table} is now partitioned by {key}; the old table is kept as {table}_unpartitioned")
+
+
+def notify_changed(cur, table):
+    # DETACH/ATTACH fire no triggers, so tell other workers' caches directly
+    cur.execute("SELECT pg_notify(%s, %s), pg_notify(%s, 'stock_balances');",
+                (INVALIDATION_CHANNEL, table, INVALIDATION_CHANNEL))
+
+
+def archive_partition(conn, table, month, directory=PARTITION_ARCHIVE_DIR):
+    """Detach one month of ``table`` into ``<directory>/<partition>.csv.gz`` and drop it.
+
+    The month's per-item stock movement is recorded in ``archived_movements``
+    so balances still reconcile. The file is fully written before the drop
+    commits, so a failure leaves the partition attached.
+    """
+    spec = PARTITIONED_TABLES[table]
+    name = partition_name(table, month_start(month))
+    path = os.path.join(directory, f"{name}.csv.gz")
+    os.makedirs(directory, exist_ok=True)
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}';")
+        cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name};")
+        cur.execute(f"""
+            INSERT INTO archived_movements (partition_name, item_id, quantity)
+            SELECT %s, item_id, sum({spec['sign']} * quantity)
+            FROM {name} WHERE item_id IS NOT NULL AND {spec['counted']}
+            GROUP BY item_id;
+        """, (name,))
+        columns = ', '.join(table_columns(cur, name))
+        with gzip.open(path, 'wt', encoding='utf-8', newline='') as archive:
+            cur.copy_expert(f"COPY {name} ({columns}) TO STDOUT WITH (FORMAT csv, HEADER)", archive)
+        with open(path, 'rb') as archive:
+            os.fsync(archive.fileno())
+        cur.execute(f"DROP TABLE {name};")
+        notify_changed(cur, table)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    query_cache.invalidate(table, 'stock_balances')
+    return path
+
+
+def restore_partition(conn, path):
+    # Reattach a month written by archive_partition; rows go back exactly as they were
+    match = ARCHIVE_FILE.match(os.path.basename(path))
+    if not match or match['table'] not in PARTITIONED_TABLES:
+        raise ValueError(f"{path} is not a partition archive")
+    table = match['table']
+    month = datetime.date(int(match['year']), int(match['month']), 1)
+    name = partition_name(table, month)
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}';")
+        create_like(cur, name, table)
+        with gzip.open(path, 'rt', encoding='utf-8', newline='') as archive:
+            header = archive.readline().strip()
+            cur.copy_expert(f"COPY {name} ({header}) FROM STDIN WITH (FORMAT csv)", archive)
+        attach_month(cur, table, name, month)
+        cur.execute("DELETE FROM archived_movements WHERE partition_name = %s;", (name,))
+        notify_changed(cur, table)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    query_cache.invalidate(table, 'stock_balances')
+    return name
+
+
+def maintain_partitions(conn, retention_months=PARTITION_RETENTION_MONTHS, directory=PARTITION_ARCHIVE_DIR):
+    """Create upcoming months and, with a retention set, archive months past it."""
+    done = []
+    for table in PARTITIONED_TABLES:
+        cur = conn.cursor()
+        kind = table_kind(cur, table)
+        conn.commit()
+        if kind != 'p':
+            continue
+        done += ensure_partitions(conn, table)
+        if retention_months:
+            cutoff = add_months(month_start(datetime.date.today()), -retention_months)
+            for name, _ in list_partitions(conn, table):
+                month = partition_month(table, name)
+                if month and month < cutoff:
+                    done.append(archive_partition(conn, table, month, directory))
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage sales and deliveries partitions")
+    commands = parser.add_subparsers(dest='command', required=True)
+    convert = commands.add_parser('convert', help="partition an existing table online")
+    convert.add_argument('table', choices=sorted(PARTITIONED_TABLES))
+    convert.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    commands.add_parser('maintain', help="create upcoming partitions and apply retention")
+    listing = commands.add_parser('list', help="show attached partitions and archive files")
+    listing.add_argument('table', choices=sorted(PARTITIONED_TABLES))
+    listing.add_argument('--dir', default=PARTITION_ARCHIVE_DIR)
+    archive = commands.add_parser('archive', help="archive every month before --before")
+    archive.add_argument('table', choices=sorted(PARTITIONED_TABLES))
+    archive.add_argument('--before', required=True, help="first month to keep, YYYY-MM")
+    archive.add_argument('--dir', default=PARTITION_ARCHIVE_DIR)
+    restore = commands.add_parser('restore', help="reattach archived months")
+    restore.add_argument('paths', nargs='+')
+    args = parser.parse_args(argv)
+
+    db_pool = get_db_pool()
+    conn = db_pool.getconn()
+    try:
+        if args.command == 'convert':
+            partition_table(conn, args.table, args.batch_size)
+        elif args.command == 'maintain':
+            for name in maintain_partitions(conn):
+                print(name)
+        elif args.command == 'list':
+            for name, bound in list_partitions(conn, args.table):
+                print(f"{name}  {bound}")
+            for path in sorted(glob.glob(os.path.join(args.dir, f"{args.table}_*.csv.gz"))):
+                print(f"{path}  (archived)")
+        elif args.command == 'archive':
+            cutoff = datetime.datetime.strptime(args.before, '%Y-%m').date()
+            for name, _ in list_partitions(conn, args.table):
+                month = partition_month(args.table, name)
+                if month and month < cutoff:
+                    print(archive_partition(conn, args.table, month, args.dir))
+        elif args.command == 'restore':
+            for path in args.paths:
+                print(f"Restored {restore_partition(conn, path)}")
+    finally:
+        db_pool.putconn(conn)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
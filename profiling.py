@@ -0,0 +1,207 @@
+import contextvars
+import cProfile
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+
+# Fraction of requests profiled at random; 0 leaves sampling off
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+# A request carrying this header set to PROFILE_TOKEN is always profiled and dumped;
+# without a token the header is ignored
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN') or None
+# Sampled requests at least this slow are written to PROFILE_DIR
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 1000))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+# Stack frames below this share of the request are left out of the collapsed stacks
+PROFILE_MIN_SHARE = 0.001
+
+log = logging.getLogger('inventory.profile')
+
+# The trace of the request being handled, if it was sampled
+_current_trace = contextvars.ContextVar('request_trace', default=None)
+
+# cProfile allows one active profiler per process from Python 3.12, and two at once would each see both threads'
+# calls before that, so only one sampled request is profiled at a time; others still get spans
+_profiler_lock = threading.Lock()
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def record_span(name, seconds):
+    # Called from the DB and template hooks; a dictionary lookup away from free when the request isn't sampled
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+class RequestTrace:
+    """Span totals and (optionally) a cProfile capture for one sampled request."""
+
+    def __init__(self, endpoint, forced):
+        self.endpoint = endpoint or 'unknown'
+        self.forced = forced
+        self.start = time.perf_counter()
+        self.spans = {}  # name -> [count, seconds]
+        self.profile = None
+        self.template_started = None
+
+    def add(self, name, seconds):
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [1, seconds]
+        else:
+            span[0] += 1
+            span[1] += seconds
+
+    def start_profile(self):
+        if not _profiler_lock.acquire(blocking=False):
+            return
+        self.profile = cProfile.Profile()
+        try:
+            self.profile.enable()
+        except ValueError:
+            # Another profiling tool (a debugger, coverage) owns the hook
+            self.profile = None
+            _profiler_lock.release()
+
+    def stop_profile(self):
+        if self.profile is None:
+            return
+        try:
+            self.profile.disable()
+        finally:
+            _profiler_lock.release()
+
+    def server_timing(self, total):
+        # Server-Timing header value, shown per request by browser devtools
+        entries = [f'{name};dur={seconds * 1000:.2f};desc="{count}x"'
+                   for name, (count, seconds) in sorted(self.spans.items())]
+        entries.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(entries)
+
+
+def frame_label(func):
+    # ';' separates frames in the collapsed format
+    filename, line, name = func
+    if filename == '~':
+        return name.replace(';', ',')  # built-ins, e.g. <method 'execute' of 'psycopg2.extensions.cursor' objects>
+    return f"{name} ({os.path.basename(filename)}:{line})".replace(';', ',')
+
+
+def collapsed_stacks(stats, min_share=PROFILE_MIN_SHARE):
+    """Turn cProfile stats into collapsed stacks (``a;b;c microseconds`` lines).
+
+    cProfile keeps caller -> callee totals rather than whole stacks, so a
+    function's time is split across its callers in proportion to the time
+    each call edge took. Flame graphs of the result (flamegraph.pl,
+    speedscope, inferno) are exact for code reached along one path and
+    approximate for shared helpers.
+    """
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    total = sum(tt for _, _, tt, _, _ in stats.values()) or 1.0
+    roots = [func for func, (_, _, _, _, callers) in stats.items() if not callers]
+    lines = {}
+
+    def walk(func, path, seconds):
+        cumulative = stats[func][3]
+        if seconds / total < min_share or cumulative <= 0:
+            return
+        share = min(seconds / cumulative, 1.0)
+        path = path + (frame_label(func),)
+        own = stats[func][2] * share
+        if own > 0:
+            key = ';'.join(path)
+            lines[key] = lines.get(key, 0.0) + own
+        for callee, edge_seconds in callees.get(func, ()):
+            if frame_label(callee) not in path:
+                walk(callee, path, edge_seconds * share)
+
+    for root in roots:
+        walk(root, (), stats[root][3])
+    return [f"{stack} {int(seconds * 1e6)}" for stack, seconds in sorted(lines.items()) if seconds >= 1e-6]
+
+
+class RequestProfiler:
+    """Opt-in per-request tracing for the Flask app.
+
+    A request is sampled at ``sample_rate`` or when it carries
+    ``PROFILE_HEADER: <token>``. Sampled requests time pool checkouts, SQL,
+    row conversion and template rendering, answer with a Server-Timing
+    header, and run under cProfile; slow ones (and every header-triggered
+    one) are dumped to ``directory`` as ``.folded`` collapsed stacks and a
+    ``.prof`` pstats file. When neither trigger is configured ``enabled`` is
+    false and the app skips every hook.
+    """
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE, token=PROFILE_TOKEN, slow_ms=PROFILE_SLOW_MS,
+                 directory=PROFILE_DIR):
+        self.sample_rate = sample_rate
+        self.token = token
+        self.slow_ms = slow_ms
+        self.directory = directory
+        self.enabled = sample_rate > 0 or token is not None
+        self.dumped = 0
+
+    def begin(self, endpoint, header=None):
+        forced = self.token is not None and header == self.token
+        if not forced and not (self.sample_rate > 0 and random.random() < self.sample_rate):
+            return None
+        trace = RequestTrace(endpoint, forced)
+        _current_trace.set(trace)
+        trace.start_profile()
+        return trace
+
+    def finish(self, response=None):
+        # After the view (and any template) ran: stop the profiler, add Server-Timing and dump if slow
+        trace = _current_trace.get()
+        if trace is None:
+            return response
+        _current_trace.set(None)
+        trace.stop_profile()
+        total = time.perf_counter() - trace.start
+        if response is not None:
+            response.headers['Server-Timing'] = trace.server_timing(total)
+        if trace.forced or total * 1000 >= self.slow_ms:
+            try:
+                self.dump(trace, total)
+            except OSError:
+                log.exception("could not write profile of %s", trace.endpoint)
+        return response
+
+    def template_started(self, *args, **kwargs):
+        # Flask before_render_template / template_rendered signal receivers
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.template_started = time.perf_counter()
+
+    def template_finished(self, *args, **kwargs):
+        trace = _current_trace.get()
+        if trace is not None and trace.template_started is not None:
+            trace.add('render', time.perf_counter() - trace.template_started)
+            trace.template_started = None
+
+    def dump(self, trace, total):
+        os.makedirs(self.directory, exist_ok=True)
+        endpoint = re.sub(r'[^\w.-]', '_', trace.endpoint)
+        base = os.path.join(self.directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{endpoint}-"
+                                            f"{total * 1000:.0f}ms")
+        spans = ', '.join(f"{name}={seconds * 1000:.1f}ms/{count}"
+                          for name, (count, seconds) in sorted(trace.spans.items()))
+        if trace.profile is not None:
+            stats = pstats.Stats(trace.profile)
+            with open(base + '.folded', 'w', encoding='utf-8') as folded:
+                folded.write('\n'.join(collapsed_stacks(stats.stats)) + '\n')
+            stats.dump_stats(base + '.prof')
+        self.dumped += 1
+        log.warning("profiled %s in %.1f ms (%s) -> %s", trace.endpoint, total * 1000, spans, base)
@@ -0,0 +1,243 @@
+import functools
+import logging
+import os
+import select
+import sys
+import threading
+import time
+from collections import OrderedDict
+import psycopg2
+from database_utilities import mark_write, reading_own_writes, replica_reads
+
+
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', '1') == '1'
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 30))  # seconds
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1024))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# Channel the table triggers from migration 7 notify on, with the table name as payload
+INVALIDATION_CHANNEL = 'cache_invalidation'
+
+log = logging.getLogger('inventory.cache')
+
+
+def estimate_size(value):
+    # Rough in-memory size of a cached result (lists/tuples of rows, dicts, scalars)
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(estimate_size(v) for v in value)
+    return size
+
+
+def freeze(value):
+    # Make call arguments hashable so they can be part of a cache key
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, set)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class QueryCache:
+    """In-process LRU cache for read results, bounded by entry count, bytes and TTL.
+
+    Every entry is tagged with the tables it was read from; a write to any of
+    those tables drops the entry.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires_at, size, tables, value)
+        self.by_table = {}
+        self.bytes = 0
+        # Bumped on every invalidation so a read that raced a write is not stored
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[3]
+
+    def generation(self, tables):
+        with self.lock:
+            return tuple(self.generations.get(table, 0) for table in tables)
+
+    def put(self, key, tables, value, generation):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if generation != tuple(self.generations.get(table, 0) for table in tables):
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, size, tables, value)
+            self.bytes += size
+            for table in tables:
+                self.by_table.setdefault(table, set()).add(key)
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tables):
+        with self.lock:
+            for table in tables:
+                self.generations[table] = self.generations.get(table, 0) + 1
+                for key in list(self.by_table.pop(table, ())):
+                    if key in self.entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            for table in set(self.by_table) | set(self.generations):
+                self.generations[table] = self.generations.get(table, 0) + 1
+            self.entries.clear()
+            self.by_table.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        _, size, tables, _ = self.entries.pop(key)
+        self.bytes -= size
+        for table in tables:
+            keys = self.by_table.get(table)
+            if keys:
+                keys.discard(key)
+
+    def render_prometheus(self):
+        with self.lock:
+            return '\n'.join([
+                '# HELP inventory_cache_hits_total Reads served from the query cache.',
+                '# TYPE inventory_cache_hits_total counter',
+                f'inventory_cache_hits_total {self.hits}',
+                '# HELP inventory_cache_misses_total Reads that went to the database.',
+                '# TYPE inventory_cache_misses_total counter',
+                f'inventory_cache_misses_total {self.misses}',
+                '# HELP inventory_cache_evictions_total Entries evicted by the size bounds.',
+                '# TYPE inventory_cache_evictions_total counter',
+                f'inventory_cache_evictions_total {self.evictions}',
+                '# HELP inventory_cache_invalidations_total Entries dropped because a table was written.',
+                '# TYPE inventory_cache_invalidations_total counter',
+                f'inventory_cache_invalidations_total {self.invalidations}',
+                '# HELP inventory_cache_entries Entries currently cached.',
+                '# TYPE inventory_cache_entries gauge',
+                f'inventory_cache_entries {len(self.entries)}',
+                '# HELP inventory_cache_bytes Estimated size of cached results.',
+                '# TYPE inventory_cache_bytes gauge',
+                f'inventory_cache_bytes {self.bytes}',
+            ]) + '\n'
+
+
+query_cache = QueryCache()
+
+
+def cached(*tables):
+    """Read-through caching for a table class method whose result depends on ``tables``.
+
+    A session that just wrote (see database_utilities.mark_write) bypasses
+    the cache both ways, since entries may predate its write. Results read
+    from the replica are never stored: they can lag a write whose
+    invalidation already happened, and would then outlive it under the new
+    generation.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not CACHE_ENABLED or reading_own_writes():
+                return method(self, *args, **kwargs)
+            key = (type(self).__name__, method.__name__, freeze(args), freeze(kwargs))
+            hit, value = query_cache.get(key)
+            if hit:
+                return value
+            generation = query_cache.generation(tables)
+            replica_reads_before = replica_reads()
+            value = method(self, *args, **kwargs)
+            if replica_reads() == replica_reads_before:
+                query_cache.put(key, tables, value, generation)
+            return value
+        return wrapper
+    return decorator
+
+
+def invalidates(*tables):
+    # Drop cached reads of ``tables`` once a write method has committed, and send
+    # this session's next reads to the primary so they see the write
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            result = method(self, *args, **kwargs)
+            query_cache.invalidate(*tables)
+            mark_write()
+            return result
+        return wrapper
+    return decorator
+
+
+class CacheInvalidationListener:
+    """Background LISTEN on the invalidation channel for this worker.
+
+    Other workers' writes reach this process as notifications from the table
+    triggers. If the listening connection drops, notifications may have been
+    missed, so the whole cache is cleared before listening again.
+    """
+
+    def __init__(self, cache, connect_kwargs, poll_interval=5.0):
+        self.cache = cache
+        self.connect_kwargs = connect_kwargs
+        self.poll_interval = poll_interval
+        self.pid = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def ensure_running(self):
+        # Safe to call per request: starts one thread per process, including after a fork
+        if self.pid == os.getpid() and self.thread and self.thread.is_alive():
+            return
+        with self.start_lock:
+            if self.pid == os.getpid() and self.thread and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name='cache-invalidation', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        backoff = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.connect_kwargs)
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {INVALIDATION_CHANNEL};")
+                self.cache.clear()
+                backoff = 1
+                while True:
+                    if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                        continue
+                    conn.poll()
+                    tables = {notify.payload for notify in conn.notifies}
+                    conn.notifies.clear()
+                    if tables:
+                        self.cache.invalidate(*tables)
+            except Exception:
+                log.exception("cache invalidation listener failed, reconnecting in %ss", backoff)
+                if conn is not None:
+                    conn.close()
+                self.cache.clear()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
@@ -0,0 +1,69 @@
+import functools
+import operator
+import time
+from collections import namedtuple
+from db_metrics import InstrumentedCursor
+from profiling import current_trace, record_span
+
+
+@functools.lru_cache(maxsize=None)
+def record_type(name, columns, aliases=()):
+    """Return a compact row type for ``columns`` of a table.
+
+    Rows are namedtuples (``__slots__ = ()``, no per-row dict), and
+    ``aliases`` adds read-only properties like ``id`` for ``item_id`` that the
+    templates use. Types are cached, so every query over the same column
+    list shares one class.
+    """
+    base = namedtuple(name, columns)
+    namespace = {'__slots__': ()}
+    for alias, column in aliases:
+        if column in columns and alias not in columns:
+            namespace[alias] = property(operator.itemgetter(columns.index(column)))
+    return type(name, (base,), namespace)
+
+
+class RecordCursor(InstrumentedCursor):
+    # Cursor that hands back rows as ``self.record`` instances instead of plain tuples
+    record = None
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is None or self.record is None:
+            return row
+        return self.record._make(row)
+
+    def fetchmany(self, size=None):
+        return self.fetch_records(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self.fetch_records(super().fetchall)
+
+    def fetch_records(self, fetch, *args):
+        if self.record is None:
+            return fetch(*args)
+        if current_trace() is None:
+            return list(map(self.record._make, fetch(*args)))
+        # A profiled request sees fetching (network, parsing) and building records as separate spans
+        start = time.perf_counter()
+        rows = fetch(*args)
+        fetched = time.perf_counter()
+        records = list(map(self.record._make, rows))
+        record_span('fetch', fetched - start)
+        record_span('rows', time.perf_counter() - fetched)
+        return records
+
+    def __iter__(self):
+        # Batch through fetchmany so named (server-side) cursors still pull itersize rows per round trip
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+
+def record_cursor(conn, name, columns, aliases=(), cursor_name=None):
+    # Open a cursor whose rows come back as record_type(name, columns, aliases)
+    cur = conn.cursor(name=cursor_name, cursor_factory=RecordCursor)
+    cur.record = record_type(name, tuple(columns), tuple(aliases))
+    return cur
@@ -0,0 +1,172 @@
+import numpy as np
+from query_cache import cached
+
+
+PERIODS = ('day', 'week', 'month')
+DEFAULT_PERCENTILES = (50, 90, 99)
+# Rows converted to column values per fetchmany round
+FETCH_BATCH_ROWS = 10000
+
+
+def fetch_columns(cur, types):
+    """Read a result set straight into one NumPy array per column.
+
+    ``types`` maps column name to dtype (``object`` for labels and dates).
+    The arrays are sized from the cursor's row count up front and filled
+    ``FETCH_BATCH_ROWS`` rows at a time, so only one batch of row tuples is
+    alive at once rather than a list of every row. The raw result is still
+    held by libpq, so this needs a client-side cursor (whose row count is
+    known after ``execute``).
+    """
+    total = cur.rowcount
+    if total < 0:
+        raise ValueError("fetch_columns needs a client-side cursor with a known row count")
+    columns = {name: np.empty(total, dtype=dtype) for name, dtype in types}
+    filled = 0
+    while filled < total:
+        rows = cur.fetchmany(FETCH_BATCH_ROWS)
+        if not rows:
+            break
+        end = filled + len(rows)
+        for index, (name, dtype) in enumerate(types):
+            if dtype is object:
+                columns[name][filled:end] = [row[index] for row in rows]
+            else:
+                columns[name][filled:end] = np.fromiter((row[index] for row in rows), dtype=dtype, count=len(rows))
+        filled = end
+    return columns
+
+
+def moving_average(values, window):
+    # Trailing moving average via a cumulative sum; the first window-1 points are NaN
+    result = np.full(values.shape, np.nan)
+    if window < 1 or len(values) < window:
+        return result
+    totals = np.cumsum(np.concatenate(([0.0], values)))
+    result[window - 1:] = (totals[window:] - totals[:-window]) / window
+    return result
+
+
+def percentiles(values, points=DEFAULT_PERCENTILES):
+    if not len(values):
+        return {f"p{point}": None for point in points}
+    return {f"p{point}": float(value) for point, value in zip(points, np.percentile(values, points))}
+
+
+def to_json(values):
+    # NumPy arrays to JSON-safe lists (NaN becomes null)
+    if values.dtype == object:
+        return [str(value) for value in values]
+    return [None if np.isnan(value) else float(value) for value in values.astype(float)]
+
+
+class Reports:
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
+
+    @cached('sales')
+    def revenue(self, period='day', start=None, end=None, window=7):
+        """Revenue and units per day/week/month, gaps filled with zero.
+
+        Grouping runs in PostgreSQL; the moving average and percentiles of
+        period revenue are computed over the returned columns with NumPy.
+        """
+        if period not in PERIODS:
+            raise ValueError(f"period must be one of {', '.join(PERIODS)}")
+        conn = self.db_pool.getconn(readonly=True)
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                WITH bounds AS (
+                    SELECT date_trunc(%(period)s, COALESCE(%(start)s::date, min(sale_date)))::date AS first_period,
+                           COALESCE(%(end)s::date, max(sale_date)) AS last_day
+                    FROM sales
+                ), totals AS (
+                    SELECT date_trunc(%(period)s, sale_date)::date AS period,
+                           sum(quantity * price)::float8 AS revenue,
+                           sum(quantity)::float8 AS units
+                    FROM sales, bounds
+                    WHERE sale_date >= bounds.first_period AND sale_date <= bounds.last_day
+                    GROUP BY 1
+                )
+                SELECT periods.period::date, COALESCE(totals.revenue, 0), COALESCE(totals.units, 0)
+                FROM bounds,
+                     generate_series(bounds.first_period, bounds.last_day, ('1 ' || %(period)s)::interval)
+                         AS periods (period)
+                LEFT JOIN totals ON totals.period = periods.period::date
+                ORDER BY 1;
+            """, {'period': period, 'start': start, 'end': end})
+            columns = fetch_columns(cur, [('period', object), ('revenue', np.float64), ('units', np.float64)])
+        finally:
+            self.db_pool.putconn(conn)
+
+        revenue = columns['revenue']
+        return {
+            'period': period,
+            'periods': to_json(columns['period']),
+            'revenue': to_json(revenue),
+            'units': to_json(columns['units']),
+            'moving_average': to_json(moving_average(revenue, int(window))),
+            'total_revenue': float(revenue.sum()),
+            'revenue_percentiles': percentiles(revenue),
+        }
+
+    @cached('sales')
+    def units_by_item(self, start=None, end=None, limit=100):
+        conn = self.db_pool.getconn(readonly=True)
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT item_name, sum(quantity)::float8 AS units, sum(quantity * price)::float8 AS revenue
+                FROM sales
+                WHERE (%(start)s::date IS NULL OR sale_date >= %(start)s::date)
+                  AND (%(end)s::date IS NULL OR sale_date <= %(end)s::date)
+                GROUP BY item_name
+                ORDER BY units DESC;
+            """, {'start': start, 'end': end})
+            columns = fetch_columns(cur, [('item_name', object), ('units', np.float64), ('revenue', np.float64)])
+        finally:
+            self.db_pool.putconn(conn)
+
+        units = columns['units']
+        total_units = units.sum()
+        share = units / total_units if total_units else np.zeros_like(units)
+        limit = int(limit)
+        return {
+            'items': [
+                {'item_name': name, 'units': float(u), 'revenue': float(r), 'share': float(s)}
+                for name, u, r, s in zip(columns['item_name'][:limit], units[:limit],
+                                         columns['revenue'][:limit], share[:limit])
+            ],
+            'item_count': int(len(units)),
+            'total_units': float(total_units),
+            'units_percentiles': percentiles(units),
+        }
+
+    @cached('inventory')
+    def inventory_value_by_vendor(self):
+        conn = self.db_pool.getconn(readonly=True)
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT vendor_name, count(*)::float8 AS items, sum(quantity)::float8 AS units,
+                       sum(value * quantity)::float8 AS total_value
+                FROM inventory
+                GROUP BY vendor_name
+                ORDER BY total_value DESC;
+            """)
+            columns = fetch_columns(cur, [('vendor_name', object), ('items', np.float64),
+                                          ('units', np.float64), ('total_value', np.float64)])
+        finally:
+            self.db_pool.putconn(conn)
+
+        total_value = columns['total_value'].sum()
+        return {
+            'vendors': [
+                {'vendor_name': name, 'items': int(i), 'units': float(u), 'total_value': float(v)}
+                for name, i, u, v in zip(columns['vendor_name'], columns['items'],
+                                         columns['units'], columns['total_value'])
+            ],
+            'total_value': float(total_value),
+            'value_percentiles': percentiles(columns['total_value']),
+        }
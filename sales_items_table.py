@@ -1,28 +1,30 @@
 import psycopg2
 from psycopg2 import pool
+from pagination import DEFAULT_PAGE_SIZE, STREAM_CHUNK_SIZE, fetch_many, fetch_page, stream_rows
+from records import record_cursor
+from partitions import partition_table
+from query_cache import cached, invalidates
 
 
 class SalesItems:
+    COLUMNS = ('sale_id', 'sale_date', 'item_id', 'item_name', 'quantity', 'price')
+    SORTABLE_COLUMNS = ('sale_date', 'item_name', 'quantity', 'price')
+    FILTERABLE_COLUMNS = ('sale_date', 'item_name')
+    RECORD = 'SaleRecord'
+    ALIASES = (('id', 'sale_id'), ('date', 'sale_date'))
+
     def __init__(self, db_pool):
         self.db_pool = db_pool
 
     def create_sales_table(self):
+        # Partitioned by month with a DEFAULT partition; existing unpartitioned tables are converted online
         conn = self.db_pool.getconn()
         try:
-            cur = conn.cursor()
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS sales (
-                    sale_id SERIAL PRIMARY KEY,
-                    sale_date DATE NOT NULL,
-                    item_name VARCHAR(255) NOT NULL,
-                    quantity INTEGER NOT NULL,
-                    price FLOAT NOT NULL
-                );
-            """)
-            conn.commit()
+            partition_table(conn, 'sales')
         finally:
             self.db_pool.putconn(conn)
 
+    @invalidates('sales', 'stock_balances')
     def add_sale(self, sale_data):
         conn = self.db_pool.getconn()
         try:
@@ -35,16 +37,33 @@ class SalesItems:
         finally:
             self.db_pool.putconn(conn)
 
+    @cached('sales')
     def get_sales(self):
-        conn = self.db_pool.getconn()
+        conn = self.db_pool.getconn(readonly=True)
         try:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM sales;")
+            cur = record_cursor(conn, self.RECORD, self.COLUMNS, self.ALIASES)
+            cur.execute(f"SELECT {', '.join(self.COLUMNS)} FROM sales;")
             rows = cur.fetchall()
             return rows
         finally:
             self.db_pool.putconn(conn)
 
+    @cached('sales')
+    def get_many(self, ids, columns=None):
+        # {sale_id: row} for a batch of ids in one round trip
+        return fetch_many(self.db_pool, 'sales', 'sale_id', columns or self.COLUMNS, ids, self.RECORD, self.ALIASES)
+
+    @cached('sales')
+    def get_sales_page(self, cursor=None, limit=DEFAULT_PAGE_SIZE, sort=None, descending=False, filters=None,
+                       columns=None):
+        return fetch_page(self.db_pool, 'sales', 'sale_id', columns or self.COLUMNS, filters, sort, descending,
+                          cursor, limit, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS, self.RECORD, self.ALIASES)
+
+    def stream_sales(self, sort=None, descending=False, filters=None, chunk_size=STREAM_CHUNK_SIZE, columns=None):
+        return stream_rows(self.db_pool, 'sales', 'sale_id', columns or self.COLUMNS, filters, sort, descending,
+                           chunk_size, self.SORTABLE_COLUMNS, self.FILTERABLE_COLUMNS, self.RECORD, self.ALIASES)
+
+    @invalidates('sales', 'stock_balances')
     def update_sale(self, sale_id, sale_date, item_name, quantity, price):
         conn = self.db_pool.getconn()
         try:
@@ -58,6 +77,7 @@ class SalesItems:
         finally:
             self.db_pool.putconn(conn)
 
+    @invalidates('sales', 'stock_balances')
     def delete_sale(self, sale_id):
         conn = self.db_pool.getconn()
         try:
@@ -68,9 +88,9 @@ class SalesItems:
             self.db_pool.putconn(conn)
 
 
-# Use the existing database connection pool from app.py
-from app import db_pool
+# Use the shared, lazily created database connection pool
+from database_utilities import get_db_pool
 
 
 # Initialize SalesItems class with database connection pool
-sales_items = SalesItems(db_pool)
+sales_items = SalesItems(get_db_pool())
@@ -0,0 +1,147 @@
+import argparse
+from psycopg2 import extensions
+from change_feed import publish_reload
+from database_utilities import get_db_pool
+from query_cache import cached, query_cache
+
+
+# Every stock movement still in the live tables as (item_id, signed quantity);
+# the counted inventory.quantity is the baseline and a delivery counts once it is delivered
+HISTORY_MOVEMENTS_SQL = """
+    SELECT item_id, quantity AS delta FROM inventory
+    UNION ALL
+    SELECT item_id, quantity FROM deliveries WHERE item_id IS NOT NULL AND status = 'delivered'
+    UNION ALL
+    SELECT item_id, -quantity FROM sales WHERE item_id IS NOT NULL
+    UNION ALL
+    SELECT item_id, CASE WHEN input_type = 'purchase' THEN quantity ELSE -quantity END
+    FROM inventory_inputs WHERE item_id IS NOT NULL
+"""
+
+# Migration 6 predates delivery status (migration 15), when every delivery counted
+UNTRACKED_MOVEMENTS_SQL = HISTORY_MOVEMENTS_SQL.replace(" AND status = 'delivered'", '')
+
+# Plus the per-item totals of sales/deliveries partitions moved to archive files (see partitions.py)
+MOVEMENTS_SQL = HISTORY_MOVEMENTS_SQL + """
+    UNION ALL
+    SELECT item_id, quantity FROM archived_movements
+"""
+
+DRIFT_SQL = f"""
+    WITH expected AS (
+        SELECT item_id, sum(delta)::INTEGER AS on_hand
+        FROM ({MOVEMENTS_SQL}) movements
+        GROUP BY item_id
+    )
+    SELECT item_id, COALESCE(e.on_hand, 0) AS expected, b.on_hand AS recorded
+    FROM expected e
+    FULL JOIN stock_balances b USING (item_id)
+    -- stock_apply skips zero deltas, so an item that never moved off 0 has no balance row
+    WHERE COALESCE(e.on_hand, 0) <> COALESCE(b.on_hand, 0)
+    ORDER BY item_id;
+"""
+
+def rebuild_sql(movements=MOVEMENTS_SQL):
+    # Migration 6 rebuilds from UNTRACKED_MOVEMENTS_SQL, since archived_movements and status come later
+    return f"""
+        INSERT INTO stock_balances (item_id, on_hand, updated_at)
+        SELECT item_id, sum(delta)::INTEGER, now()
+        FROM ({movements}) movements
+        WHERE item_id IN (SELECT item_id FROM inventory)
+        GROUP BY item_id
+        ON CONFLICT (item_id) DO UPDATE
+            SET on_hand = EXCLUDED.on_hand, updated_at = EXCLUDED.updated_at
+            WHERE stock_balances.on_hand IS DISTINCT FROM EXCLUDED.on_hand;
+    """
+
+
+REBUILD_SQL = rebuild_sql()
+
+
+class StockLedger:
+    """Per-item running on-hand balances.
+
+    ``stock_balances`` is maintained by triggers (see migration 6) in the same
+    transaction as each inventory, sale, delivery or input write, so reads
+    are a primary-key lookup rather than an aggregate over history.
+    """
+
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
+
+    @cached('stock_balances')
+    def get_balance(self, item_id):
+        conn = self.db_pool.getconn(readonly=True)
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT on_hand FROM stock_balances WHERE item_id = %s;", (item_id,))
+            row = cur.fetchone()
+            return row[0] if row else 0
+        finally:
+            self.db_pool.putconn(conn)
+
+    @cached('stock_balances')
+    def get_balances(self, item_ids):
+        # {item_id: on_hand} for a page of items in one round trip
+        item_ids = list(item_ids)
+        if not item_ids:
+            return {}
+        conn = self.db_pool.getconn(readonly=True)
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT item_id, on_hand FROM stock_balances WHERE item_id = ANY(%s);", (item_ids,))
+            return dict(cur.fetchall())
+        finally:
+            self.db_pool.putconn(conn)
+
+    def reconcile(self, repair=False):
+        """Rebuild balances from history in bulk and return the drift found.
+
+        Without ``repair`` this only reads, from one repeatable-read snapshot,
+        so the comparison is exact without blocking writers. With ``repair``
+        the ledger is locked against concurrent movements while the balances
+        are rewritten.
+        """
+        conn = self.db_pool.getconn()
+        try:
+            cur = conn.cursor()
+            if repair:
+                cur.execute("LOCK TABLE stock_balances IN EXCLUSIVE MODE;")
+            else:
+                conn.set_session(isolation_level=extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+            cur.execute(DRIFT_SQL)
+            drift = [{'item_id': item_id, 'expected': expected, 'recorded': recorded}
+                     for item_id, expected, recorded in cur.fetchall()]
+            if repair and drift:
+                cur.execute("SET LOCAL inventory.change_feed = 'off';")
+                cur.execute(REBUILD_SQL)
+                cur.execute("DELETE FROM stock_balances WHERE item_id NOT IN (SELECT item_id FROM inventory);")
+                publish_reload(cur, 'stock_balances')
+            conn.commit()
+            if repair and drift:
+                query_cache.invalidate('stock_balances')
+            return drift
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            if not repair:
+                conn.set_session(isolation_level=extensions.ISOLATION_LEVEL_DEFAULT, readonly='default')
+            self.db_pool.putconn(conn)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare stock balances against history")
+    parser.add_argument('--repair', action='store_true', help="rewrite balances that have drifted")
+    args = parser.parse_args(argv)
+
+    ledger = StockLedger(get_db_pool())
+    drift = ledger.reconcile(repair=args.repair)
+    for entry in drift:
+        print(f"item {entry['item_id']}: recorded {entry['recorded']}, expected {entry['expected']}")
+    print(f"{len(drift)} item(s) drifted{' and were repaired' if args.repair and drift else ''}")
+    return 1 if drift and not args.repair else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,55 @@
+import os
+import sys
+import uuid
+
+import psycopg2
+import pytest
+
+# The modules live at the repository root rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Tests using the ``database`` fixture run against this PostgreSQL (a libpq URL or DSN) and are
+# skipped without it; each gets a schema of its own, dropped afterwards
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+
+class SingleConnectionPool:
+    # Stands in for DatabaseConnectionPool: every checkout is the test's connection, kept in its schema
+    def __init__(self, conn):
+        self.conn = conn
+
+    def getconn(self, key=None, readonly=False):
+        return self.conn
+
+    def putconn(self, conn, key=None, close=False):
+        pass
+
+
+@pytest.fixture
+def database():
+    if not TEST_DATABASE_URL:
+        pytest.skip("set TEST_DATABASE_URL to run the PostgreSQL tests")
+    from query_cache import query_cache
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    cur = conn.cursor()
+    # public stays on the path for extensions (pg_trgm) installed there
+    cur.execute(f"CREATE SCHEMA {schema}; SET search_path = {schema}, public;")
+    conn.commit()
+    query_cache.clear()
+    try:
+        yield conn
+    finally:
+        query_cache.clear()
+        conn.rollback()
+        conn.autocommit = True
+        conn.cursor().execute(f"DROP SCHEMA {schema} CASCADE;")
+        conn.close()
+
+
+@pytest.fixture
+def migrated(database):
+    # The test schema with every migration applied
+    from migrations import migrate
+    migrate(SingleConnectionPool(database), log=lambda message: None)
+    return database
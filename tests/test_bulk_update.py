@@ -0,0 +1,81 @@
+import datetime
+
+import pytest
+
+from bulk_update import CONFLICT, NOT_FOUND, REJECTED, UPDATED, normalize_patches, patch_statement
+from conftest import SingleConnectionPool
+from deliveries import Deliveries
+from inventory_items_table import InventoryItems
+
+COLUMNS = InventoryItems.PATCHABLE_COLUMNS
+
+
+def test_patches_are_normalized_against_the_whitelist():
+    assert normalize_patches([{'item_id': '3', 'version': '2', 'value': 1.5}, {'item_id': 4, 'quantity': None}],
+                             'item_id', COLUMNS) == [(3, 2, {'value': 1.5}), (4, None, {'quantity': None})]
+    with pytest.raises(ValueError, match="needs a item_id"):
+        normalize_patches([{'value': 1.5}], 'item_id', COLUMNS)
+    with pytest.raises(ValueError, match="Cannot update item_id_old"):
+        normalize_patches([{'item_id': 1, 'item_id_old': 2}], 'item_id', COLUMNS)
+    with pytest.raises(ValueError, match="patched more than once"):
+        normalize_patches([{'item_id': 1, 'value': 1}, {'item_id': '1', 'quantity': 2}], 'item_id', COLUMNS)
+
+
+def test_columns_only_some_patches_set_travel_with_a_flag():
+    patches = normalize_patches([{'item_id': 1, 'value': 2.5, 'quantity': 4}, {'item_id': 2, 'value': 3.0}],
+                                'item_id', COLUMNS)
+    statement, template, names = patch_statement('inventory', 'item_id', COLUMNS, patches)
+    statement = ' '.join(statement.split())
+    assert names == ['id', 'version', 'set_quantity', 'quantity', 'value']
+    assert template == "(%s::integer, %s::integer, %s::boolean, %s::integer, %s::numeric)"
+    assert ("SET quantity = CASE WHEN v.set_quantity THEN v.quantity ELSE t.quantity END, value = v.value"
+            in statement)
+    assert "WHERE t.item_id = v.id AND (v.version IS NULL OR t.version = v.version) RETURNING" in statement
+
+
+def test_a_condition_guards_the_update_and_empty_patches_are_refused():
+    patches = normalize_patches([{'delivery_id': 1, 'status': 'delivered'}], 'delivery_id', {'status': 'varchar'})
+    statement, _, _ = patch_statement('deliveries', 'delivery_id', {'status': 'varchar'}, patches,
+                                      condition="t.status <> v.status")
+    assert "AND (t.status <> v.status)" in statement
+    with pytest.raises(ValueError, match="Nothing to update"):
+        patch_statement('inventory', 'item_id', COLUMNS, normalize_patches([{'item_id': 1}], 'item_id', COLUMNS))
+
+
+def test_bulk_update_reports_each_rows_outcome(migrated):
+    cur = migrated.cursor()
+    cur.execute("""
+        INSERT INTO inventory (item_name, vendor_name, quantity, value)
+        VALUES ('Widget', 'Acme', 10, 2.50), ('Sprocket', 'Acme', 5, 1.00)
+        RETURNING item_id;
+    """)
+    widget, sprocket = [row[0] for row in cur.fetchall()]
+    migrated.commit()
+    items = InventoryItems(SingleConnectionPool(migrated))
+    results = items.bulk_update([{'item_id': widget, 'version': 1, 'value': 2.75},
+                                 {'item_id': sprocket, 'version': 7, 'value': 1.25},
+                                 {'item_id': sprocket + 100, 'value': 9.99}])
+    assert results == [{'item_id': widget, 'outcome': UPDATED, 'version': 2},
+                       {'item_id': sprocket, 'outcome': CONFLICT, 'version': 1},
+                       {'item_id': sprocket + 100, 'outcome': NOT_FOUND, 'version': None}]
+    cur.execute("SELECT item_id, value::float8, quantity FROM inventory ORDER BY item_id;")
+    assert cur.fetchall() == [(widget, 2.75, 10), (sprocket, 1.0, 5)]
+
+
+def test_status_transitions_move_stock_once(migrated):
+    cur = migrated.cursor()
+    cur.execute("INSERT INTO inventory (item_name, vendor_name, quantity, value) "
+                "VALUES ('Widget', 'Acme', 10, 2.50) RETURNING item_id;")
+    item_id = cur.fetchone()[0]
+    cur.execute("""
+        INSERT INTO deliveries (delivery_date, vendor_name, item_name, quantity, unit_price, status)
+        VALUES (%s, 'Acme', 'Widget', 5, 2.00, 'pending'), (%s, 'Acme', 'Widget', 8, 2.00, 'delivered')
+        RETURNING delivery_id;
+    """, (datetime.date.today(), datetime.date.today()))
+    pending, delivered = [row[0] for row in cur.fetchall()]
+    migrated.commit()
+    results = Deliveries(SingleConnectionPool(migrated)).transition_status([
+        {'delivery_id': pending, 'status': 'delivered'}, {'delivery_id': delivered, 'status': 'pending'}])
+    assert [result['outcome'] for result in results] == [UPDATED, REJECTED]
+    cur.execute("SELECT on_hand FROM stock_balances WHERE item_id = %s;", (item_id,))
+    assert cur.fetchone() == (23,)
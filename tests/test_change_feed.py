@@ -0,0 +1,142 @@
+import json
+from collections import namedtuple
+
+from change_feed import ChangeFeed
+
+Notify = namedtuple('Notify', 'payload')
+
+
+def change(table, op='insert', **row):
+    return Notify(json.dumps({'table': table, 'op': op, 'row': row}))
+
+
+def events(chunk):
+    # [(id, event name, data)] from a chunk of SSE text
+    parsed = []
+    for block in chunk.strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n'))
+        parsed.append((fields['id'], fields['event'], fields['data']))
+    return parsed
+
+
+def feed(backlog=100):
+    # Never started: tests publish directly instead of through a LISTEN connection
+    return ChangeFeed({}, backlog=backlog)
+
+
+def test_live_events_are_numbered_by_epoch_and_sequence():
+    changes = feed()
+    stream = changes.subscribe(heartbeat=0.01)
+    assert next(stream) == "retry: 3000\n\n"
+    changes._publish([change('sales', sale_id=1), change('inventory', item_id=2)])
+    received = events(next(stream))
+    assert [(event_id, name) for event_id, name, _ in received] == [
+        (f"{changes.epoch}-1", 'change'), (f"{changes.epoch}-2", 'change')]
+    assert json.loads(received[0][2])['row'] == {'sale_id': 1}
+
+
+def test_idle_stream_sends_heartbeats():
+    stream = feed().subscribe(heartbeat=0.01)
+    next(stream)
+    assert next(stream) == ": keep-alive\n\n"
+
+
+def test_only_subscribed_tables_are_sent():
+    changes = feed()
+    stream = changes.subscribe(['sales'], heartbeat=0.01)
+    next(stream)
+    changes._publish([change('inventory'), change('sales'), change('deliveries')])
+    assert [event_id for event_id, _, _ in events(next(stream))] == [f"{changes.epoch}-2"]
+
+
+def test_resume_from_last_event_id_replays_the_backlog():
+    changes = feed()
+    changes._publish([change('sales', sale_id=n) for n in range(1, 4)])
+    stream = changes.subscribe(last_event_id=f"{changes.epoch}-1", heartbeat=0.01)
+    next(stream)
+    assert [event_id for event_id, _, _ in events(next(stream))] == [f"{changes.epoch}-2", f"{changes.epoch}-3"]
+
+
+def test_resume_from_another_epoch_reloads():
+    changes = feed()
+    changes._publish([change('sales')])
+    stream = changes.subscribe(last_event_id="deadbeef-1", heartbeat=0.01)
+    next(stream)
+    assert events(next(stream)) == [(f"{changes.epoch}-1", 'reload', '{"op": "reload"}')]
+
+
+def test_resume_from_a_future_position_reloads():
+    changes = feed()
+    stream = changes.subscribe(last_event_id=f"{changes.epoch}-5", heartbeat=0.01)
+    next(stream)
+    assert events(next(stream))[0][1] == 'reload'
+
+
+def test_client_that_fell_out_of_the_backlog_reloads_at_the_head():
+    changes = feed(backlog=2)
+    stream = changes.subscribe(heartbeat=0.01)
+    next(stream)
+    changes._publish([change('sales') for _ in range(5)])
+    assert events(next(stream)) == [(f"{changes.epoch}-5", 'reload', '{"op": "reload"}')]
+
+
+def test_reconnect_starts_a_new_epoch_and_reloads_subscribers():
+    changes = feed()
+    stream = changes.subscribe(heartbeat=0.01)
+    next(stream)
+    old_epoch = changes.epoch
+    changes._restart()
+    assert changes.epoch != old_epoch and changes.seq == 0 and not changes.events
+    assert events(next(stream)) == [(f"{changes.epoch}-0", 'reload', '{"op": "reload"}')]
+
+
+def test_bulk_reload_notifications_become_reload_events():
+    changes = feed()
+    stream = changes.subscribe(heartbeat=0.01)
+    next(stream)
+    changes._publish([Notify('not json'), Notify(json.dumps({'table': 'sales', 'op': 'reload'}))])
+    assert [(event_id, name) for event_id, name, _ in events(next(stream))] == [(f"{changes.epoch}-1", 'reload')]
+
+
+def test_subscriber_count_drops_when_the_stream_closes():
+    changes = feed()
+    stream = changes.subscribe()
+    next(stream)
+    assert changes.subscribers == 1
+    stream.close()
+    assert changes.subscribers == 0
+
+
+def test_each_process_starts_its_own_epoch(monkeypatch):
+    changes = feed()
+    monkeypatch.setattr(changes, '_run', lambda: None)
+    changes.ensure_running()
+    changes._publish([change('sales'), change('sales')])
+    started = changes.epoch
+    changes.ensure_running()
+    # Same process: the listener is restarted but positions stay valid
+    assert (changes.epoch, changes.seq) == (started, 2)
+
+    # A forked worker inherits the parent's state; its first start must invalidate the parent's event ids
+    monkeypatch.setattr(changes, 'pid', -1)
+    changes.ensure_running()
+    assert changes.epoch != started
+    assert changes.seq == 0 and not changes.events
+    stream = changes.subscribe(last_event_id=f"{started}-1", heartbeat=0.01)
+    next(stream)
+    assert events(next(stream)) == [(f"{changes.epoch}-0", 'reload', '{"op": "reload"}')]
+
+
+def test_stock_movements_publish_balance_changes(migrated):
+    cur = migrated.cursor()
+    cur.execute("INSERT INTO inventory (item_name, vendor_name, quantity, value) VALUES ('Widget', 'Acme', 10, 2);")
+    migrated.commit()
+    cur.execute("LISTEN row_changes;")
+    migrated.commit()
+    cur.execute("INSERT INTO sales (sale_date, item_name, quantity, price) VALUES (current_date, 'Widget', 4, 3);")
+    migrated.commit()
+    migrated.poll()
+    published = [json.loads(notify.payload) for notify in migrated.notifies]
+    assert [(change['table'], change['op']) for change in published] == [('sales', 'insert'),
+                                                                         ('stock_balances', 'update')]
+    assert published[1]['row']['on_hand'] == 6
@@ -0,0 +1,73 @@
+import threading
+import time
+
+from database_utilities import PRIORITY_READ, PRIORITY_REPORT, PRIORITY_WRITE, CheckoutQueue
+
+
+def waiting(queue, count):
+    # Block until ``count`` threads are queued
+    deadline = time.monotonic() + 5
+    while len(queue.waiters) < count:
+        assert time.monotonic() < deadline, "waiters never queued"
+        time.sleep(0.001)
+
+
+def test_free_slots_are_granted_immediately():
+    queue = CheckoutQueue(2)
+    assert queue.acquire(PRIORITY_READ, 0)
+    assert queue.acquire(PRIORITY_READ, 0)
+    assert not queue.acquire(PRIORITY_WRITE, 0)
+
+
+def test_timeout_when_nothing_is_released():
+    queue = CheckoutQueue(1)
+    queue.acquire(PRIORITY_READ, 0)
+    started = time.monotonic()
+    assert not queue.acquire(PRIORITY_READ, 0.05)
+    assert time.monotonic() - started >= 0.05
+
+
+def test_released_slot_goes_to_the_highest_priority_then_first_arrival():
+    queue = CheckoutQueue(1)
+    queue.acquire(PRIORITY_READ, 0)
+    granted = []
+    threads = []
+    for name, priority in (('report', PRIORITY_REPORT), ('read-1', PRIORITY_READ), ('write', PRIORITY_WRITE),
+                           ('read-2', PRIORITY_READ)):
+        thread = threading.Thread(target=lambda name=name, priority=priority: queue.acquire(priority, 5)
+                                  and granted.append(name))
+        thread.start()
+        threads.append(thread)
+        waiting(queue, len(threads))
+    for expected in range(1, len(threads) + 1):
+        queue.release()
+        deadline = time.monotonic() + 5
+        while len(granted) < expected:
+            assert time.monotonic() < deadline, "release granted nobody"
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join()
+    assert granted == ['write', 'read-1', 'read-2', 'report']
+
+
+def test_abandoned_waiters_are_skipped():
+    queue = CheckoutQueue(1)
+    queue.acquire(PRIORITY_READ, 0)
+    assert not queue.acquire(PRIORITY_WRITE, 0.01)
+    queue.release()
+    # The timed-out waiter didn't swallow the slot
+    assert queue.available == 1
+    assert queue.acquire(PRIORITY_REPORT, 0)
+
+
+def test_new_arrivals_do_not_jump_queued_waiters():
+    queue = CheckoutQueue(1)
+    queue.acquire(PRIORITY_READ, 0)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(queue.acquire(PRIORITY_REPORT, 5)))
+    thread.start()
+    waiting(queue, 1)
+    queue.release()
+    thread.join()
+    assert result == [True]
+    assert not queue.acquire(PRIORITY_WRITE, 0)
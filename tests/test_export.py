@@ -0,0 +1,45 @@
+import datetime
+
+import pytest
+
+from export import EXPORT_TARGETS, export_query
+
+
+def test_default_columns_and_no_filter():
+    query, params = export_query('inventory')
+    columns = ', '.join(EXPORT_TARGETS['inventory']['columns'])
+    assert query == f"COPY (SELECT {columns} FROM inventory) TO STDOUT WITH (FORMAT csv, HEADER)"
+    assert params == []
+
+
+def test_date_range_filters_the_date_column():
+    query, params = export_query('sales', ['sale_id', 'quantity'], '2024-01-01', datetime.date(2024, 2, 1))
+    assert query == ("COPY (SELECT sale_id, quantity FROM sales WHERE sale_date >= %s AND sale_date < %s) "
+                     "TO STDOUT WITH (FORMAT csv, HEADER)")
+    assert params == [datetime.date(2024, 1, 1), datetime.date(2024, 2, 1)]
+
+
+def test_open_ended_range():
+    query, params = export_query('deliveries', ['delivery_id'], end='2024-03-01')
+    assert "WHERE delivery_date < %s)" in query
+    assert params == [datetime.date(2024, 3, 1)]
+
+
+def test_unknown_table():
+    with pytest.raises(ValueError, match="not supported"):
+        export_query('utilities')
+
+
+def test_unknown_columns_are_rejected():
+    with pytest.raises(ValueError, match="Unknown column"):
+        export_query('sales', ['sale_id', 'sale_id) TO PROGRAM (rm'])
+
+
+def test_date_filter_on_a_table_without_dates():
+    with pytest.raises(ValueError, match="no date"):
+        export_query('inventory', start='2024-01-01')
+
+
+def test_malformed_date():
+    with pytest.raises(ValueError):
+        export_query('sales', start='January')
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+import forecasting
+from forecasting import SEASON_WEEKS, copy_numbers, forecast, seasonal_indexes
+
+
+def seasonal_history(weeks, items=1):
+    # Demand of 10 a week scaled by a yearly cycle, phase-locked to the calendar week
+    week = np.arange(weeks)
+    return np.tile(10 * (1 + 0.5 * np.sin(2 * np.pi * week / SEASON_WEEKS)), (items, 1))
+
+
+def forecast_all(weekly, lead_days=14.0):
+    items = weekly.shape[0]
+    return forecast(weekly, np.full(items, lead_days), np.zeros(items), np.zeros(items))
+
+
+def test_short_history_has_no_seasonality():
+    assert np.array_equal(seasonal_indexes(np.ones((3, SEASON_WEEKS + 10))), np.ones((3, SEASON_WEEKS)))
+
+
+def test_profile_index_zero_is_the_week_after_the_history(monkeypatch):
+    monkeypatch.setattr(forecasting, 'SEASONAL_SHRINKAGE', 0.0)
+    weeks = 2 * SEASON_WEEKS + 7
+    season = seasonal_indexes(seasonal_history(weeks))[0]
+    expected = 1 + 0.5 * np.sin(2 * np.pi * (weeks + np.arange(SEASON_WEEKS)) / SEASON_WEEKS)
+    assert np.allclose(season, expected)
+
+
+@pytest.mark.parametrize('extra_weeks', [0, 10, 30, 51])
+def test_recent_weeks_deseasonalize_to_a_flat_level(monkeypatch, extra_weeks):
+    # Whatever the history's length, a purely seasonal series has a constant underlying level
+    monkeypatch.setattr(forecasting, 'SEASONAL_SHRINKAGE', 0.0)
+    result = forecast_all(seasonal_history(2 * SEASON_WEEKS + extra_weeks))
+    assert result['weekly_demand'] == pytest.approx([10.0])
+    assert result['demand_std'] == pytest.approx([0.0], abs=1e-9)
+
+
+def test_horizon_follows_the_coming_weeks(monkeypatch):
+    monkeypatch.setattr(forecasting, 'SEASONAL_SHRINKAGE', 0.0)
+    weeks = 2 * SEASON_WEEKS + 10
+    result = forecast_all(seasonal_history(weeks))
+    coming = 10 * (1 + 0.5 * np.sin(2 * np.pi * (weeks + np.arange(forecasting.HORIZON_WEEKS)) / SEASON_WEEKS))
+    assert result['horizon_demand'] == pytest.approx([coming.sum()])
+
+
+def test_items_are_forecast_independently():
+    weekly = np.vstack([seasonal_history(3 * SEASON_WEEKS)[0], np.zeros(3 * SEASON_WEEKS)])
+    result = forecast_all(weekly)
+    assert result['weekly_demand'][1] == 0
+    assert result['order_quantity'][1] == 0
+    assert result['order_quantity'][0] > 0
+
+
+class CopyCursor:
+    # COPY TO STDOUT writes PostgreSQL's text format: tab-separated columns, one row per line
+    def __init__(self, text):
+        self.text = text
+
+    def mogrify(self, query, params):
+        return query.encode()
+
+    def copy_expert(self, sql, file):
+        file.write(self.text)
+
+
+def test_copy_numbers_parses_the_tab_separated_rows():
+    result = copy_numbers(CopyCursor("7\t0\t12\n7\t1\t3.5\n9\t155\t-2\n"), "SELECT 1", {}, 3)
+    assert result.dtype == np.float64
+    assert result.tolist() == [[7, 0, 12], [7, 1, 3.5], [9, 155, -2]]
+
+
+def test_copy_numbers_keeps_its_shape_for_one_or_no_rows():
+    assert copy_numbers(CopyCursor("7\t0\t12\n"), "SELECT 1", {}, 3).shape == (1, 3)
+    assert copy_numbers(CopyCursor(""), "SELECT 1", {}, 3).shape == (0, 3)
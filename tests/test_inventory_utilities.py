@@ -0,0 +1,28 @@
+import pytest
+
+from conftest import SingleConnectionPool
+from inventory_utilities import InventoryUtilities
+
+
+def test_update_rejects_an_invalid_job_before_touching_the_database():
+    utilities = InventoryUtilities(db_pool=None)
+    with pytest.raises(ValueError, match="Unknown utility"):
+        utilities.update_utility(1, 'defragment', '')
+    with pytest.raises(ValueError, match="JSON object"):
+        utilities.update_utility(1, 'recount', '[1, 2]')
+
+
+def test_only_queued_jobs_can_be_edited(migrated):
+    utilities = InventoryUtilities(SingleConnectionPool(migrated))
+    queued = utilities.run_utility({'utility_name': 'recount', 'parameters': ''})
+    utilities.update_utility(queued, 'revalue', '{"full": true}')
+    cur = migrated.cursor()
+    cur.execute("SELECT utility_name, parameters FROM utilities WHERE utility_id = %s;", (queued,))
+    assert cur.fetchone() == ('revalue', '{"full": true}')
+
+    cur.execute("UPDATE utilities SET status = 'running' WHERE utility_id = %s;", (queued,))
+    migrated.commit()
+    with pytest.raises(ValueError, match="not queued"):
+        utilities.update_utility(queued, 'purge', '')
+    cur.execute("SELECT utility_name FROM utilities WHERE utility_id = %s;", (queued,))
+    assert cur.fetchone() == ('revalue',)
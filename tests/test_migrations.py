@@ -0,0 +1,80 @@
+import decimal
+
+from conftest import SingleConnectionPool
+from inventory_items_table import InventoryItems
+from migrations import INDEX_STATEMENT, MIGRATIONS, drop_invalid_index, migrate
+
+
+class CatalogCursor:
+    # Answers the pg_index lookup with ``valid`` (None: no such index) and records what runs
+    def __init__(self, valid):
+        self.row = None if valid is None else (valid,)
+        self.statements = []
+
+    def execute(self, statement, params=None):
+        self.statements.append(' '.join(statement.split()))
+
+    def fetchone(self):
+        return self.row
+
+
+def quiet(message):
+    pass
+
+
+def test_versions_are_unique_and_in_order():
+    versions = [version for version, _, _ in MIGRATIONS]
+    assert versions == sorted(set(versions))
+
+
+def test_index_statements_split_for_partitions():
+    index = INDEX_STATEMENT.match("""
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS sales_item_id_idx ON sales (item_id) WHERE item_id > 0;""")
+    assert (index['head'], index['name'], index['table']) == ('CREATE UNIQUE INDEX', 'sales_item_id_idx', 'sales')
+    assert index['rest'] == " (item_id) WHERE item_id > 0;"
+    assert INDEX_STATEMENT.match("DROP INDEX CONCURRENTLY IF EXISTS sales_item_id_idx;") is None
+
+
+def test_only_invalid_indexes_are_dropped_before_a_rebuild():
+    for valid, dropped in ((False, True), (True, False), (None, False)):
+        cur = CatalogCursor(valid)
+        drop_invalid_index(cur, 'sales_item_id_idx')
+        assert ("DROP INDEX CONCURRENTLY IF EXISTS sales_item_id_idx;" in cur.statements) is dropped
+
+
+def test_migrate_applies_everything_once_and_resets_the_lock_timeout(database):
+    db_pool = SingleConnectionPool(database)
+    assert migrate(db_pool, log=quiet) == [version for version, _, _ in MIGRATIONS]
+    assert migrate(db_pool, log=quiet) == []
+    cur = database.cursor()
+    cur.execute("SHOW lock_timeout;")
+    assert cur.fetchone() == ('0',)
+
+
+def test_money_columns_round_to_the_cent(database):
+    db_pool = SingleConnectionPool(database)
+    migrate(db_pool, target=4, log=quiet)
+    cur = database.cursor()
+    cur.execute("INSERT INTO inventory (item_name, vendor_name, quantity, value) VALUES ('Widget', 'Acme', 1, 2.346);")
+    database.commit()
+    migrate(db_pool, log=quiet)
+    cur.execute("SELECT value FROM inventory;")
+    assert cur.fetchone() == (decimal.Decimal('2.35'),)
+
+
+def test_create_inventory_table_matches_the_migrated_schema(database):
+    InventoryItems(SingleConnectionPool(database)).create_inventory_table()
+    cur = database.cursor()
+    cur.execute("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'inventory'
+        ORDER BY ordinal_position;
+    """)
+    assert cur.fetchall() == [('item_id', 'integer'), ('item_name', 'character varying'),
+                              ('vendor_name', 'character varying'), ('quantity', 'integer'),
+                              ('value', 'numeric'), ('version', 'integer')]
+    # Migrating on top of it only adds what the DDL leaves to migrations
+    migrate(SingleConnectionPool(database), log=quiet)
+    cur.execute("INSERT INTO inventory (item_name, vendor_name, quantity, value) VALUES ('Widget', 'Acme', 1, 2.5) "
+                "RETURNING version;")
+    assert cur.fetchone() == (1,)
@@ -0,0 +1,65 @@
+import datetime
+
+import orders
+from conftest import SingleConnectionPool
+from orders import Orders
+
+
+class ReleaseCursor:
+    # Answers each RELEASE_EXPIRED_SQL batch with the next count
+    def __init__(self, counts):
+        self.counts = list(counts)
+
+    def execute(self, statement, params=None):
+        self.row = (self.counts.pop(0),)
+
+    def fetchone(self):
+        return self.row
+
+
+class ReleaseConnection:
+    def __init__(self, counts):
+        self.counts = counts
+
+    def cursor(self):
+        return ReleaseCursor(self.counts)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def release(monkeypatch, counts, batch_size):
+    invalidated = []
+    monkeypatch.setattr(orders.query_cache, 'invalidate', lambda *tables: invalidated.append(tables))
+    released = Orders(SingleConnectionPool(ReleaseConnection(counts))).release_expired(batch_size)
+    return released, invalidated
+
+
+def test_an_idle_reaper_cycle_keeps_the_cache(monkeypatch):
+    assert release(monkeypatch, [0], batch_size=2) == (0, [])
+
+
+def test_released_reservations_invalidate_orders_and_balances(monkeypatch):
+    assert release(monkeypatch, [2, 2, 1], batch_size=2) == (5, [('orders', 'stock_balances')])
+
+
+def test_expired_reservations_return_their_stock(migrated):
+    cur = migrated.cursor()
+    cur.execute("INSERT INTO inventory (item_name, vendor_name, quantity, value) "
+                "VALUES ('Widget', 'Acme', 10, 2.50) RETURNING item_id;")
+    item_id = cur.fetchone()[0]
+    migrated.commit()
+    book = Orders(SingleConnectionPool(migrated))
+    order_id = book.place_order({'order_date': datetime.date.today(), 'customer_name': 'Ada',
+                                 'item_id': item_id, 'quantity': 4})
+    assert book.release_expired() == 0
+
+    cur.execute("UPDATE orders SET reserved_until = now() - interval '1 minute' WHERE order_id = %s;", (order_id,))
+    migrated.commit()
+    assert book.release_expired() == 1
+    cur.execute("SELECT o.status, b.on_hand, b.reserved FROM orders o JOIN stock_balances b USING (item_id) "
+                "WHERE o.order_id = %s;", (order_id,))
+    assert cur.fetchone() == ('expired', 10, 0)
@@ -0,0 +1,63 @@
+import base64
+
+import pytest
+
+from pagination import MAX_PAGE_SIZE, DEFAULT_PAGE_SIZE, build_keyset_query, clamp_limit, decode_cursor, encode_cursor
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor('Widget', 42)) == ('Widget', 42)
+
+
+def test_cursor_keeps_null_sort_value_and_stringifies_others():
+    assert decode_cursor(encode_cursor(None, 7)) == (None, 7)
+    assert decode_cursor(encode_cursor(12.5, 7)) == ('12.5', 7)
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor('a/b+c?' * 10, 1)
+    assert all(char.isalnum() or char in '-_=' for char in cursor)
+
+
+@pytest.mark.parametrize('cursor', ['not base64!', base64.urlsafe_b64encode(b'{"a": 1}').decode(),
+                                    base64.urlsafe_b64encode(b'["x", "y"]').decode(), 'é'])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError, match="Invalid pagination cursor"):
+        decode_cursor(cursor)
+
+
+def test_clamp_limit():
+    assert clamp_limit(None) == DEFAULT_PAGE_SIZE
+    assert clamp_limit('abc') == DEFAULT_PAGE_SIZE
+    assert clamp_limit('0') == 1
+    assert clamp_limit(10 ** 6) == MAX_PAGE_SIZE
+
+
+def test_first_page_by_primary_key():
+    query, params = build_keyset_query('sales', 'sale_id', ('sale_id', 'quantity'), limit=50)
+    assert query == "SELECT sale_id, quantity FROM sales ORDER BY sale_id ASC LIMIT %s;"
+    assert params == [50]
+
+
+def test_cursor_on_primary_key_seeks_past_the_last_id():
+    query, params = build_keyset_query('sales', 'sale_id', ('sale_id',), cursor=encode_cursor(None, 99),
+                                       descending=True)
+    assert query == "SELECT sale_id FROM sales WHERE sale_id < %s ORDER BY sale_id DESC;"
+    assert params == [99]
+
+
+def test_cursor_on_sort_column_uses_row_comparison_with_pk_tie_breaker():
+    query, params = build_keyset_query('sales', 'sale_id', ('sale_id', 'sale_date'),
+                                       filters={'item_name': 'Widget'}, sort='sale_date',
+                                       cursor=encode_cursor('2024-01-31', 5), limit=10,
+                                       sortable=('sale_date',), filterable=('item_name',))
+    assert query == ("SELECT sale_id, sale_date FROM sales WHERE item_name = %s AND (sale_date, sale_id) > (%s, %s) "
+                     "ORDER BY sale_date ASC, sale_id ASC LIMIT %s;")
+    assert params == ['Widget', '2024-01-31', 5, 10]
+
+
+def test_only_whitelisted_columns_reach_the_sql():
+    with pytest.raises(ValueError, match="Cannot sort"):
+        build_keyset_query('sales', 'sale_id', ('sale_id',), sort='price; DROP TABLE sales')
+    with pytest.raises(ValueError, match="Cannot filter"):
+        build_keyset_query('sales', 'sale_id', ('sale_id',), filters={'1=1 OR item_name': 'x'})
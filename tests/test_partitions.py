@@ -0,0 +1,139 @@
+import datetime
+
+import psycopg2
+import pytest
+
+from partitions import (add_months, archive_partition, create_like, ensure_partitions, list_partitions, month_start,
+                        partition_month, partition_name, partition_table, restore_partition)
+
+
+class RecordingCursor:
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement, params=None):
+        self.statements.append(' '.join(statement.split()))
+
+
+def test_month_arithmetic():
+    assert month_start(datetime.date(2024, 2, 29)) == datetime.date(2024, 2, 1)
+    assert add_months(datetime.date(2024, 11, 1), 3) == datetime.date(2025, 2, 1)
+    assert add_months(datetime.date(2024, 1, 1), -1) == datetime.date(2023, 12, 1)
+
+
+def test_partition_names_round_trip():
+    name = partition_name('deliveries', datetime.date(2024, 3, 1))
+    assert name == 'deliveries_2024_03'
+    assert partition_month('deliveries', name) == datetime.date(2024, 3, 1)
+    assert partition_month('sales', name) is None
+    assert partition_month('deliveries', 'deliveries_default') is None
+
+
+def test_new_months_copy_the_parents_check_constraints():
+    # ATTACH PARTITION refuses a table missing one of the parent's CHECK constraints
+    cur = RecordingCursor()
+    create_like(cur, 'deliveries_2024_03', 'deliveries')
+    assert cur.statements == [
+        "CREATE TABLE deliveries_2024_03 (LIKE deliveries INCLUDING DEFAULTS INCLUDING CONSTRAINTS);"]
+
+
+def months(conn, table):
+    return {partition_month(table, name) for name, _ in list_partitions(conn, table)} - {None}
+
+
+def test_fresh_deliveries_table_gets_monthly_partitions_with_the_status_check(database):
+    cur = database.cursor()
+    cur.execute("CREATE TABLE inventory (item_id SERIAL PRIMARY KEY, item_name VARCHAR(255));")
+    database.commit()
+    partition_table(database, 'deliveries', log=lambda message: None)
+
+    this_month = month_start(datetime.date.today())
+    assert this_month in months(database, 'deliveries')
+    cur.execute("""
+        INSERT INTO deliveries (delivery_date, vendor_name, item_name, quantity, unit_price, status)
+        VALUES (%s, 'Acme', 'Widget', 5, 1.50, 'pending')
+        RETURNING tableoid::regclass::text, version;
+    """, (datetime.date.today(),))
+    assert cur.fetchone() == (partition_name('deliveries', this_month), 1)
+    database.commit()
+    with pytest.raises(psycopg2.errors.CheckViolation):
+        cur.execute("""
+            INSERT INTO deliveries (delivery_date, vendor_name, item_name, quantity, unit_price, status)
+            VALUES (%s, 'Acme', 'Widget', 5, 1.50, 'lost');
+        """, (datetime.date.today(),))
+    database.rollback()
+
+
+def test_maintenance_attaches_months_after_migrations(migrated):
+    created = ensure_partitions(migrated, 'deliveries', months_ahead=6)
+    last = add_months(month_start(datetime.date.today()), 6)
+    assert partition_name('deliveries', last) in created
+    assert last in months(migrated, 'deliveries')
+
+
+def test_archive_and_restore_a_deliveries_month(migrated, tmp_path):
+    month = add_months(month_start(datetime.date.today()), -2)
+    cur = migrated.cursor()
+    cur.execute("""
+        INSERT INTO inventory (item_name, vendor_name, quantity, value) VALUES ('Widget', 'Acme', 0, 2)
+        RETURNING item_id;
+    """)
+    item_id = cur.fetchone()[0]
+    migrated.commit()
+    ensure_partitions(migrated, 'deliveries', month)
+    cur.execute("""
+        INSERT INTO deliveries (delivery_date, vendor_name, item_name, quantity, unit_price, status)
+        VALUES (%s, 'Acme', 'Widget', 7, 2, 'delivered'), (%s, 'Acme', 'Widget', 3, 2, 'pending');
+    """, (month, month))
+    migrated.commit()
+
+    path = archive_partition(migrated, 'deliveries', month, str(tmp_path))
+    assert month not in months(migrated, 'deliveries')
+    # Only the delivered row moved stock, so only it is carried forward
+    cur.execute("SELECT item_id, quantity FROM archived_movements;")
+    assert cur.fetchall() == [(item_id, 7)]
+    migrated.commit()
+
+    assert restore_partition(migrated, path) == partition_name('deliveries', month)
+    assert month in months(migrated, 'deliveries')
+    cur.execute("SELECT status, quantity FROM deliveries WHERE delivery_date = %s ORDER BY quantity;", (month,))
+    assert cur.fetchall() == [('pending', 3), ('delivered', 7)]
+    cur.execute("SELECT on_hand FROM stock_balances WHERE item_id = %s;", (item_id,))
+    assert cur.fetchone() == (7,)
+    migrated.commit()
+
+
+def test_converting_a_table_keeps_its_rows_columns_and_triggers(database):
+    from conftest import SingleConnectionPool
+    from migrations import migrate
+    migrate(SingleConnectionPool(database), target=10, log=lambda message: None)
+    cur = database.cursor()
+    cur.execute("""
+        INSERT INTO inventory (item_name, vendor_name, quantity, value) VALUES ('Widget', 'Acme', 10, 2);
+        INSERT INTO sales (sale_date, item_name, quantity, price) VALUES (current_date, 'Widget', 4, 3);
+        ALTER TABLE sales ADD COLUMN note TEXT DEFAULT 'kept';
+        CREATE FUNCTION sales_touched() RETURNS trigger AS $$ BEGIN RETURN NULL; END; $$ LANGUAGE plpgsql;
+        CREATE TRIGGER sales_touched AFTER INSERT ON sales FOR EACH ROW EXECUTE FUNCTION sales_touched();
+    """)
+    database.commit()
+
+    # A column the partitioned definition doesn't know about can't be carried over
+    with pytest.raises(ValueError, match="note"):
+        partition_table(database, 'sales', log=lambda message: None)
+    cur.execute("ALTER TABLE sales DROP COLUMN note;")
+    database.commit()
+    partition_table(database, 'sales', log=lambda message: None)
+
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = 'sales'::regclass;")
+    assert cur.fetchone() == ('p',)
+    cur.execute("""
+        SELECT tgname FROM pg_trigger WHERE tgrelid = 'sales'::regclass AND NOT tgisinternal ORDER BY tgname;
+    """)
+    assert [row[0] for row in cur.fetchall()] == [
+        'sales_cache_invalidation', 'sales_set_item_id', 'sales_stock_movement', 'sales_touched']
+    cur.execute("SELECT item_name, quantity, price FROM sales;")
+    assert cur.fetchall() == [('Widget', 4, 3)]
+    # Copying rows into the partitions is not a stock movement
+    cur.execute("SELECT on_hand FROM stock_balances;")
+    assert cur.fetchall() == [(6,)]
+    database.commit()
@@ -0,0 +1,59 @@
+from profiling import collapsed_stacks, frame_label
+
+MAIN = ('app.py', 10, 'main')
+QUERY = ('db.py', 20, 'query')
+HELPER = ('util.py', 30, 'helper')
+BUILTIN = ('~', 0, "<method 'execute' of 'psycopg2.extensions.cursor' objects>")
+
+
+def parse(lines):
+    return {stack: int(micros) for stack, micros in (line.rsplit(' ', 1) for line in lines)}
+
+
+def test_frame_label():
+    assert frame_label(('/srv/app/db.py', 20, 'query')) == 'query (db.py:20)'
+    assert frame_label(BUILTIN) == BUILTIN[2]
+    assert frame_label(('x.py', 1, 'a;b')) == 'a,b (x.py:1)'
+
+
+def test_own_time_is_attributed_along_the_call_path():
+    # func: (primitive calls, calls, own time, cumulative time, {caller: (cc, nc, tt, ct)})
+    stats = {
+        MAIN: (1, 1, 1.0, 4.0, {}),
+        QUERY: (1, 1, 1.0, 3.0, {MAIN: (1, 1, 1.0, 3.0)}),
+        BUILTIN: (1, 1, 2.0, 2.0, {QUERY: (1, 1, 2.0, 2.0)}),
+    }
+    assert parse(collapsed_stacks(stats)) == {
+        'main (app.py:10)': 1000000,
+        'main (app.py:10);query (db.py:20)': 1000000,
+        f'main (app.py:10);query (db.py:20);{BUILTIN[2]}': 2000000,
+    }
+
+
+def test_shared_helper_is_split_by_caller_edge_time():
+    stats = {
+        MAIN: (1, 1, 0.0, 4.0, {}),
+        QUERY: (1, 1, 0.0, 1.0, {MAIN: (1, 1, 0.0, 1.0)}),
+        HELPER: (2, 2, 4.0, 4.0, {MAIN: (1, 1, 3.0, 3.0), QUERY: (1, 1, 1.0, 1.0)}),
+    }
+    assert parse(collapsed_stacks(stats)) == {
+        'main (app.py:10);helper (util.py:30)': 3000000,
+        'main (app.py:10);query (db.py:20);helper (util.py:30)': 1000000,
+    }
+
+
+def test_recursion_does_not_loop():
+    stats = {
+        MAIN: (1, 1, 0.0, 2.0, {}),
+        QUERY: (1, 3, 2.0, 2.0, {MAIN: (1, 1, 2.0, 2.0), QUERY: (2, 2, 1.0, 1.0)}),
+    }
+    assert parse(collapsed_stacks(stats)) == {'main (app.py:10);query (db.py:20)': 2000000}
+
+
+def test_frames_below_min_share_are_dropped():
+    stats = {
+        MAIN: (1, 1, 1.0, 1.001, {}),
+        QUERY: (1, 1, 0.001, 0.001, {MAIN: (1, 1, 0.001, 0.001)}),
+    }
+    assert list(parse(collapsed_stacks(stats, min_share=0.01))) == ['main (app.py:10)']
+    assert len(collapsed_stacks(stats, min_share=0)) == 2
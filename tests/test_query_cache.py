@@ -0,0 +1,29 @@
+import threading
+
+from query_cache import CacheInvalidationListener, QueryCache
+
+
+def test_concurrent_requests_start_one_listener(monkeypatch):
+    listener = CacheInvalidationListener(QueryCache(), {})
+    started = []
+    release = threading.Event()
+
+    def run():
+        started.append(threading.current_thread())
+        release.wait()
+
+    monkeypatch.setattr(listener, '_run', run)
+    barrier = threading.Barrier(8)
+
+    def request():
+        barrier.wait()
+        listener.ensure_running()
+
+    requests = [threading.Thread(target=request) for _ in range(8)]
+    for thread in requests:
+        thread.start()
+    for thread in requests:
+        thread.join()
+    release.set()
+    listener.thread.join()
+    assert started == [listener.thread]
@@ -0,0 +1,55 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import reports
+from reports import fetch_columns, moving_average, percentiles
+
+
+class ResultCursor:
+    # The part of a client-side psycopg2 cursor fetch_columns uses
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.rowcount = len(self.rows)
+        self.batches = []
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        self.batches.append(len(batch))
+        return batch
+
+
+def test_fetch_columns_fills_typed_arrays_in_batches(monkeypatch):
+    monkeypatch.setattr(reports, 'FETCH_BATCH_ROWS', 2)
+    days = [datetime.date(2024, 1, day) for day in range(1, 6)]
+    cur = ResultCursor((day, day.day * 1.5, day.day) for day in days)
+    columns = fetch_columns(cur, [('day', object), ('revenue', np.float64), ('units', np.int64)])
+    assert cur.batches == [2, 2, 1]
+    assert list(columns['day']) == days
+    assert columns['revenue'].dtype == np.float64 and list(columns['revenue']) == [1.5, 3.0, 4.5, 6.0, 7.5]
+    assert columns['units'].dtype == np.int64 and list(columns['units']) == [1, 2, 3, 4, 5]
+
+
+def test_fetch_columns_on_an_empty_result():
+    columns = fetch_columns(ResultCursor([]), [('label', object), ('value', np.float64)])
+    assert len(columns['label']) == 0 and len(columns['value']) == 0
+
+
+def test_fetch_columns_needs_a_row_count():
+    cur = ResultCursor([])
+    cur.rowcount = -1
+    with pytest.raises(ValueError):
+        fetch_columns(cur, [('value', np.float64)])
+
+
+def test_moving_average():
+    result = moving_average(np.array([1.0, 2.0, 3.0, 4.0]), 2)
+    assert np.isnan(result[0])
+    assert list(result[1:]) == [1.5, 2.5, 3.5]
+    assert np.isnan(moving_average(np.array([1.0]), 3)).all()
+
+
+def test_percentiles():
+    assert percentiles(np.arange(101.0), (50, 90)) == {'p50': 50.0, 'p90': 90.0}
+    assert percentiles(np.array([]), (50,)) == {'p50': None}
@@ -0,0 +1,46 @@
+import datetime
+
+from conftest import SingleConnectionPool
+from stock_ledger import MOVEMENTS_SQL, REBUILD_SQL, UNTRACKED_MOVEMENTS_SQL, StockLedger, rebuild_sql
+
+
+def test_history_before_delivery_status_counts_every_delivery():
+    assert "status = 'delivered'" in MOVEMENTS_SQL
+    assert "status" not in UNTRACKED_MOVEMENTS_SQL
+    assert "archived_movements" in MOVEMENTS_SQL and "archived_movements" not in UNTRACKED_MOVEMENTS_SQL
+
+
+def test_rebuild_only_rewrites_balances_that_changed():
+    statement = ' '.join(rebuild_sql(UNTRACKED_MOVEMENTS_SQL).split())
+    assert ' '.join(UNTRACKED_MOVEMENTS_SQL.split()) in statement
+    assert statement.endswith("WHERE stock_balances.on_hand IS DISTINCT FROM EXCLUDED.on_hand;")
+    assert REBUILD_SQL == rebuild_sql(MOVEMENTS_SQL)
+
+
+def test_reconcile_finds_and_repairs_drift(migrated):
+    cur = migrated.cursor()
+    cur.execute("""
+        INSERT INTO inventory (item_name, vendor_name, quantity, value)
+        VALUES ('Widget', 'Acme', 10, 2.50), ('Sprocket', 'Acme', 0, 1.00)
+        RETURNING item_id;
+    """)
+    widget, sprocket = [row[0] for row in cur.fetchall()]
+    today = datetime.date.today()
+    cur.execute("INSERT INTO sales (sale_date, item_name, quantity, price) VALUES (%s, 'Widget', 3, 2.50);", (today,))
+    cur.execute("""
+        INSERT INTO deliveries (delivery_date, vendor_name, item_name, quantity, unit_price, status)
+        VALUES (%s, 'Acme', 'Widget', 5, 2.00, 'delivered'), (%s, 'Acme', 'Widget', 8, 2.00, 'pending');
+    """, (today, today))
+    migrated.commit()
+    ledger = StockLedger(SingleConnectionPool(migrated))
+    # The never-moved Sprocket has no balance row and is not drift
+    assert ledger.reconcile() == []
+
+    cur.execute("UPDATE stock_balances SET on_hand = 99 WHERE item_id = %s;", (widget,))
+    cur.execute("INSERT INTO stock_balances (item_id, on_hand) VALUES (%s, 4);", (sprocket,))
+    migrated.commit()
+    drift = [{'item_id': widget, 'expected': 12, 'recorded': 99}, {'item_id': sprocket, 'expected': 0, 'recorded': 4}]
+    assert ledger.reconcile() == drift
+    assert ledger.reconcile(repair=True) == drift
+    assert ledger.reconcile() == []
+    assert ledger.get_balance(widget) == 12
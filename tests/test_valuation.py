@@ -0,0 +1,47 @@
+import datetime
+
+import pytest
+
+from conftest import SingleConnectionPool
+from valuation import InventoryValuation, movements_sql, take_snapshot, valuation_as_of
+
+
+def test_movements_are_dated_inside_every_branch():
+    # Each branch carries its own date range, so sales and deliveries partitions are pruned
+    bounded = ' '.join(movements_sql().split())
+    for column in ('sale_date', 'delivery_date', 'input_date'):
+        assert f"{column} > %(after)s AND {column} <= %(through)s" in bounded
+    assert "delivery_date <= %(through)s AND status = 'delivered'" in bounded
+    assert "%(through)s" not in movements_sql(bounded=False)
+
+
+def test_only_closed_days_are_snapshotted_and_valuation_needs_a_day():
+    with pytest.raises(ValueError, match="ended"):
+        take_snapshot(None, datetime.date.today())
+    with pytest.raises(ValueError, match="required"):
+        valuation_as_of(None, '')
+
+
+def test_valuation_rolls_a_snapshot_forward(migrated):
+    today = datetime.date.today()
+    yesterday = today - datetime.timedelta(days=1)
+    cur = migrated.cursor()
+    cur.execute("INSERT INTO inventory (item_name, vendor_name, quantity, value) "
+                "VALUES ('Widget', 'Acme', 10, 2.50) RETURNING item_id;")
+    item_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO sales (sale_date, item_name, quantity, price) VALUES (%s, 'Widget', 3, 4.00);", (today,))
+    migrated.commit()
+    valuation = InventoryValuation(SingleConnectionPool(migrated))
+
+    # Today's sale is taken back off the balance, leaving yesterday's 10
+    snapshot, created = valuation.snapshot(yesterday)
+    assert created and (snapshot['total_quantity'], snapshot['total_value']) == (10, 25.0)
+    assert valuation.snapshot(yesterday) == (snapshot, False)
+    with pytest.raises(ValueError, match="changed since"):
+        valuation.snapshot(today - datetime.timedelta(days=2))
+
+    totals = valuation.valuation(today)
+    assert (totals['total_quantity'], totals['total_value']) == (7, 17.5)
+    detail = valuation.valuation(today.isoformat(), detail=True)
+    assert detail['items'] == [{'item_id': item_id, 'quantity': 7, 'unit_value': 2.5, 'value': 17.5}]
+    assert (detail['total_quantity'], detail['total_value']) == (7, 17.5)
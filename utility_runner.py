@@ -0,0 +1,370 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import select
+import socket
+import time
+import psycopg2
+from database_utilities import db_config_from_env, get_db_pool
+from forecasting import Forecaster
+from partitions import maintain_partitions
+from stock_ledger import StockLedger
+from valuation import take_snapshot
+
+
+UTILITY_WORKERS = int(os.environ.get('UTILITY_WORKERS', 2))
+UTILITY_TIMEOUT = int(os.environ.get('UTILITY_TIMEOUT', 3600))  # seconds, unless the row sets its own
+UTILITY_POLL_INTERVAL = float(os.environ.get('UTILITY_POLL_INTERVAL', 5))  # seconds
+PROGRESS_INTERVAL = 1.0  # seconds between progress writes
+JOB_BATCH_SIZE = 1000
+# The runner also keeps future sales/deliveries partitions created and yesterday's valuation snapshot taken, this often
+PARTITION_MAINTENANCE_INTERVAL = float(os.environ.get('PARTITION_MAINTENANCE_INTERVAL', 6 * 3600))  # seconds
+# Notified when jobs are queued (migration 17)
+UTILITY_CHANNEL = 'utility_jobs'
+# How long past its deadline a running row may go unreported before another runner gives up on it
+ABANDON_GRACE = 300  # seconds
+
+log = logging.getLogger('inventory.utilities')
+
+
+# Claim the oldest queued job; SKIP LOCKED lets several runners pull from the same table
+CLAIM_SQL = """
+    UPDATE utilities
+    SET status = 'running', progress = 0, message = NULL, attempts = attempts + 1, worker = %(worker)s,
+        started_at = now(), finished_at = NULL, duration_ms = NULL,
+        timeout_seconds = COALESCE(timeout_seconds, %(timeout)s)
+    WHERE utility_id = (
+        SELECT utility_id FROM utilities
+        WHERE status = 'queued'
+        ORDER BY utility_id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING utility_id, utility_name, parameters, timeout_seconds;
+"""
+
+FINISH_SQL = """
+    UPDATE utilities
+    SET status = %(status)s, message = %(message)s, finished_at = now(),
+        progress = CASE WHEN %(status)s = 'succeeded' THEN 1 ELSE progress END,
+        duration_ms = (extract(epoch FROM now() - started_at) * 1000)::bigint
+    WHERE utility_id = %(utility_id)s AND status = 'running';
+"""
+
+# Rows left running by a runner that died without finishing them
+ABANDONED_SQL = """
+    UPDATE utilities
+    SET status = 'failed', message = 'Runner stopped reporting', finished_at = now(),
+        duration_ms = (extract(epoch FROM now() - started_at) * 1000)::bigint
+    WHERE status = 'running'
+      AND started_at + make_interval(secs => timeout_seconds + %s) < now();
+"""
+
+
+def parse_parameters(parameters):
+    # utilities.parameters is free text; jobs take a JSON object (or nothing)
+    if not parameters or not parameters.strip():
+        return {}
+    try:
+        params = json.loads(parameters)
+    except ValueError:
+        raise ValueError("Utility parameters must be a JSON object")
+    if not isinstance(params, dict):
+        raise ValueError("Utility parameters must be a JSON object")
+    return params
+
+
+class JobProgress:
+    """Progress callback handed to a job.
+
+    Writes go over their own autocommit connection, so progress is visible
+    while the job's work is still uncommitted, and are throttled to one per
+    ``PROGRESS_INTERVAL``.
+    """
+
+    def __init__(self, utility_id, connect_kwargs):
+        self.utility_id = utility_id
+        self.conn = psycopg2.connect(**connect_kwargs)
+        self.conn.autocommit = True
+        self.last_write = 0.0
+
+    def __call__(self, fraction, message=None):
+        now = time.monotonic()
+        if now - self.last_write < PROGRESS_INTERVAL:
+            return
+        self.last_write = now
+        self.conn.cursor().execute("""
+            UPDATE utilities SET progress = %s, message = COALESCE(%s, message)
+            WHERE utility_id = %s AND status = 'running';
+        """, (max(0.0, min(float(fraction), 1.0)), message, self.utility_id))
+
+    def finish(self, status, message):
+        try:
+            self.conn.cursor().execute(FINISH_SQL, {'utility_id': self.utility_id, 'status': status,
+                                                    'message': message})
+        finally:
+            self.conn.close()
+
+
+# Jobs: fn(db_pool, params, progress) -> summary message
+
+def recount(db_pool, params, progress):
+    # Rebuild stock balances from movement history
+    progress(0, "Recounting stock")
+    drift = StockLedger(db_pool).reconcile(repair=True)
+    return f"{len(drift)} item(s) repaired"
+
+
+def revalue(db_pool, params, progress):
+    # Scale inventory value by {"percent": n}, optionally for one {"vendor_name": ...}, in item_id batches
+    percent = float(params['percent'])
+    vendor_name = params.get('vendor_name')
+    conn = db_pool.getconn()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT min(item_id), max(item_id) FROM inventory;")
+        low, high = cur.fetchone()
+        conn.commit()
+        updated = 0
+        if low is None:
+            return "No items to revalue"
+        for start in range(low, high + 1, JOB_BATCH_SIZE):
+            cur.execute("""
+                UPDATE inventory SET value = round(value * (1 + %s / 100.0), 2)
+                WHERE item_id >= %s AND item_id < %s AND (%s::varchar IS NULL OR vendor_name = %s);
+            """, (percent, start, start + JOB_BATCH_SIZE, vendor_name, vendor_name))
+            updated += cur.rowcount
+            conn.commit()
+            progress((start + JOB_BATCH_SIZE - low) / (high - low + 1))
+        return f"{updated} item(s) revalued by {percent}%"
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
+
+
+def purge(db_pool, params, progress):
+    # Delete closed orders and finished utility jobs older than {"days": n} (default 90), in batches
+    days = int(params.get('days', 90))
+    targets = (
+        ('orders', 'order_id', "status IN ('expired', 'cancelled') AND created_at"),
+        ('utilities', 'utility_id', "status IN ('succeeded', 'failed', 'timed_out', 'skipped') AND queued_at"),
+    )
+    conn = db_pool.getconn()
+    try:
+        cur = conn.cursor()
+        deleted = {}
+        for index, (table, pk, condition) in enumerate(targets):
+            deleted[table] = 0
+            while True:
+                cur.execute(f"""
+                    DELETE FROM {table} WHERE {pk} IN (
+                        SELECT {pk} FROM {table}
+                        WHERE {condition} < now() - make_interval(days => %s)
+                        LIMIT %s
+                    );
+                """, (days, JOB_BATCH_SIZE))
+                deleted[table] += cur.rowcount
+                conn.commit()
+                progress((index + 0.5) / len(targets), f"Purged {deleted[table]} {table} rows")
+                if cur.rowcount < JOB_BATCH_SIZE:
+                    break
+        return ", ".join(f"{count} {table}" for table, count in deleted.items()) + " row(s) purged"
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
+
+
+def forecast(db_pool, params, progress):
+    # Recompute reorder points; {"force": true} ignores the no-new-sales shortcut
+    count = Forecaster(db_pool).run(force=bool(params.get('force')), progress=progress)
+    return "No new sales or deliveries since the last run" if count is None else f"{count} item(s) forecast"
+
+
+def partitions(db_pool, params, progress):
+    # Create upcoming monthly partitions and archive months past PARTITION_RETENTION_MONTHS
+    conn = db_pool.getconn()
+    try:
+        done = maintain_partitions(conn)
+    finally:
+        db_pool.putconn(conn)
+    return f"{len(done)} partition(s) created or archived"
+
+
+def snapshot(db_pool, params, progress):
+    # Valuation snapshot of {"as_of": "YYYY-MM-DD"} (default: yesterday)
+    conn = db_pool.getconn()
+    try:
+        result, created = take_snapshot(conn, params.get('as_of'))
+    finally:
+        db_pool.putconn(conn)
+    if not created:
+        return f"Snapshot for {result['as_of']} already taken"
+    return f"Snapshot for {result['as_of']}: {result['items']} item(s), {result['stored_items']} stored"
+
+
+JOBS = {
+    'recount': recount,
+    'revalue': revalue,
+    'purge': purge,
+    'forecast': forecast,
+    'partitions': partitions,
+    'snapshot': snapshot,
+}
+
+
+def validate_job(utility_name, parameters):
+    # Called when a job is queued, so bad requests fail at the form instead of in the runner
+    if utility_name not in JOBS:
+        raise ValueError(f"Unknown utility {utility_name}; expected one of {', '.join(sorted(JOBS))}")
+    return parse_parameters(parameters)
+
+
+def execute_job(utility_id, utility_name, parameters):
+    # Entry point of a job's child process
+    logging.basicConfig(level=logging.INFO)
+    progress = JobProgress(utility_id, db_config_from_env())
+    status, message = 'succeeded', None
+    try:
+        message = JOBS[utility_name](get_db_pool(), parse_parameters(parameters), progress)
+    except Exception as e:
+        log.exception("utility %s (%s) failed", utility_id, utility_name)
+        status, message = 'failed', f"{type(e).__name__}: {e}"
+    finally:
+        progress.finish(status, message)
+        get_db_pool().closeall()
+
+
+class UtilityRunner:
+    """Executes queued ``utilities`` rows, outside the web workers.
+
+    The table is the queue: rows are claimed with ``FOR UPDATE SKIP LOCKED``
+    and each job runs in its own process, at most ``workers`` at a time.
+    A job that outlives its timeout is terminated and marked ``timed_out``.
+    The runner sleeps on ``UTILITY_CHANNEL`` ('utility_jobs'), which the
+    utilities insert trigger notifies, so a newly queued row wakes it
+    immediately.
+    """
+
+    def __init__(self, connect_kwargs, workers=UTILITY_WORKERS, timeout=UTILITY_TIMEOUT,
+                 poll_interval=UTILITY_POLL_INTERVAL):
+        self.connect_kwargs = connect_kwargs
+        self.workers = workers
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        # A fresh interpreter per job: nothing (sockets, locks, pools) is inherited from the runner
+        self.context = multiprocessing.get_context('spawn')
+        self.running = {}  # utility_id -> (process, deadline)
+        self.next_maintenance = 0.0
+
+    def claim(self, cur):
+        cur.execute(CLAIM_SQL, {'worker': self.worker, 'timeout': self.timeout})
+        return cur.fetchone()
+
+    def start(self, utility_id, utility_name, parameters, timeout_seconds):
+        process = self.context.Process(target=execute_job, args=(utility_id, utility_name, parameters),
+                                       name=f'utility-{utility_id}', daemon=True)
+        process.start()
+        self.running[utility_id] = (process, time.monotonic() + timeout_seconds)
+        log.info("started utility %s (%s)", utility_id, utility_name)
+
+    def reap(self, cur):
+        now = time.monotonic()
+        for utility_id, (process, deadline) in list(self.running.items()):
+            if process.is_alive() and now < deadline:
+                continue
+            if process.is_alive():
+                process.terminate()
+                process.join(5)
+                if process.is_alive():
+                    process.kill()
+                status, message = 'timed_out', "Terminated after exceeding its timeout"
+            else:
+                # A clean exit already recorded its own outcome; this only catches crashes
+                status, message = 'failed', f"Job process exited with code {process.exitcode}"
+            process.join()
+            cur.execute(FINISH_SQL, {'utility_id': utility_id, 'status': status, 'message': message})
+            del self.running[utility_id]
+            log.info("utility %s finished (exit code %s)", utility_id, process.exitcode)
+
+    def maintain(self):
+        # Partition upkeep is quick DDL and a closed day's snapshot mostly stores deltas,
+        # so both run inline rather than as queued jobs
+        if time.monotonic() < self.next_maintenance:
+            return
+        self.next_maintenance = time.monotonic() + PARTITION_MAINTENANCE_INTERVAL
+        conn = psycopg2.connect(**self.connect_kwargs)
+        try:
+            for name in maintain_partitions(conn):
+                log.info("partition maintenance: %s", name)
+        except Exception:
+            log.exception("partition maintenance failed")
+        try:
+            result, created = take_snapshot(conn)
+            if created:
+                log.info("valuation snapshot for %s: %s item(s) stored", result['as_of'], result['stored_items'])
+        except Exception:
+            log.exception("valuation snapshot failed")
+        finally:
+            conn.close()
+
+    def wait_timeout(self):
+        if not self.running:
+            return self.poll_interval
+        next_deadline = min(deadline for _, deadline in self.running.values())
+        return max(0.0, min(self.poll_interval, next_deadline - time.monotonic()))
+
+    def run(self, once=False):
+        """Claim and execute jobs until interrupted (or, with ``once``, until the queue is drained)."""
+        conn = psycopg2.connect(**self.connect_kwargs)
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute(f"LISTEN {UTILITY_CHANNEL};")
+        try:
+            while True:
+                self.reap(cur)
+                self.maintain()
+                cur.execute(ABANDONED_SQL, (ABANDON_GRACE,))
+                while len(self.running) < self.workers:
+                    job = self.claim(cur)
+                    if job is None:
+                        break
+                    self.start(*job)
+                if once and not self.running:
+                    return
+                # Wake on a newly queued job, a job process exiting, or the next deadline
+                sentinels = [process.sentinel for process, _ in self.running.values()]
+                select.select([conn] + sentinels, [], [], self.wait_timeout())
+                conn.poll()
+                conn.notifies.clear()
+        finally:
+            for process, _ in self.running.values():
+                process.terminate()
+            conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Execute queued utilities")
+    parser.add_argument('--workers', type=int, default=UTILITY_WORKERS, help="jobs to run at once")
+    parser.add_argument('--timeout', type=int, default=UTILITY_TIMEOUT,
+                        help="seconds a job may run unless its row sets timeout_seconds")
+    parser.add_argument('--once', action='store_true', help="exit once the queue is empty")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    runner = UtilityRunner(db_config_from_env(), args.workers, args.timeout)
+    try:
+        runner.run(once=args.once)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,19 @@
+# Required form fields for each write route; the bulk importer applies the same rules
+REQUIRED_FIELDS = {
+    'add_item': ['item_name', 'vendor_name', 'quantity', 'value'],
+    'submit_input': ['input_type', 'item_id', 'quantity', 'date'],
+    'run_utility': ['utility_name', 'parameters'],
+    'add_sale': ['sale_date', 'item_name', 'quantity', 'price'],
+    'place_order': ['order_date', 'customer_name', 'item_name', 'quantity'],
+    'record_delivery': ['order_id', 'date', 'status'],
+    'insert_delivery': ['delivery_date', 'vendor_name', 'item_name', 'quantity', 'unit_price'],
+}
+
+
+def missing_field(data, route):
+    # Return the first required field that is absent or blank, or None if the data is complete
+    for field in REQUIRED_FIELDS[route]:
+        value = data.get(field)
+        if value is None or (isinstance(value, str) and not value.strip()):
+            return field
+    return None
@@ -0,0 +1,288 @@
+import argparse
+import datetime
+import json
+import os
+from database_utilities import get_db_pool
+
+
+# Every this many snapshots in a chain, one stores every item in full (a keyframe); the rest store only
+# the items whose quantity or unit value changed since the previous snapshot, so rebuilding one reads at
+# most this many
+SNAPSHOT_KEYFRAME_INTERVAL = int(os.environ.get('SNAPSHOT_KEYFRAME_INTERVAL', 30))
+
+# Dated stock movements (table, date column, signed quantity, condition). The date range is applied
+# inside every branch so sales and deliveries partitions are pruned. Recounts and new items' opening
+# quantities carry no date; they show up from the next snapshot on.
+MOVEMENT_BRANCHES = (
+    ('sales', 'sale_date', '-quantity', None),
+    ('deliveries', 'delivery_date', 'quantity', "status = 'delivered'"),
+    ('inventory_inputs', 'input_date', "CASE WHEN input_type = 'purchase' THEN quantity ELSE -quantity END", None),
+)
+
+
+def movements_sql(bounded=True):
+    # Per-item movement dated after %(after)s (and through %(through)s when bounded)
+    branches = []
+    for table, column, delta, condition in MOVEMENT_BRANCHES:
+        where = ["item_id IS NOT NULL", f"{column} > %(after)s"]
+        if bounded:
+            where.append(f"{column} <= %(through)s")
+        if condition:
+            where.append(condition)
+        branches.append(f"SELECT item_id, {delta} AS delta FROM {table} WHERE {' AND '.join(where)}")
+    return f"""
+        SELECT item_id, sum(delta)::BIGINT AS delta
+        FROM ({' UNION ALL '.join(branches)}) movements
+        GROUP BY item_id
+    """
+
+
+# Quantity and unit value of every item at the end of %(after)s: on hand now, less whatever moved since
+STATE_SQL = f"""
+    CREATE TEMP TABLE valuation_state ON COMMIT DROP AS
+    SELECT i.item_id, (COALESCE(b.on_hand, 0) - COALESCE(m.delta, 0))::INTEGER AS quantity, i.value AS unit_value
+    FROM inventory i
+    LEFT JOIN stock_balances b USING (item_id)
+    LEFT JOIN ({movements_sql(bounded=False)}) m USING (item_id);
+"""
+
+# The full item state of snapshot %(snapshot)s: the latest row per item along its chain, deleted items dropped
+REBUILD_SQL = """
+    SELECT item_id, quantity, unit_value FROM (
+        SELECT DISTINCT ON (i.item_id) i.item_id, i.quantity, i.unit_value
+        FROM valuation_snapshot_items i
+        JOIN valuation_snapshots s USING (snapshot_id)
+        WHERE s.keyframe_id = %(keyframe)s AND i.snapshot_id <= %(snapshot)s
+        ORDER BY i.item_id, i.snapshot_id DESC
+    ) latest
+    WHERE quantity IS NOT NULL
+"""
+
+# The one unit value valuation_as_of applies to an item (``{item}``.item_id): its latest row along the chain of
+# snapshot %(snapshot)s, or its current value for an item that snapshot doesn't hold (one added since)
+UNIT_VALUE_SQL = """
+    LEFT JOIN LATERAL (
+        SELECT si.unit_value
+        FROM valuation_snapshot_items si
+        JOIN valuation_snapshots s USING (snapshot_id)
+        WHERE si.item_id = {item}.item_id AND s.keyframe_id = %(keyframe)s AND si.snapshot_id <= %(snapshot)s
+        ORDER BY si.snapshot_id DESC
+        LIMIT 1
+    ) v ON true
+    LEFT JOIN inventory i ON i.item_id = {item}.item_id
+"""
+UNIT_VALUE = "COALESCE(v.unit_value, i.value, 0)"
+
+SNAPSHOT_COLUMNS = ('snapshot_id', 'as_of', 'keyframe_id', 'items', 'total_quantity', 'total_value',
+                    'stored_items', 'taken_at')
+
+
+def snapshot_dict(row):
+    snapshot = dict(zip(SNAPSHOT_COLUMNS, row))
+    snapshot['as_of'] = snapshot['as_of'].isoformat()
+    snapshot['taken_at'] = snapshot['taken_at'].isoformat()
+    snapshot['total_value'] = float(snapshot['total_value'])
+    return snapshot
+
+
+def parse_day(value, default=None):
+    if value is None or value == '':
+        return default
+    return value if isinstance(value, datetime.date) else datetime.date.fromisoformat(value)
+
+
+def take_snapshot(conn, as_of=None):
+    """Record the quantity and unit value of every item at the end of ``as_of`` (default: yesterday).
+
+    Only closed days can be snapshotted, since later writes dated today
+    would be missed. Quantities are rebuilt by taking dated movements back
+    off today's balances, which can't undo recounts or new items' opening
+    stock, so a day before yesterday is refused unless no balance has
+    changed since it ended. The snapshot extends the chain of the latest
+    earlier one with just the items that changed, unless that chain is
+    ``SNAPSHOT_KEYFRAME_INTERVAL`` long or a later snapshot already exists,
+    in which case it is a full keyframe. Unit values are those current when
+    the snapshot is taken, so run it soon after the day closes (the utility
+    runner does). Returns ``(snapshot, created)``; an existing snapshot for
+    the day is returned as is.
+    """
+    today = datetime.date.today()
+    as_of = parse_day(as_of, today - datetime.timedelta(days=1))
+    if as_of >= today:
+        raise ValueError("Only days that have ended can be snapshotted")
+    cur = conn.cursor()
+    try:
+        # One snapshot at a time, so two runners can't both extend the same chain
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('valuation_snapshots'));")
+        cur.execute(f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM valuation_snapshots WHERE as_of = %s;", (as_of,))
+        existing = cur.fetchone()
+        if existing:
+            conn.commit()
+            return snapshot_dict(existing), False
+        if as_of < today - datetime.timedelta(days=1):
+            # Every stock change, dated or not, stamps its balance row, so no later stamp means nothing to undo
+            cur.execute("SELECT 1 FROM stock_balances WHERE updated_at >= %s::date + 1 LIMIT 1;", (as_of,))
+            if cur.fetchone():
+                raise ValueError(f"Stock has changed since {as_of}, so it can no longer be snapshotted")
+
+        cur.execute("""
+            SELECT snapshot_id, keyframe_id, as_of = (SELECT max(as_of) FROM valuation_snapshots),
+                   (SELECT count(*) FROM valuation_snapshots c WHERE c.keyframe_id = s.keyframe_id)
+            FROM valuation_snapshots s
+            WHERE as_of < %s
+            ORDER BY as_of DESC
+            LIMIT 1;
+        """, (as_of,))
+        previous = cur.fetchone()
+        cur.execute("SELECT nextval(pg_get_serial_sequence('valuation_snapshots', 'snapshot_id'));")
+        snapshot_id = cur.fetchone()[0]
+        cur.execute(STATE_SQL, {'after': as_of})
+
+        if previous and previous[2] and previous[3] < SNAPSHOT_KEYFRAME_INTERVAL:
+            keyframe_id = previous[1]
+            cur.execute(f"""
+                INSERT INTO valuation_snapshot_items (snapshot_id, item_id, quantity, unit_value)
+                SELECT %(snapshot_id)s, item_id, s.quantity, s.unit_value
+                FROM valuation_state s
+                FULL JOIN ({REBUILD_SQL}) p USING (item_id)
+                WHERE (s.quantity, s.unit_value) IS DISTINCT FROM (p.quantity, p.unit_value);
+            """, {'snapshot_id': snapshot_id, 'keyframe': keyframe_id, 'snapshot': previous[0]})
+        else:
+            keyframe_id = snapshot_id
+            cur.execute("""
+                INSERT INTO valuation_snapshot_items (snapshot_id, item_id, quantity, unit_value)
+                SELECT %s, item_id, quantity, unit_value FROM valuation_state;
+            """, (snapshot_id,))
+        stored_items = cur.rowcount
+
+        cur.execute(f"""
+            INSERT INTO valuation_snapshots ({', '.join(SNAPSHOT_COLUMNS[:-1])})
+            SELECT %s, %s, %s, count(*), COALESCE(sum(quantity), 0), COALESCE(sum(quantity * unit_value), 0), %s
+            FROM valuation_state
+            RETURNING {', '.join(SNAPSHOT_COLUMNS)};
+        """, (snapshot_id, as_of, keyframe_id, stored_items))
+        snapshot = snapshot_dict(cur.fetchone())
+        conn.commit()
+        return snapshot, True
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def valuation_as_of(conn, day, detail=False):
+    """Inventory quantity and value at the end of ``day``.
+
+    Starts from the nearest snapshot, before or after ``day``, and applies
+    the sales, deliveries and inputs dated in between (forwards or
+    backwards). Totals and detail value items by the same rule
+    (UNIT_VALUE_SQL), so they agree; totals need only the snapshot row plus
+    the items that moved, while ``detail`` adds every item's quantity and
+    value. Raises LookupError when no snapshot exists yet.
+    """
+    day = parse_day(day)
+    if day is None:
+        raise ValueError("A day to value is required")
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM valuation_snapshots
+        ORDER BY abs(as_of - %s), as_of DESC
+        LIMIT 1;
+    """, (day,))
+    row = cur.fetchone()
+    if row is None:
+        raise LookupError("No valuation snapshots have been taken yet")
+    snapshot = snapshot_dict(row)
+    as_of = row[1]
+    # Movements between the snapshot and the day are added going forwards and taken away going backwards
+    params = {'after': min(as_of, day), 'through': max(as_of, day), 'sign': 1 if day >= as_of else -1,
+              'keyframe': snapshot['keyframe_id'], 'snapshot': snapshot['snapshot_id']}
+
+    result = {'as_of': day.isoformat(), 'snapshot': snapshot}
+    if not detail:
+        cur.execute(f"""
+            SELECT COALESCE(sum(m.delta), 0) * %(sign)s, COALESCE(sum(m.delta * {UNIT_VALUE}), 0) * %(sign)s
+            FROM ({movements_sql()}) m
+            {UNIT_VALUE_SQL.format(item='m')};
+        """, params)
+        quantity, value = cur.fetchone()
+        result['total_quantity'] = int(snapshot['total_quantity'] + quantity)
+        result['total_value'] = float(snapshot['total_value']) + float(value)
+        return result
+
+    cur.execute(f"""
+        SELECT items.item_id, quantity, {UNIT_VALUE}, quantity * {UNIT_VALUE}
+        FROM (
+            SELECT item_id, COALESCE(s.quantity, 0) + COALESCE(m.delta, 0) * %(sign)s AS quantity
+            FROM ({REBUILD_SQL}) s
+            FULL JOIN ({movements_sql()}) m USING (item_id)
+        ) items
+        {UNIT_VALUE_SQL.format(item='items')}
+        ORDER BY items.item_id;
+    """, params)
+    items = [{'item_id': item_id, 'quantity': int(quantity), 'unit_value': float(unit_value),
+              'value': float(value)} for item_id, quantity, unit_value, value in cur.fetchall()]
+    result['items'] = items
+    result['total_quantity'] = sum(item['quantity'] for item in items)
+    result['total_value'] = sum(item['value'] for item in items)
+    return result
+
+
+class InventoryValuation:
+    """Point-in-time inventory valuation from delta-encoded snapshots (see take_snapshot)."""
+
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
+
+    def snapshot(self, as_of=None):
+        conn = self.db_pool.getconn()
+        try:
+            return take_snapshot(conn, as_of)
+        finally:
+            self.db_pool.putconn(conn)
+
+    def valuation(self, day, detail=False):
+        conn = self.db_pool.getconn(readonly=True)
+        try:
+            return valuation_as_of(conn, day, detail)
+        finally:
+            self.db_pool.putconn(conn)
+
+    def list_snapshots(self, limit=100):
+        conn = self.db_pool.getconn(readonly=True)
+        try:
+            cur = conn.cursor()
+            cur.execute(f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM valuation_snapshots ORDER BY as_of DESC LIMIT %s;",
+                        (limit,))
+            return [snapshot_dict(row) for row in cur.fetchall()]
+        finally:
+            self.db_pool.putconn(conn)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Take inventory valuation snapshots and value stock as of a date")
+    commands = parser.add_subparsers(dest='command', required=True)
+    snapshot = commands.add_parser('snapshot', help="snapshot the end of a closed day")
+    snapshot.add_argument('--as-of', help="day to snapshot (YYYY-MM-DD, default: yesterday)")
+    value = commands.add_parser('value', help="inventory value at the end of a day")
+    value.add_argument('as_of', help="day to value (YYYY-MM-DD)")
+    value.add_argument('--detail', action='store_true', help="include every item")
+    commands.add_parser('list', help="list recent snapshots")
+    args = parser.parse_args(argv)
+
+    valuation = InventoryValuation(get_db_pool())
+    try:
+        if args.command == 'snapshot':
+            result, created = valuation.snapshot(args.as_of)
+            result['created'] = created
+        elif args.command == 'value':
+            result = valuation.valuation(args.as_of, args.detail)
+        else:
+            result = valuation.list_snapshots()
+    except (ValueError, LookupError) as e:
+        parser.error(str(e))
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
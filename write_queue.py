@@ -0,0 +1,142 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from psycopg2.extras import execute_values
+from database_utilities import PRIORITY_WRITE, mark_write, set_request_limits
+from query_cache import query_cache
+
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_DELAY = 0.005
+# How long write() waits for its batch to commit before giving up on the row
+DEFAULT_WRITE_TIMEOUT = float(os.environ.get('GROUP_COMMIT_WRITE_TIMEOUT', 10))  # seconds
+
+
+class GroupCommitQueue:
+    """Write-behind queue that batches single-row INSERTs into one commit.
+
+    Callers hand over a row and block on a future; a writer thread drains the
+    queue, inserts up to ``batch_size`` rows with one multi-row INSERT and
+    commits once. A caller only returns after the commit covering its row, so
+    durability is the same as a per-request commit.
+
+    The writer starts on the first submit in each process, so a queue built
+    at import time keeps working in pre-forked workers.
+    """
+
+    def __init__(self, db_pool, table, columns, batch_size=DEFAULT_BATCH_SIZE, max_delay=DEFAULT_MAX_DELAY,
+                 write_timeout=DEFAULT_WRITE_TIMEOUT):
+        self.db_pool = db_pool
+        self.table = table
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.write_timeout = write_timeout
+        self.pending = queue.Queue()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.writer = None
+
+    def ensure_running(self):
+        # One writer per process: a forked child inherits neither the parent's thread nor its queued rows
+        if self.pid == os.getpid() and self.writer and self.writer.is_alive():
+            return
+        with self.lock:
+            if self.pid == os.getpid() and self.writer and self.writer.is_alive():
+                return
+            if self.pid != os.getpid():
+                self.pending = queue.Queue()
+            self.pid = os.getpid()
+            self.writer = threading.Thread(target=self._run, name=f"group-commit-{self.table}", daemon=True)
+            self.writer.start()
+
+    def submit(self, values):
+        # Queue one row and return a future that resolves once its batch has committed
+        if self.stopped.is_set():
+            raise RuntimeError(f"Write queue for {self.table} is closed")
+        self.ensure_running()
+        future = Future()
+        self.pending.put((tuple(values), future))
+        return future
+
+    def write(self, values, timeout=None):
+        future = self.submit(values)
+        try:
+            result = future.result(self.write_timeout if timeout is None else timeout)
+        except TimeoutError:
+            # A row still queued is dropped; one already in a flushing batch may yet commit
+            future.cancel()
+            raise
+        # The commit happened on the writer thread; stickiness belongs to the caller's session
+        mark_write()
+        return result
+
+    def close(self):
+        # Stop accepting rows, flush what is queued and wait for this process's writer to exit
+        self.stopped.set()
+        if self.pid != os.getpid() or self.writer is None:
+            return
+        self.pending.put(None)
+        self.writer.join()
+
+    def _collect(self):
+        # Block for the first row, then keep gathering until the batch is full or the window closes
+        first = self.pending.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = self.pending.get(timeout=max(remaining, 0)) if remaining > 0 else self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                # Put the sentinel back so the loop exits after this batch is flushed
+                self.pending.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        # Batches hold back every queued request, so they jump the pool's queue like request writes do
+        set_request_limits(PRIORITY_WRITE)
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            # Rows whose caller gave up before the batch formed are not written
+            batch = [(values, future) for values, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self._flush([values for values, _ in batch])
+            except Exception:
+                # One bad row shouldn't fail its neighbours: retry the batch row by row
+                for values, future in batch:
+                    try:
+                        self._flush([values])
+                        future.set_result(True)
+                    except Exception as e:
+                        future.set_exception(e)
+            else:
+                for _, future in batch:
+                    future.set_result(True)
+
+    def _flush(self, rows):
+        conn = self.db_pool.getconn()
+        try:
+            cur = conn.cursor()
+            execute_values(cur, f"INSERT INTO {self.table} ({', '.join(self.columns)}) VALUES %s;",
+                           rows, page_size=len(rows))
+            conn.commit()
+            query_cache.invalidate(self.table, 'stock_balances')
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.db_pool.putconn(conn)